@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# =========================================================================== #
+
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Final, Iterable, Iterator, Literal
+
+from kotai.cache import Manifest, digest, fileDigest
+
+# --------------------------------------------------------------------------- #
+'''
+Artifacts of a benchmark (--storage): the files of the pipeline stages, read
+and written through Artifacts, by the stages and by kotai.stats. Two backends:
+
+    dirs    every artifact is a file of <bench>.d/, next to <bench>.c (the
+            default, and the layout of previous versions)
+
+    pack    text artifacts (descriptor, constraint_<ket>, the genBench .c and
+            the .info files) are records of append-only packs in
+            --artifacts-dir, <root>/packs/pack-<n>.dat, each with its index
+            split in shards, <root>/packs/pack-<n>.idx/<m>.idx, n and m from
+            a hash of the benchmark path.
+            Records are zlib-compressed with --pack-compress. Everything else
+            (binaries, .map, .cfg, the manifest) goes to the work dir of the
+            benchmark, <root>/work/<h[:2]>/<h[2:4]>/<bench stem>-<h[:16]>,
+            h a hash of its path, so no directory grows with the corpus.
+
+Tools only read and write files: Artifacts.files hands out the paths a tool
+works with, materializing packed artifacts in a temp dir of the worker (see
+tempfile) for as long as the tool needs them, and Artifacts.store packs what
+a tool wrote there. With the dirs backend, both deal with the files of
+<bench>.d/ directly.
+
+A pack is appended to under an exclusive flock of its .dat, the record then
+its index line, so concurrent workers and runs never interleave. The latest
+record of a (bench, name) replaces the earlier ones, and Artifacts.remove
+(--clean) appends tombstones: packs are never rewritten. Nothing is kept in
+memory: every lookup reads the index shard of the benchmark, the lines of a
+few benchmarks (Artifacts.indexShards per pack), so a worker never holds the
+index of the corpus, and a record replaced by another worker is never read.
+
+Index lines are tab-separated: bench, name, offset, length, codec ('-' raw,
+'z' zlib, '!' tombstone) and the time of the record.
+
+[--scratch-dir] With either backend, the artifacts of the compile and CFGgrind
+stages (binaries, .map, .cfg...) that aren't in the keep-set (--scratch-keep,
+by suffix, .info and .c by default) are files of a scratch dir per benchmark,
+<scratch>/<bench stem>-<h[:16]>, e.g. on a tmpfs. The kept ones are written
+to persistent storage directly, and so are the descriptor, the constraints
+and the manifest. Once a benchmark leaves the pipeline with some optLevels,
+the parent deletes their scratch files (see Artifacts.clearScratch). The
+temp copies of packed artifacts go to the scratch dir too.
+'''
+# --------------------------------------------------------------------------- #
+
+Storage = Literal['dirs', 'pack']
+
+Storages: Final[list[Storage]] = ['dirs', 'pack']
+
+
+def isText(name: str) -> bool:
+    '''Whether the artifact name is packed by the pack backend'''
+    return (name == 'descriptor' or name.startswith('constraint_')
+            or name.endswith('.c') or name.endswith('.info'))
+
+
+def readRecord(dataPath: Path, offset: int, length: int, codec: str) -> bytes:
+    '''Contents of a pack record (OSError if it can't be read)'''
+    with open(dataPath, 'rb') as fhandle:
+        fhandle.seek(offset)
+        data = fhandle.read(length)
+    if len(data) != length:
+        raise OSError(f'Truncated record at {offset}: {dataPath}')
+    return zlib.decompress(data) if codec == 'z' else data
+
+
+# (offset, length, codec, time) of a record
+PackEntry = tuple[int, int, str, float]
+
+
+class Pack:
+    '''A single pack: append-only records plus their index, see Artifacts'''
+
+    # ---------------------------- Member attrs. ---------------------------- #
+
+    __slots__ = (
+        'dataPath',
+        'indexDir',
+    )
+
+    def __init__(self, root: Path, n: int):
+        self.dataPath: Path = root / f'pack-{n:03}.dat'
+        self.indexDir: Path = root / f'pack-{n:03}.idx'
+
+    def indexPath(self, bench: str) -> Path:
+        '''The index shard with the lines of bench'''
+        shard = int(digest(bench)[8:12], 16) % Artifacts.indexShards
+        return self.indexDir / f'{shard:03}.idx'
+
+    @staticmethod
+    def _entries(indexPath: Path, bench: str | None = None
+                 ) -> dict[tuple[str, str], PackEntry]:
+        '''Live entries of an index shard, only those of bench if given'''
+        try: data = indexPath.read_bytes()
+        except OSError:
+            return {}
+
+        # A line is only read once it's complete
+        prefix = f'{bench}\t'.encode('utf-8') if bench is not None else b''
+        entries: dict[tuple[str, str], PackEntry] = {}
+        for line in data[:data.rfind(b'\n') + 1].splitlines():
+            if not line.startswith(prefix):
+                continue
+            lineBench, name, offset, length, codec, when = line.decode('utf-8').split('\t')
+            if codec == '!':
+                entries.pop((lineBench, name), None)
+            else:
+                entries[(lineBench, name)] = (int(offset), int(length),
+                                              codec, float(when))
+        return entries
+
+    def lookup(self, bench: str) -> dict[str, PackEntry]:
+        '''Live entries of bench, by name, as of now'''
+        return {name: entry for (_, name), entry
+                in Pack._entries(self.indexPath(bench), bench).items()}
+
+    def get(self, bench: str, name: str) -> bytes | None:
+        if (entry := self.lookup(bench).get(name)) is None:
+            return None
+        try: return readRecord(self.dataPath, *entry[:3])
+        except (OSError, zlib.error):
+            return None
+
+    def has(self, bench: str, name: str) -> bool:
+        return name in self.lookup(bench)
+
+    def put(self, bench: str, name: str, data: bytes | None) -> None:
+        '''Appends a record of (bench, name), a tombstone if data is None'''
+        codec = '!' if data is None else 'z' if Artifacts.compress else '-'
+        if codec == 'z':
+            data = zlib.compress(data or b'', 1)
+        self.indexDir.mkdir(parents=True, exist_ok=True)
+
+        fd = os.open(self.dataPath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        with open(fd, 'ab') as dataFile:
+            fcntl.flock(dataFile, fcntl.LOCK_EX)
+            offset = dataFile.seek(0, os.SEEK_END)
+            if data:
+                dataFile.write(data)
+                dataFile.flush()
+            with open(self.indexPath(bench), 'a', encoding='utf-8') as indexFile:
+                indexFile.write(f'{bench}\t{name}\t{offset}\t{len(data or b"")}'
+                                f'\t{codec}\t{time.time()}\n')
+
+    def items(self) -> Iterator[tuple[tuple[str, str], PackEntry]]:
+        '''Every live entry, one index shard in memory at a time'''
+        for indexPath in sorted(self.indexDir.glob('*.idx')):
+            yield from Pack._entries(indexPath).items()
+
+
+# --------------------------------------------------------------------------- #
+
+class Artifacts:
+    '''The artifacts of a single benchmark, see --storage'''
+
+    # ---------------------------- Static attrs. ---------------------------- #
+
+    # [--storage]
+    storage: Storage = 'dirs'
+
+    # [--artifacts-dir] Packs and work dirs of the pack backend
+    root: Path = Path('./output/artifacts')
+
+    # Packs the text artifacts are spread over
+    packs: int = 64
+
+    # Shards of the index of a pack, so that a lookup only reads the lines
+    # of a few benchmarks (see Pack.lookup)
+    indexShards: int = 256
+
+    # [--pack-compress] zlib the records of new artifacts
+    compress: bool = False
+
+    # [--scratch-dir] Temporary artifacts, None keeps them with the others
+    scratch: Path | None = None
+
+    # [--scratch-keep] Suffixes of the artifacts never put in scratch
+    keep: list[str] = ['.info', '.c']
+
+    # Packs opened by this process, by their .dat
+    _opened: dict[Path, Pack] = {}
+
+    # ---------------------------- Member attrs. ---------------------------- #
+
+    __slots__ = (
+        'bench',
+        'key',
+        'workDir',
+    )
+
+    def __init__(self, bench: Path):
+        self.bench: Path = bench
+        if Artifacts.storage == 'pack':
+            self.key: str = bench.resolve().as_posix()
+            h = digest(self.key)
+            self.workDir: Path = (Artifacts.root / 'work' / h[:2] / h[2:4]
+                                  / f'{bench.stem}-{h[:16]}')
+        else:
+            self.key = str(bench)
+            self.workDir = bench.with_suffix('.d')
+
+    @staticmethod
+    def pack(root: Path, n: int) -> Pack:
+        dataPath = root / f'pack-{n:03}.dat'
+        if dataPath not in Artifacts._opened:
+            Artifacts._opened[dataPath] = Pack(root, n)
+        return Artifacts._opened[dataPath]
+
+    def _pack(self) -> Pack:
+        return Artifacts.pack(Artifacts.root / 'packs',
+                              int(digest(self.key)[:8], 16) % Artifacts.packs)
+
+    def _packed(self, name: str) -> bool:
+        return Artifacts.storage == 'pack' and isText(name)
+
+    def _scratched(self, name: str) -> bool:
+        return (Artifacts.scratch is not None and not self._packed(name)
+                and name not in ('descriptor', Manifest.fileName)
+                and not name.startswith('constraint_')
+                and not name.endswith(tuple(Artifacts.keep)))
+
+    @property
+    def scratchDir(self) -> Path:
+        assert Artifacts.scratch
+        return Artifacts.scratch / f'{self.bench.stem}-{digest(self.key)[:16]}'
+
+    # ----------------------------------------------------------------------- #
+
+    def path(self, name: str) -> Path:
+        '''
+        Where name is (dirs, scratch) or would be (pack, text) in the work
+        dir or in the scratch dir
+        '''
+        if self._scratched(name):
+            return self.scratchDir / name
+        return self.workDir / name
+
+    def exists(self, name: str) -> bool:
+        if self._packed(name):
+            return self._pack().has(self.key, name)
+        return self.path(name).exists()
+
+    def read(self, name: str) -> str:
+        '''Text of name (OSError if missing)'''
+        if not self._packed(name):
+            with open(self.path(name), 'r', encoding='utf-8') as fhandle:
+                return fhandle.read()
+        if (data := self._pack().get(self.key, name)) is None:
+            raise FileNotFoundError(f'No such artifact: {self.path(name)}')
+        return data.decode('utf-8')
+
+    def write(self, name: str, text: str) -> None:
+        '''Writes name (OSError on failure)'''
+        if self._packed(name):
+            self._pack().put(self.key, name, text.encode('utf-8'))
+            return
+        with open(self.path(name), 'w', encoding='utf-8') as fhandle:
+            fhandle.write(text)
+
+    def digest(self, name: str) -> str:
+        '''sha256 of the contents of name, or '' if it can't be read'''
+        if not self._packed(name):
+            return fileDigest(self.path(name))
+        data = self._pack().get(self.key, name)
+        return hashlib.sha256(data).hexdigest() if data is not None else ''
+
+    @contextmanager
+    def files(self, *names: str) -> Iterator[list[Path]]:
+        '''
+        Paths of names for a tool to read, or to write and then store. The
+        packed ones are materialized in a temp dir, deleted afterwards.
+        '''
+        if not any(self._packed(name) for name in names):
+            yield [self.path(name) for name in names]
+            return
+
+        tmpDir = Path(tempfile.mkdtemp(prefix='kotai-', dir=Artifacts.scratch))
+        try:
+            paths = []
+            for name in names:
+                if not self._packed(name):
+                    paths.append(self.path(name))
+                    continue
+                paths.append(path := tmpDir / name)
+                if (data := self._pack().get(self.key, name)) is not None:
+                    path.write_bytes(data)
+            yield paths
+        finally:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+
+    def store(self, name: str, path: Path) -> None:
+        '''Packs the file a tool wrote at path (given by files) as name'''
+        if self._packed(name):
+            self._pack().put(self.key, name, path.read_bytes())
+
+    def remove(self) -> None:
+        '''Deletes every artifact (and the work dir) of the benchmark'''
+        if Artifacts.storage == 'pack':
+            pack = self._pack()
+            for name in pack.lookup(self.key):
+                pack.put(self.key, name, None)
+        shutil.rmtree(self.workDir, ignore_errors=True)
+        if Artifacts.scratch:
+            shutil.rmtree(self.scratchDir, ignore_errors=True)
+
+    def clearScratch(self, optLevels: Iterable[str]) -> None:
+        '''
+        Deletes the scratch files of optLevels (<bench>_<optLevel>[_.]*),
+        then the scratch dir if nothing else is left in it
+        '''
+        if not Artifacts.scratch:
+            return
+        prefixes = [f'{self.bench.stem}_{opt}' for opt in optLevels]
+        try: entries = list(os.scandir(self.scratchDir))
+        except OSError:
+            return
+        for entry in entries:
+            if any(entry.name == p or entry.name.startswith((f'{p}_', f'{p}.'))
+                   for p in prefixes):
+                try: os.unlink(entry.path)
+                except OSError as e:
+                    logging.warning(f'{e}: scratch [{entry.path}]')
+        try: self.scratchDir.rmdir()
+        except OSError:
+            pass
+
+
+def packedFiles(root: Path, suffix: str) -> Iterator[tuple[str, float, tuple]]:
+    '''
+    (path, time, record) of every live artifact of the packs under root whose
+    name ends with suffix, path as it would be with the dirs backend
+    (<bench>.d/<name>), record the readRecord args
+    '''
+    packDir = root / 'packs'
+    for dataPath in sorted(packDir.glob('pack-*.dat')):
+        pack = Artifacts.pack(packDir, int(dataPath.stem.partition('-')[2]))
+        for (bench, name), (offset, length, codec, when) in pack.items():
+            if name.endswith(suffix):
+                yield (str(Path(bench).with_suffix('.d') / name), when,
+                       (str(pack.dataPath), offset, length, codec))
+
+
+
+# =========================================================================== #
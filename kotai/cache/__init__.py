@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# =========================================================================== #
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+from functools import cache
+from pathlib import Path
+from shutil import which
+from typing import IO
+
+# --------------------------------------------------------------------------- #
+'''
+Content-addressed keys for the pipeline stages.
+
+Each stage hashes everything its output depends on (input file contents, the
+identity of the tool binaries it runs, the exact argv, ket, optLevel...) into
+a key. The key is recorded in <bench>.d/manifest once the stage succeeds, so
+the next run can skip the stage as long as the key still matches and the
+stage outputs are still on disk.
+'''
+# --------------------------------------------------------------------------- #
+
+
+@cache
+def toolId(exe: Path | str) -> str:
+    '''
+    Identity of a tool binary: resolved path, size and mtime. Replacing or
+    rebuilding the tool changes its id, which invalidates every key using it.
+    Memoized, since it's called once per stage per benchmark.
+    '''
+    if not (resolved := which(exe)) and not Path(exe).is_file():
+        return f'missing:{exe}'
+    path = Path(resolved or exe).resolve()
+    try: st = path.stat()
+    except OSError:
+        return f'missing:{exe}'
+    return f'{path}:{st.st_size}:{st.st_mtime_ns}'
+
+
+def tmpPath(path: Path) -> Path:
+    '''Hidden sibling of path, unique to the calling process and thread'''
+    return path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}')
+
+
+def fileDigest(path: Path) -> str:
+    '''sha256 of the contents of path, or '' if it can't be read'''
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as fhandle:
+            while chunk := fhandle.read(1 << 16):
+                h.update(chunk)
+    except OSError:
+        return ''
+    return h.hexdigest()
+
+
+def digest(*parts: str | bytes) -> str:
+    '''sha256 over parts, each one length-prefixed so ('ab','c') != ('a','bc')'''
+    h = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else part.encode('utf-8')
+        h.update(len(data).to_bytes(8, 'little'))
+        h.update(data)
+    return h.hexdigest()
+
+
+# --------------------------------------------------------------------------- #
+
+class Manifest:
+    '''
+    Stage keys of a single benchmark, stored as json in <bench>.d/manifest.
+
+    The file is read once when a worker picks the benchmark up. Updates are
+    read-modify-write under an exclusive flock, since tasks of the same
+    benchmark (e.g. one per optLevel) may record their stages concurrently.
+    '''
+
+    # ---------------------------- Static attrs. ---------------------------- #
+
+    fileName: str = 'manifest'
+
+    # [--no-cache] disables lookups, keys are still recorded
+    enabled: bool = True
+
+    # ---------------------------- Member attrs. ---------------------------- #
+
+    __slots__ = (
+        'path',
+        'keys',
+    )
+
+    def __init__(self, cFileMetaDir: Path):
+        self.path: Path           = cFileMetaDir / Manifest.fileName
+        self.keys: dict[str, str] = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fhandle:
+                fcntl.flock(fhandle, fcntl.LOCK_SH)
+                self.keys = Manifest._load(fhandle)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _load(fhandle: IO[str]) -> dict[str, str]:
+        try: keys = json.load(fhandle)
+        except ValueError:
+            return {}
+        return keys if isinstance(keys, dict) else {}
+
+    def hit(self, stage: str, key: str, *outputs: Path) -> bool:
+        '''True if stage was recorded with key and all its outputs exist'''
+        return (Manifest.enabled
+                and self.keys.get(stage) == key
+                and all(o.exists() for o in outputs))
+
+    def record(self, stage: str, key: str) -> None:
+        self._update(stage, key)
+
+    def drop(self, stage: str) -> None:
+        if stage in self.keys:
+            self._update(stage, None)
+
+    def _update(self, stage: str, key: str | None) -> None:
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            with open(fd, 'r+', encoding='utf-8') as fhandle:
+                fcntl.flock(fhandle, fcntl.LOCK_EX)
+                keys = Manifest._load(fhandle)
+                if key is None: keys.pop(stage, None)
+                else:           keys[stage] = key
+                fhandle.seek(0)
+                fhandle.truncate()
+                json.dump(keys, fhandle, indent=1, sort_keys=True)
+        except OSError:
+            return
+        self.keys = keys
+
+
+# --------------------------------------------------------------------------- #
+
+class ContentCache:
+    '''
+    Content-addressed file store, shared between benchmarks and runs, laid
+    out as <root>/<key[:2]>/<key>. Entries are hard-linked (or copied, across
+    filesystems) in and out of the store.
+
+    A hit refreshes the entry's mtime, so evict() can drop the least recently
+    used entries once the store outgrows maxBytes. Entries still linked from
+    elsewhere (st_nlink > 1) take no space of their own, so they neither
+    count towards maxBytes nor get evicted. Files placed by get() are shared
+    with the store: they must be replaced, never written in place.
+    '''
+
+    # ---------------------------- Member attrs. ---------------------------- #
+
+    __slots__ = (
+        'root',
+        'maxBytes',
+    )
+
+    def __init__(self, root: Path, maxBytes: int):
+        self.root: Path     = root
+        self.maxBytes: int  = maxBytes
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def get(self, key: str, dst: Path) -> bool:
+        '''Places the entry for key at dst, returns False on a miss'''
+        entry = self._path(key)
+        if not entry.exists():
+            return False
+        try:
+            _linkOrCopy(entry, dst)
+            os.utime(entry)
+        except OSError:
+            return False
+        return True
+
+    def put(self, key: str, src: Path) -> None:
+        entry = self._path(key)
+        tmpEntry = tmpPath(entry)
+        try:
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            _linkOrCopy(src, tmpEntry)
+            os.replace(tmpEntry, entry)
+        except OSError:
+            tmpEntry.unlink(missing_ok=True)
+
+    def evict(self) -> tuple[int, int]:
+        '''
+        Deletes the least recently used entries until the store fits in
+        maxBytes. Returns the number of entries deleted and the bytes freed.
+        '''
+        entries: list[tuple[float, int, Path]] = []
+        for sub in (os.scandir(self.root) if self.root.is_dir() else []):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                try: st = entry.stat()
+                except OSError:
+                    continue
+                # Deleting it wouldn't free its blocks
+                if st.st_nlink > 1:
+                    continue
+                entries.append((st.st_mtime, st.st_size, Path(entry.path)))
+
+        total = sum(size for _, size, _ in entries)
+        nEvicted = bytesEvicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try: path.unlink()
+            except OSError:
+                continue
+            total -= size
+            nEvicted += 1
+            bytesEvicted += size
+
+        return nEvicted, bytesEvicted
+
+
+def _linkOrCopy(src: Path, dst: Path) -> None:
+    dst.unlink(missing_ok=True)
+    try: os.link(src, dst)
+    except OSError:
+        if not src.exists():
+            raise
+        shutil.copy2(src, dst)
+
+
+
+# =========================================================================== #
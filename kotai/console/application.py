@@ -2,34 +2,44 @@
 # =========================================================================== #
 
 import argparse
+import functools
+import itertools
 import logging
+import os
+import shutil
+import sys
+import time
+from contextvars import ContextVar
 from pathlib import Path
-from multiprocessing import Pool
-from typing import Any, Counter
+from typing import Any, Callable, Coroutine, Counter, Iterable, Iterator, TypeVar
 
+from kotai.artifacts import Artifacts, Storages
+from kotai.cache import ContentCache, Manifest, digest, fileDigest, toolId
 from kotai.constraints.genkonstrain import Konstrain
+from kotai.executor import AsyncEngine, Executors, ExecutorKind, asyncConcurrency, newPool
+from kotai.generator import Generator, GeneratorModes, generatorDigest
 from kotai.plugin.PrintDescriptors import PrintDescriptors
 from kotai.plugin.Jotai import Jotai
-from kotai.plugin.Clang import Clang
-from kotai.plugin.CFGgrind import CFGgrind
-from kotai.templates.benchmark import GenBenchTemplatePrefix, GenBenchTemplateMainBegin, GenBenchTemplateMainEnd, genSwitch, GenBenchSwitchBegin, GenBenchSwitchEnd
-from kotai.kotypes import BenchInfo, Failure, ExitCode, LogThen, OptLevel, OptLevels, SysExitCode, KonstrainExecType, KonstrainExecTypes, setLog, success, failure, valid
+from kotai.plugin.Clang import Clang, ObjKeyKinds
+from kotai.plugin.CFGgrind import CFGgrind, UBScreens
+from kotai.templates.benchmark import GenBenchTemplatePrefix, GenBenchTemplateMainBegin, GenBenchTemplateMainEnd, genSwitch, GenBenchSwitchBegin, GenBenchSwitchEnd, switchCases, templateDigest
+from kotai.kotypes import BenchInfo, CmdResult, Failure, ExitCode, LogThen, OptLevel, OptLevels, SysExitCode, KonstrainExecType, KonstrainExecTypes, Limits, ResultKind, drainSamples, pendingSamples, setBenchTable, setLimits, setLog, setTimeoutRetry, success, failure, sumUsage, valid
+from kotai.results import ResultStore, drainStages, recordStage
+from kotai.stats import ingest
+from kotai.stats.report import writeReport
+from kotai.metrics import Metrics
+from kotai.schedule import Scheduler, Schedules
+from kotai.timeouts import RuntimeStats
 from kotai.logconf import logFmt, sep
 
 
 # --------------------------------------------------------------------------- #
 '''
 TODOs:
-    - Add checks to avoid re-running intermediate steps (check if files exist)
-
     - Modify Jotai.cpp to generate the new switch-based main from the prototype
 
     - Find a way to prepend the orig. function with __attribute__((noinline))
 
-    - Find out which CFGgrind call creates "vgcore.XXXXXX" (temp) files and
-      remove these files when they're no longer needed (or create them
-      somewhere else)
-
     - Change wrappers so they don't need to be instantiated inside the worker
       functions. Maybe remove individual file attributes and make their methods
       static, receiving these attrs as args?
@@ -47,11 +57,19 @@ class Application:
         self.clean: bool
         self.inputdir: list[str]
         self.nproc: int
+        self.workers: int
+        self.executor: ExecutorKind
         self.chunksize: int
+        self.window: int
         self.optLevels: list[OptLevel] = []
         self.ketList: list[KonstrainExecType] = []
         self.logfile: str
         self.ubstats: str
+        self.cacheStats: Counter[tuple[str, bool]] = Counter()
+        self.runtimes: RuntimeStats
+        self.store: ResultStore
+        self.metrics: Metrics
+        self.scheduler: Scheduler
 
         self.args = argparse.Namespace()
         cli = argparse.ArgumentParser(
@@ -61,13 +79,48 @@ class Application:
 
         cli.add_argument('-c', '--clean',     action='store_true', default=False)
         cli.add_argument('--no-log',          action='store_true', default=False)
+        cli.add_argument('--no-cache',        action='store_true', default=False)
+        cli.add_argument('--stream',          action='store_true', default=False)
+        cli.add_argument('--window',          type=int, default=4096)
+        cli.add_argument('--konstrain-servers', type=int, default=0)
+        cli.add_argument('--descriptor-batch',  type=int, default=1)
+        cli.add_argument('--jotai-batch',       action='store_true', default=False)
+        cli.add_argument('--generator',         type=str, choices=GeneratorModes, default='jotai')
         cli.add_argument('-i', '--inputdir',  type=str, nargs='+', required=True)
         cli.add_argument('-j', '--nproc',     type=int, default=8)
+        cli.add_argument('--executor',        type=str, choices=Executors, default='process')
+        cli.add_argument('--async-concurrency', type=int, default=AsyncEngine.concurrency)
         cli.add_argument('-J', '--chunksize', type=int, default=-1)
-        cli.add_argument('-K',         type=str, nargs='+', choices=KonstrainExecTypes, default='big-arr')
-        cli.add_argument('--optLevel', type=str, nargs='+', choices=OptLevels,          default='O0')
+        cli.add_argument('--schedule',  type=str, choices=Schedules, default='cost')
+        cli.add_argument('-K',         type=str, nargs='+', choices=[*KonstrainExecTypes, 'all'], default='big-arr')
+        cli.add_argument('--optLevel', type=str, nargs='+', choices=[*OptLevels, 'all'],          default='O0')
+        cli.add_argument('--storage',      type=str, choices=Storages, default='dirs')
+        cli.add_argument('--artifacts-dir', default='./output/artifacts')
+        cli.add_argument('--pack-compress', action='store_true', default=False)
+        cli.add_argument('--scratch-dir',  default=None)
+        cli.add_argument('--scratch-keep', type=str, nargs='+', default=['.info', '.c'])
+        cli.add_argument('--objcache',     default='./output/objcache')
+        cli.add_argument('--objcache-mb',  type=int, default=4096)
+        cli.add_argument('--objcache-key', type=str, choices=ObjKeyKinds, default='source')
+        cli.add_argument('--konstraincache',    default='./output/konstraincache')
+        cli.add_argument('--konstraincache-mb', type=int, default=256)
+        cli.add_argument('--pch',          action='store_true', default=False)
+        cli.add_argument('--pchdir',       default='./output/pch')
+        cli.add_argument('--adaptive-timeouts', action='store_true', default=False)
+        cli.add_argument('--timeout-retry', type=float, default=0.0)
+        cli.add_argument('--limit',        type=_limit, nargs='+', default=[])
+        cli.add_argument('--runtimes',     default='./output/runtimes.json')
+        cli.add_argument('--results',      default='./output/results.db')
+        cli.add_argument('--resume',       action='store_true', default=False)
+        cli.add_argument('--rerun',        type=str, nargs='+', choices=['fail', 'timeout', 'limit'], default=[])
+        cli.add_argument('--shard',        type=_shard, default=None)
+        cli.add_argument('--ub-screen',    type=str, choices=UBScreens, default='memcheck')
+        cli.add_argument('--no-memcheck-fallback', action='store_true', default=False)
         cli.add_argument('-L', '--logfile', default='./output/jotai.log')
         cli.add_argument('-u', '--ubstats', default='./output/ubstats.txt')
+        cli.add_argument('--dataset',      default='./output/cfginfo')
+        cli.add_argument('--progress',     type=float, default=10.0)
+        cli.add_argument('--metrics',      default='./output/metrics.prom')
         cli.parse_args(namespace=self.args)
 
         # [-i]
@@ -78,9 +131,20 @@ class Application:
         self.nproc      = (self.args.nproc if self.args.nproc > 1
                            else 1)
 
-        # [-J]
+        # [--executor]
+        self.executor   = self.args.executor
+
+        # [--async-concurrency] With --executor async, the commands in flight
+        # of the pool, instead of -j
+        self.workers    = (asyncConcurrency(self.args.async_concurrency)
+                           if self.executor == 'async' else self.nproc)
+
+        # [-J] Fixed chunksize (0: adapted per stage, see kotai.schedule)
         self.chunksize  = (self.args.chunksize if self.args.chunksize > 1
-                           else 64)
+                           else 0)
+
+        # [--window] Benchmarks discovered, and in flight, at a time
+        self.window     = max(self.args.window, 1)
 
         # [-K]
         if 'all' in self.args.K:
@@ -98,6 +162,82 @@ class Application:
 
         self.ubstats = self.args.ubstats
 
+        # [--shard] Only the benchmarks of shard i out of N
+        self.shard: tuple[int, int] | None = self.args.shard
+
+        # [--no-cache] Re-runs every stage, but still records the new keys
+        Manifest.enabled = not self.args.no_cache
+
+        # [--konstrain-servers] Long-lived Konstrain JVMs per worker process
+        Konstrain.servers = max(self.args.konstrain_servers, 0)
+
+        # [--descriptor-batch] Source files per PrintDescriptors invocation
+        PrintDescriptors.batchSize = max(self.args.descriptor_batch, 1)
+
+        # [--jotai-batch] One Jotai call per benchmark, for all of its kets
+        Jotai.batch = self.args.jotai_batch
+
+        # [--generator] Jotai, or Jotai checked against the native generator
+        Generator.mode = self.args.generator
+
+        # [--storage] <bench>.d/ dirs, or packs and hashed work dirs
+        Artifacts.storage  = self.args.storage
+        Artifacts.root     = Path(self.args.artifacts_dir)
+        Artifacts.compress = self.args.pack_compress
+
+        # [--scratch-dir] Binaries, .map and .cfg files on e.g. /dev/shm,
+        # only the suffixes of --scratch-keep go to persistent storage
+        Artifacts.scratch  = Path(self.args.scratch_dir) if self.args.scratch_dir else None
+        Artifacts.keep     = self.args.scratch_keep
+        if Artifacts.scratch:
+            Artifacts.scratch.mkdir(parents=True, exist_ok=True)
+
+        # [--objcache] Binaries shared across benchmarks/runs (0 MB disables)
+        Clang.cache = (ContentCache(Path(self.args.objcache),
+                                    self.args.objcache_mb << 20)
+                       if self.args.objcache_mb > 0 else None)
+        Clang.objKeyKind = self.args.objcache_key
+
+        # [--konstraincache] Constraints shared by identical descriptors
+        # across benchmarks/runs (0 MB disables)
+        Konstrain.cache = (ContentCache(Path(self.args.konstraincache),
+                                        self.args.konstraincache_mb << 20)
+                           if self.args.konstraincache_mb > 0 else None)
+
+        # [--runtimes] Tool runtimes of previous runs, updated by this one
+        self.runtimes = RuntimeStats(Path(self.args.runtimes))
+
+        # [--results] Outcome of every stage, written by this process only
+        self.store = ResultStore(Path(self.args.results))
+
+        # [--ub-screen] Sanitizer builds instead of memcheck, where conclusive
+        CFGgrind.ubScreen = self.args.ub_screen
+        CFGgrind.memcheckFallback = not self.args.no_memcheck_fallback
+
+        # [--progress, --metrics] Live counters per stage, '' disables --metrics
+        Metrics.interval = max(self.args.progress, 0.0)
+        Metrics.workers  = self.workers
+        self.metrics = Metrics(Path(self.args.metrics) if self.args.metrics else None)
+
+        # [--schedule, -J] Dispatch order and chunksize of each stage, from
+        # the stage latencies of previous runs
+        Scheduler.kind = self.args.schedule
+        self.scheduler = Scheduler(self.chunksize, self.workers, self.store.latencies())
+
+        # [--timeout-retry] Timed out commands get one more, longer, try
+        setTimeoutRetry(max(self.args.timeout_retry, 0.0))
+
+        # [--limit] Resource limits of every tool, then of specific ones
+        default = Limits()
+        for tool, field, value in self.args.limit:
+            if not tool:
+                default = default._replace(**{field: value})
+        perTool: dict[str, Limits] = {}
+        for tool, field, value in self.args.limit:
+            if tool:
+                perTool[tool] = perTool.get(tool, default)._replace(**{field: value})
+        setLimits(default, perTool)
+
         if self.args.no_log:
             # [--no-log] Disable logging
             logger = logging.getLogger()
@@ -115,15 +255,42 @@ class Application:
             )
             logging.debug(f'{self.args=}')
 
+        # [--adaptive-timeouts] Tool timeouts learned from --runtimes
+        if self.args.adaptive_timeouts:
+            _adaptTimeouts(self.runtimes)
+
 
     def start(self, ) -> SysExitCode:
-        return _start(self)  # Defined at the end of this file
+        try:
+            return _start(self)  # Defined at the end of this file
+        finally:
+            _evictCaches()
+            _reportCache(self.cacheStats)
+            for line in [*self.metrics.idleSummary(not self.args.stream),
+                         *self.metrics.usageSummary()]:
+                print(line)
+                logging.info(line)
+            self.metrics.tick(force=True)
+            self.runtimes.save()
+            self.store.close()
 
 # --------------------------------------------------------------------------- #
 
 
 # Deletes the files generated by this program on a previous run
-def _cleanFn(pArgs: BenchInfo) -> ExitCode:
+async def _cleanFn(pArgs: BenchInfo) -> ExitCode:
+    # [--storage pack] Tombstones for the packed artifacts, then the work dir
+    if Artifacts.storage == 'pack':
+        artifacts = Artifacts(pArgs.cFilePath)
+        try: artifacts.remove()
+        except OSError as e:
+            return LogThen.Err(f'{e}: {artifacts.workDir}')
+        return LogThen.Ok(f'Deleted {artifacts.workDir}')
+
+    # [--scratch-dir] Whatever a killed run left there
+    if Artifacts.scratch:
+        shutil.rmtree(Artifacts(pArgs.cFilePath).scratchDir, ignore_errors=True)
+
     cFileMetaDir = pArgs.cFilePath.with_suffix('.d')
     genFiles     = cFileMetaDir.glob('*')
 
@@ -144,6 +311,157 @@ def _cleanFn(pArgs: BenchInfo) -> ExitCode:
     return LogThen.Ok(f'Deleted {cFileMetaDir}')
 
 
+def _shard(arg: str) -> tuple[int, int]:
+    '''argparse type of --shard: i/N, with 0 <= i < N'''
+    try:
+        i, n = (int(x) for x in arg.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected i/N, got {arg!r}')
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError(f'expected 0 <= i < N, got {arg!r}')
+    return i, n
+
+
+# [--limit] Limits fields, with the multiplier of their values
+_limitFields: dict[str, tuple[str, int]] = {
+    'core':  ('core',         1 << 20),  # MiB
+    'as':    ('addressSpace', 1 << 20),  # MiB
+    'cpu':   ('cpu',          1),        # seconds
+    'fsize': ('fileSize',     1 << 20),  # MiB
+}
+
+def _limit(arg: str) -> tuple[str, str, int | None]:
+    '''
+    argparse type of --limit: [tool:]kind=value, kind one of _limitFields
+    and value a number or 'none' (unlimited), e.g. as=4096 cfggrind:as=none
+    '''
+    tool, _, limit = arg.rpartition(':')
+    kind, _, value = limit.partition('=')
+    if kind not in _limitFields:
+        raise argparse.ArgumentTypeError(f'expected [tool:]{"|".join(_limitFields)}'
+                                         f'=value, got {arg!r}')
+    field, unit = _limitFields[kind]
+    if value == 'none':
+        return tool, field, None
+    try: n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected a number or none, got {arg!r}')
+    if n < 0:
+        raise argparse.ArgumentTypeError(f'expected a number >= 0, got {arg!r}')
+    return tool, field, n * unit
+
+
+def _inShard(relPath: Path, shard: tuple[int, int]) -> bool:
+    '''
+    [--shard i/N] Whether a benchmark belongs to shard i, from a hash of its
+    path relative to its -i dir: the same on every machine and every rerun,
+    and balanced across shards for any number of benchmarks
+    '''
+    i, n = shard
+    return int(digest(relPath.as_posix())[:16], 16) % n == i
+
+
+def _adaptTimeouts(runtimes: RuntimeStats) -> None:
+    '''Sets the timeout of each tool wrapper from its recorded runtimes'''
+    PrintDescriptors.timeout = runtimes.timeout('printdescriptors', PrintDescriptors.timeout)
+    Konstrain.timeout        = runtimes.timeout('konstrain', Konstrain.timeout)
+    Jotai.timeout            = runtimes.timeout('jotai', Jotai.timeout)
+    Clang.timeout            = runtimes.timeout('clang', Clang.timeout)
+    CFGgrind.timeouts        = {tool: runtimes.timeout(tool, CFGgrind.timeout)
+                                for tool in ('cfggrind_asmmap', 'memcheck', 'sanitizer',
+                                             'cfggrind', 'cfggrind_info')}
+
+    logging.info(f'Adaptive timeouts: {PrintDescriptors.timeout=} '
+                 f'{Konstrain.timeout=} {Jotai.timeout=} {Clang.timeout=} '
+                 f'{CFGgrind.timeouts=}')
+
+
+_Worker = TypeVar('_Worker', bound=Callable[..., Any])
+_R = TypeVar('_R')
+
+# Nesting depth of _collect'ed calls in the current thread (or task, see
+# kotai.executor)
+_collectDepth: ContextVar[int] = ContextVar('collectDepth', default=0)
+
+def _collect(fn: _Worker) -> _Worker:
+    '''
+    Worker function decorator: the CmdSamples recorded by runproc and the
+    StageRecords recorded by the stages while fn runs are attached to the
+    first BenchInfo of its result, so they travel back to the parent with it
+    (see _tally). When workers call each other, the outermost one takes them
+    all.
+    '''
+    @functools.wraps(fn)
+    async def worker(*args: Any) -> Any:
+        depth = _collectDepth.get()
+        if not depth:
+            drainSamples()
+            drainStages()
+        _collectDepth.set(depth + 1)
+        try:
+            res = await fn(*args)
+        finally:
+            _collectDepth.set(depth)
+        if depth:
+            return res
+
+        first = res
+        while isinstance(first, (list, tuple)) and first:
+            first = first[0]
+        if isinstance(first, BenchInfo):
+            first.samples += drainSamples()
+            first.stages  += drainStages()
+        return res
+
+    return worker  # type: ignore[return-value]
+
+
+def _stage(stage: str, *outputs: str, perOptLevel: bool = False,
+           perKet: bool = False) -> Callable[[_Worker], _Worker]:
+    '''
+    Worker function decorator for the stages that run once per benchmark,
+    once per (benchmark, optLevel) after _fanOut, or once per (benchmark,
+    optLevel, ket) after _fanOutCases: records the outcome of fn in the
+    results store, with <bench>.d/<bench><output> for each one of outputs
+    ({opt} and {ket} replaced by the optLevel and ket, <bench>.d/ the work
+    dir of kotai.artifacts) as its artifacts.
+    '''
+    def decorator(fn: _Worker) -> _Worker:
+        @functools.wraps(fn)
+        async def worker(pArgs: BenchInfo) -> BenchInfo:
+            start    = time.monotonic()
+            nSamples = len(pendingSamples())
+            optLevel = pArgs.optLevelList[0] if perOptLevel else ''
+            ket      = pArgs.ketList[0] if perKet else ''
+
+            res = await fn(pArgs)
+
+            cFilePath = res.cFilePath
+            artifacts = Artifacts(cFilePath)
+            if valid(res):
+                kind = ResultKind.OK
+            elif any(s.kind == ResultKind.TIMEOUT
+                     for s in pendingSamples()[nSamples:]):
+                kind = ResultKind.TIMEOUT
+            elif any(s.kind == ResultKind.LIMIT
+                     for s in pendingSamples()[nSamples:]):
+                kind = ResultKind.LIMIT
+            else:
+                kind = ResultKind.FAIL
+
+            recordStage(cFilePath, stage, kind, time.monotonic() - start,
+                        *[artifacts.path(cFilePath.stem + o.format(opt=optLevel, ket=ket))
+                          for o in outputs if kind == ResultKind.OK],
+                        ket=ket, optLevel=optLevel,
+                        cached=valid(res) and any(res.cacheHits.values()),
+                        usage=sumUsage(s.usage for s in pendingSamples()[nSamples:]))
+            return res
+
+        return worker  # type: ignore[return-value]
+
+    return decorator
+
+
 def getFnName(descriptor: str) -> str | Failure:
     '''
     Called by _genDescriptor to retrieve the fn name found in the benchmark.
@@ -164,11 +482,89 @@ def getFnName(descriptor: str) -> str | Failure:
 
 
 # Worker function mapped in a multiprocessing.Pool to run PrintDescriptors
-def _genDescriptor(pArgs: BenchInfo) -> BenchInfo:
+@_collect
+async def _genDescriptor(pArgs: BenchInfo) -> BenchInfo:
+    return (await _genDescriptorBatch([pArgs]))[0]
+
+
+# Worker function mapped in a multiprocessing.Pool by --descriptor-batch
+@_collect
+async def _genDescriptorBatch(batch: list[BenchInfo]) -> list[BenchInfo]:
+    '''
+    Runs PrintDescriptors once for every benchmark in batch that isn't cached
+    (see PrintDescriptors.runbatch), then handles each benchmark on its own,
+    exactly as if the plugin had been run on it alone.
+    '''
+    results: list[BenchInfo | None] = []
+    pending: list[tuple[int, BenchInfo, Manifest, str]] = []
+
+    for pArgs in batch:
+        start        = time.monotonic()
+        artifacts    = Artifacts(pArgs.cFilePath)
+        manifest     = Manifest(artifacts.workDir)
+        key = digest(fileDigest(pArgs.cFilePath),
+                     *[toolId(exe) for exe in PrintDescriptors.exe.values()],
+                     *PrintDescriptors(pArgs.cFilePath).cmdline())
+
+        if (res := _cachedDescriptor(pArgs, manifest, key)) is None:
+            pending.append((len(results), pArgs, manifest, key))
+        else:
+            recordStage(pArgs.cFilePath, 'descriptor', ResultKind.OK,
+                        time.monotonic() - start, artifacts.path('descriptor'),
+                        cached=True)
+        results.append(res)
+
+    start = time.monotonic()
+    cmdResults = await PrintDescriptors.runbatch([p.cFilePath for _, p, _, _ in pending])
+    seconds = (time.monotonic() - start) / max(len(pending), 1)
+    for (idx, pArgs, manifest, key), cmdResult in zip(pending, cmdResults):
+        results[idx] = res = _saveDescriptor(pArgs, manifest, key, cmdResult)
+        if valid(res):
+            recordStage(res.cFilePath, 'descriptor', ResultKind.OK, seconds,
+                        Artifacts(res.cFilePath).path('descriptor'),
+                        usage=cmdResult.usage)
+        else:
+            recordStage(res.cFilePath, 'descriptor',
+                        cmdResult.kind if cmdResult.kind != ResultKind.OK else ResultKind.FAIL,
+                        seconds, usage=cmdResult.usage)
+
+    return [r for r in results if r is not None]
+
+
+def _cachedDescriptor(pArgs: BenchInfo, manifest: Manifest,
+                      key: str) -> BenchInfo | None:
+    '''Skips the plugin if the source, the plugin and its flags are unchanged'''
+    artifacts = Artifacts(pArgs.cFilePath)
+
+    if not manifest.hit('descriptor', key) or not artifacts.exists('descriptor'):
+        return None
+
+    try: msg = artifacts.read('descriptor')
+    except Exception as e:
+        logging.warning(f'{e}: PrintDescriptors [{artifacts.path("descriptor")}]')
+        return None
+
+    if (fnName := getFnName(msg)) == failure:
+        return None
+
+    return BenchInfo(pArgs.cFilePath,
+                     fnName=fnName,
+                     ketList=pArgs.ketList,
+                     optLevelList=pArgs.optLevelList,
+                     exitCodes={'descriptor': success},
+                     cacheHits={'descriptor': True})
 
-    cFilePath = pArgs.cFilePath
 
-    msg, err = PrintDescriptors(cFilePath).runcmd()
+def _saveDescriptor(pArgs: BenchInfo, manifest: Manifest, key: str,
+                    cmdResult: CmdResult) -> BenchInfo:
+    '''Checks the output of PrintDescriptors and writes <bench>.d/descriptor'''
+    cFilePath      = pArgs.cFilePath
+    artifacts      = Artifacts(cFilePath)
+    cFileMetaDir   = artifacts.workDir
+    descriptorPath = artifacts.path('descriptor')
+
+    pArgs.cacheHits = {'descriptor': False}
+    msg, err, *_ = cmdResult
 
     # If the PrintDescriptors plugin fails, return before creating the file
     if err == failure:
@@ -179,52 +575,102 @@ def _genDescriptor(pArgs: BenchInfo) -> BenchInfo:
         return pArgs.Err('descriptor', f'{fnName=}')
 
     # Creates the output dir for the current cFile
-    cFileMetaDir = cFilePath.with_suffix('.d')
     try: cFileMetaDir.mkdir(parents=True, exist_ok=True)
     except Exception as e:
         return pArgs.Err('descriptor', f'{e}: PrintDescriptors [{cFileMetaDir}]')
 
     # Creates the descriptor file
-    descriptorPath = cFileMetaDir / 'descriptor'
-    try:
-        with open(descriptorPath, 'w', encoding='utf-8') as descFile:
-            descFile.write(msg)
+    try: artifacts.write('descriptor', msg)
     except Exception as e:
         return pArgs.Err('descriptor', f'{e}: PrintDescriptors [{descriptorPath}]')
 
+    manifest.record('descriptor', key)
+
     return BenchInfo(pArgs.cFilePath,
                      fnName=fnName,
                      ketList=pArgs.ketList,
                      optLevelList=pArgs.optLevelList,
                      exitCodes={'descriptor': success},
-                     descriptor = msg)
+                     cacheHits=pArgs.cacheHits)
 
 
 # Worker function mapped in a multiprocessing.Pool to run Konstrain
-def _runKonstrain(pArgs: BenchInfo) -> BenchInfo:
+@_collect
+async def _runKonstrain(pArgs: BenchInfo) -> BenchInfo:
     cFilePath              = pArgs.cFilePath
     ketList: list[KonstrainExecType] = pArgs.ketList
-    cFileMetaDir           = cFilePath.with_suffix('.d')
-    descriptorPath         = cFileMetaDir / 'descriptor'
+    artifacts              = Artifacts(cFilePath)
+    manifest               = Manifest(artifacts.workDir)
+    descriptorDigest       = artifacts.digest('descriptor')
 
     exitCodes: dict[Any, ExitCode] = {}
+    pArgs.cacheHits = {}
 
     for ket in ketList:
 
-        msg, err = Konstrain(descriptorPath, ket, cFileMetaDir / f'constraint_{ket}').runcmd()
+        start           = time.monotonic()
+        constraintName  = f'constraint_{ket}'
+        constraintsPath = artifacts.path(constraintName)
+        stage = f'konstrain_{ket}'
+        key = digest(descriptorDigest,
+                     toolId('java'),
+                     *[toolId(exe) for exe in Konstrain.exe.values()],
+                     *Konstrain(artifacts.path('descriptor'), ket, constraintsPath).cmdline())
+
+        hit = pArgs.cacheHits[stage] = (manifest.hit(stage, key)
+                                        and artifacts.exists(constraintName))
+        if hit:
+            exitCodes[ket] = success
+            recordStage(cFilePath, 'konstrain', ResultKind.OK,
+                        time.monotonic() - start, constraintsPath,
+                        ket=ket, cached=True)
+            continue
+
+        # [--konstraincache] The constraints of another benchmark (or run)
+        # with the same descriptor text, if any
+        memoKey = (Konstrain.memoKey(descriptorDigest, ket)
+                   if Konstrain.cache and descriptorDigest else None)
+        memoHit = False
+
+        with artifacts.files('descriptor', constraintName) as (descriptorPath, outPath):
+            # Never written in place: it may be a hard link to a cache entry
+            outPath.unlink(missing_ok=True)
+            if memoKey and Konstrain.cache:
+                memoHit = Konstrain.cache.get(memoKey, outPath)
+                pArgs.cacheHits[f'konstraincache_{ket}'] = memoHit
+
+            cmdResult = (CmdResult('', success) if memoHit
+                         else await Konstrain(descriptorPath, ket, outPath).runcmd())
+            msg, err, *_ = cmdResult
+            if err != failure:
+                try: artifacts.store(constraintName, outPath)
+                except OSError as e:
+                    cmdResult, err = cmdResult._replace(err=failure), failure
+                    msg = f'{e}'
+            if err != failure and memoKey and Konstrain.cache and not memoHit:
+                Konstrain.cache.put(memoKey, outPath)
 
         if err == failure:
             exitCodes[ket] = failure
+            manifest.drop(stage)
             logging.error(f'Konstrain {ket} [{cFilePath}]:"{msg=}"')
+            recordStage(cFilePath, 'konstrain', cmdResult.kind,
+                        time.monotonic() - start, ket=ket, usage=cmdResult.usage)
         else:
             exitCodes[ket] = success
+            manifest.record(stage, key)
+            recordStage(cFilePath, 'konstrain', ResultKind.OK,
+                        time.monotonic() - start, constraintsPath, ket=ket,
+                        cached=memoHit, usage=cmdResult.usage)
 
     pArgs.setExitCodes(exitCodes)
     return pArgs
 
 
 # Worker function mapped in a multiprocessing.Pool to run Jotai
-def _runJotai(pArgs: BenchInfo) -> BenchInfo:
+@_collect
+@_stage('jotai', '.c')
+async def _runJotai(pArgs: BenchInfo) -> BenchInfo:
     '''
     Creates genBenchFile: a main() entry point to the original benchmark.
 
@@ -249,21 +695,36 @@ def _runJotai(pArgs: BenchInfo) -> BenchInfo:
     except Exception as e:
         return pArgs.Err('Jotai', f'{e}')
 
-    cFileMetaDir    = cFilePath.with_suffix('.d')
-    descriptorPath  = cFileMetaDir / 'descriptor'
-    # decl vars
-    #parse(self.descriptor())
-
+    artifacts       = Artifacts(cFilePath)
+    genBenchName    = f'{cFilePath.stem}.c'
+    manifest        = Manifest(artifacts.workDir)
+
+    # The genBench depends on the benchmark, its descriptor, the constraints
+    # of every ket that Konstrain didn't fail on, Jotai (and the native
+    # generator it's checked against, see --generator) and the templates
+    kets = [ket for ket in pArgs.ketList
+            if not (ket in pArgs.exitCodes and pArgs.exitCodes[ket] == failure)]
+    key = digest(genBuffer,
+                 artifacts.digest('descriptor'),
+                 *[f'{ket}:{artifacts.digest(f"constraint_{ket}")}'
+                   for ket in kets],
+                 *[toolId(exe) for exe in Jotai.exe.values()],
+                 *([Generator.mode, generatorDigest] if Generator.mode != 'jotai' else []),
+                 templateDigest)
+
+    hit = manifest.hit('jotai', key) and artifacts.exists(genBenchName)
+    pArgs.cacheHits = {'jotai': hit}
+    if hit:
+        return pArgs
+
+    # Jotai's results, one per ket (in a single call with --jotai-batch,
+    # checked against the native generator with --generator diff)
+    names = ['descriptor', *[f'constraint_{ket}' for ket in kets]]
+    with artifacts.files(*names) as (descriptorPath, *constraintsPaths):
+        jotaiResults = await Generator.runbatch(cFilePath, kets, descriptorPath, constraintsPaths)
 
     genSwitchList: list[tuple[KonstrainExecType, str, ExitCode]] = []
-    for ket in pArgs.ketList:
-        if ket in pArgs.exitCodes and pArgs.exitCodes[ket] == failure:
-            continue
-
-        constraintsPath = cFileMetaDir / f'constraint_{ket}'
-
-        # Jotai's result
-        jotaiSwitchCase, err = Jotai(constraintsPath, descriptorPath).runcmd()
+    for ket, (jotaiSwitchCase, err, *_) in zip(kets, jotaiResults):
 
         # If error: returns before creating the genbench file
         if err == failure:
@@ -273,129 +734,670 @@ def _runJotai(pArgs: BenchInfo) -> BenchInfo:
         genSwitchList += [(ket, jotaiSwitchCase, err)]
 
     if not genSwitchList:
+        manifest.drop('jotai')
         return pArgs.Err('Jotai', 'Jotai: Complete failure')
-    # Creates the genBench file and writes the buffer to it
-    genBenchPath = cFileMetaDir / f'{cFilePath.stem}.c'
-    try:
-        with open(genBenchPath, 'w', encoding='utf-8') as genBenchFile:
-            # buffer += mainFn begin
-            genBuffer += GenBenchTemplateMainBegin
-            genBuffer += GenBenchSwitchBegin
-            for idx, sw in enumerate(genSwitchList):
-                ket, out, err = sw
-                genBuffer += genSwitch(idx, out, ket)
-            genBuffer += GenBenchSwitchEnd
-            genBuffer += GenBenchTemplateMainEnd
-            try: genBenchFile.write(genBuffer)
-            except Exception as e:
-                return pArgs.Err('Jotai', f'{e}')
 
+    # buffer += mainFn begin
+    genBuffer += GenBenchTemplateMainBegin
+    genBuffer += GenBenchSwitchBegin
+    for idx, sw in enumerate(genSwitchList):
+        ket, out, err = sw
+        genBuffer += genSwitch(idx, out, ket)
+    genBuffer += GenBenchSwitchEnd
+    genBuffer += GenBenchTemplateMainEnd
+
+    # Creates the genBench file and writes the buffer to it
+    try: artifacts.write(genBenchName, genBuffer)
     except Exception as e:
         return pArgs.Err('Jotai', f'{e}')
 
+    manifest.record('jotai', key)
+
     return pArgs
 
 
-# def _compileGenBench(pArgs: BenchInfo) -> BenchInfo:
-#     cFilePath    = pArgs.cFilePath
-#     ketList      = pArgs.ketList
-#     optLevelList = pArgs.optLevelList
-#     cFileMetaDir = cFilePath.with_suffix('.d')
-#     # genBenchPath = cFileMetaDir / f'{cFilePath.stem}_{ket}.c'
-#     # genBinPath   = cFileMetaDir / f'{cFilePath.stem}_{ket}_{optLevel}'
+def _fanOut(pArgs: BenchInfo) -> list[BenchInfo]:
+    '''One copy of pArgs per optLevel, to compile/run each binary separately'''
+    return [BenchInfo(pArgs.cFilePath,
+                      fnName=pArgs.fnName,
+                      ketList=pArgs.ketList,
+                      optLevelList=[optLevel],
+                      exitCodes=dict(pArgs.exitCodes))
+            for optLevel in pArgs.optLevelList]
 
-#     for ket in ketList:
-#         for opt in optLevelList:
-#             # Compiles the genBench into a binary
-#             _, err = Clang(optLevel, ofile=genBinPath, ifile=genBenchPath).runcmd()
 
-#     # return (pArgs if err != failure
-#     #         else pArgs.Err())
+def _fanIn(pArgs: BenchInfo, results: list[BenchInfo]) -> BenchInfo:
+    '''
+    Merges the per-optLevel results of _fanOut back into pArgs, which stays
+    valid as long as one optLevel is, and keeps only the valid optLevels.
+    '''
+    pArgs.cacheHits = {k: v for r in results for k, v in r.cacheHits.items()}
+    pArgs.optLevelList = [r.optLevelList[0] for r in results if valid(r)]
+    if not pArgs.optLevelList:
+        return pArgs.Err('optLevels')
+    return pArgs
+
+
+def _fanOutCases(pArgs: BenchInfo) -> list[BenchInfo]:
+    '''
+    One copy of a single-optLevel pArgs per ket, after _runAsmmap, to run
+    each case of the binary in its own CFGgrind task
+    '''
+    return [BenchInfo(pArgs.cFilePath,
+                      fnName=pArgs.fnName,
+                      ketList=[ket],
+                      optLevelList=pArgs.optLevelList,
+                      exitCodes=dict(pArgs.exitCodes))
+            for ket in pArgs.ketList]
+
+
+def _fanInCases(pArgs: BenchInfo, results: list[BenchInfo]) -> BenchInfo:
+    '''
+    Merges the per-ket results of _fanOutCases back into pArgs, which stays
+    valid as long as one case is, and keeps only the valid kets. The cache
+    hits of pArgs (its asmmap, with --stream) are kept.
+    '''
+    pArgs.cacheHits.update((k, v) for r in results for k, v in r.cacheHits.items())
+    for r in results:
+        pArgs.samples += r.samples
+        pArgs.stages  += r.stages
+        r.samples, r.stages = [], []
+    pArgs.ketList = [r.ketList[0] for r in results if valid(r)]
+    if not pArgs.ketList:
+        return pArgs.Err(f'cfggrind_{pArgs.optLevelList[0]}')
+    return pArgs
+
+
+# Worker function mapped in a multiprocessing.Pool to run Clang
+@_collect
+@_stage('clang', '_{opt}', perOptLevel=True)
+async def _compileGenBench(pArgs: BenchInfo) -> BenchInfo:
+    '''
+    Compiles the genBench of a single (benchmark, optLevel) pair into
+    <bench>.d/<bench>_<optLevel>. Every ket is a case of the genBench switch,
+    so one binary per optLevel covers them all.
 
+    Skipped if the manifest says the binary is up to date. Otherwise, the
+    binary is looked up in the object cache (Clang.cache) by its preprocessed
+    source, clang version and flags before actually compiling it.
+
+    [--ub-screen sanitizer] Also builds <bench>_<optLevel>_san. The benchmark
+    doesn't fail if only that build does: CFGgrind falls back to memcheck.
+    '''
+    cFilePath    = pArgs.cFilePath
+    optLevel     = pArgs.optLevelList[0]
+    artifacts    = Artifacts(cFilePath)
+    genBinPath   = artifacts.path(f'{cFilePath.stem}_{optLevel}')
+    manifest     = Manifest(artifacts.workDir)
+    pArgs.cacheHits = {}
+
+    try: genBinPath.parent.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        return pArgs.Err(f'clang_{optLevel}', f'{e}: Clang [{genBinPath.parent}]')
+
+    with artifacts.files(f'{cFilePath.stem}.c') as (genBenchPath,):
+        clang = Clang(optLevel, ofile=genBinPath, ifile=genBenchPath)
+        stage = f'clang_{optLevel}'
+        msg, err, *_ = await _compile(clang, stage, manifest, pArgs.cacheHits)
+        if err == failure:
+            return pArgs.Err(stage, f'Clang {optLevel} [{genBenchPath}]:"{msg=}"')
+        pArgs.exitCodes[stage] = success
+
+        if CFGgrind.ubScreen == 'sanitizer':
+            sanBinPath = Path(f'{genBinPath}_san')
+            msg, err, *_ = await _compile(
+                Clang(optLevel, ofile=sanBinPath, ifile=genBenchPath, sanitize=True),
+                f'clangsan_{optLevel}', manifest, pArgs.cacheHits)
+            if err == failure:
+                sanBinPath.unlink(missing_ok=True)
+                logging.debug(f'Clang {optLevel} -fsanitize [{genBenchPath}]:"{msg=}"')
+
+    return pArgs
 
-def _runCFGgrind(pArgs: BenchInfo) -> BenchInfo:
+
+async def _compile(clang: Clang, stage: str, manifest: Manifest,
+             cacheHits: dict[str, bool]) -> CmdResult:
+    '''
+    Compiles clang.ifile into clang.ofile, unless the manifest says it's up
+    to date or it's in the object cache. Cache hits are set in cacheHits.
+    '''
+    key = digest(fileDigest(clang.ifile),
+                 *[toolId(exe) for exe in Clang.exe.values()],
+                 *clang.flags())
+
+    hit = cacheHits[stage] = manifest.hit(stage, key, clang.ofile)
+    if hit:
+        return CmdResult('', success)
+
+    objKey = await clang.objKey() if Clang.cache else None
+    if Clang.cache and objKey:
+        objStage = f'objcache_{clang.optLevel}' + ('_san' if clang.sanitize else '')
+        hit = cacheHits[objStage] = Clang.cache.get(objKey, clang.ofile)
+        if hit:
+            manifest.record(stage, key)
+            return CmdResult('', success)
+
+    # Compiles the genBench into a binary, never in place: the old one may
+    # be a hard link to a cache entry
+    clang.ofile.unlink(missing_ok=True)
+    res = await clang.runcmd()
+    if res.err == failure:
+        manifest.drop(stage)
+        return res
+
+    if Clang.cache and objKey:
+        Clang.cache.put(objKey, clang.ofile)
+
+    manifest.record(stage, key)
+    return res
+
+
+# Worker function mapped in a multiprocessing.Pool to run cfggrind_asmmap
+@_collect
+@_stage('asmmap', '_{opt}.map', perOptLevel=True)
+async def _runAsmmap(pArgs: BenchInfo) -> BenchInfo:
+    '''
+    Writes <bench>.d/<bench>_<optLevel>.map, which only depends on the
+    binary, once for all of its cases. Sets pArgs.ketList to the kets of the
+    genBench switch, in case order, for _fanOutCases.
+    '''
+    cFilePath    = pArgs.cFilePath
+    optLevel     = pArgs.optLevelList[0]
+    artifacts    = Artifacts(cFilePath)
+    genBenchPath = artifacts.path(f'{cFilePath.stem}.c')
+    genBinPath   = artifacts.path(f'{cFilePath.stem}_{optLevel}')
+    manifest     = Manifest(artifacts.workDir)
+    stage        = f'asmmap_{optLevel}'
+
+    try: pArgs.ketList = list(switchCases(artifacts.read(genBenchPath.name)))
+    except Exception as e:
+        return pArgs.Err(stage, f'{e}: CFGgrind [{genBenchPath}]')
+    if not pArgs.ketList:
+        return pArgs.Err(stage, f'CFGgrind: no switch cases [{genBenchPath}]')
+
+    cfggrind = CFGgrind(genBinPath, pArgs.fnName)
+    key = digest(fileDigest(genBinPath),
+                 toolId(CFGgrind.exe['cfggrind_asmmap']))
+
+    hit = manifest.hit(stage, key, cfggrind.mapFilePath)
+    pArgs.cacheHits = {stage: hit}
+    if hit:
+        return pArgs
+
+    res, err, *_ = await cfggrind.asmmap()
+    if err == failure:
+        manifest.drop(stage)
+        return pArgs.Err(stage, f'CFGgrind asmmap [{genBinPath}]:\n{res}\n')
+
+    manifest.record(stage, key)
+    return pArgs
+
+
+# Worker function mapped in a multiprocessing.Pool to run CFGgrind
+@_collect
+@_stage('cfggrind', '_{opt}_{ket}.cfg', '_{opt}_{ket}.info',
+        perOptLevel=True, perKet=True)
+async def _runCFGgrind(pArgs: BenchInfo) -> BenchInfo:
+    '''
+    Runs the UB screen (memcheck or the sanitizers), valgrind-cfgg and
+    cfgg-info on the switch case of a single (benchmark, optLevel, ket),
+    after _runAsmmap wrote the .map of the binary, into
+    <bench>.d/<bench>_<optLevel>_<ket>.cfg/.info
+    '''
     cFilePath              = pArgs.cFilePath
-    ket                    = pArgs.ket
-    optLevel               = pArgs.optLevel
-    cFileMetaDir           = cFilePath.with_suffix('.d')
-    genBinPath             = cFileMetaDir / f'{cFilePath.stem}_{ket}_{optLevel}'
-    ''' Runs valgrind-memcheck, cfgg-asmmap, valgrind-cfgg and cfgg-info '''
+    optLevel               = pArgs.optLevelList[0]
+    ket                    = pArgs.ketList[0]
+    artifacts              = Artifacts(cFilePath)
+    genBenchPath           = artifacts.path(f'{cFilePath.stem}.c')
+    genBinPath             = artifacts.path(f'{cFilePath.stem}_{optLevel}')
+    manifest               = Manifest(artifacts.workDir)
+    stage                  = f'cfggrind_{optLevel}_{ket}'
+
+    # The case of the genBench switch that runs ket
+    try: case = str(switchCases(artifacts.read(genBenchPath.name))[ket])
+    except Exception as e:
+        return pArgs.Err(stage, f'{e}: CFGgrind {ket} [{genBenchPath}]')
+
+    cfggrind = CFGgrind(genBinPath, pArgs.fnName, ket)
+    sanitized = CFGgrind.ubScreen == 'sanitizer'
+    key = digest(fileDigest(genBinPath),
+                 pArgs.fnName,
+                 case,
+                 *[toolId(exe) for exe in CFGgrind.exe.values()],
+                 CFGgrind.ubScreen,
+                 *([str(CFGgrind.memcheckFallback),
+                    fileDigest(cfggrind.sanBinPath)
+                    if cfggrind.sanBinPath.exists() else ''] if sanitized else []))
+
+    infoName = cfggrind.cfggInfoOutPath.name
+    hit = manifest.hit(stage, key) and artifacts.exists(infoName)
+    pArgs.cacheHits = {stage: hit}
+    if hit:
+        # CFGgrind only runs once the UB screen found no UB
+        recordStage(cFilePath, CFGgrind.ubScreen, ResultKind.OK, 0.0,
+                    ket=ket, optLevel=optLevel, cached=True)
+        return pArgs
+
+    # [--storage pack] cfggrind_info writes the .info to a temp file
+    with artifacts.files(infoName) as (infoPath,):
+        cfggrind.cfggInfoOutPath = infoPath
+        res, err, *_ = await cfggrind.runcmd(case)
+        if err != failure:
+            try: artifacts.store(infoName, infoPath)
+            except OSError as e:
+                res, err = f'{e}', failure
+
+    # Undefined behavior (or a crash) as found by the sanitizers and/or
+    # memcheck, see kotai.stats.report. An inconclusive sanitized run that
+    # fell back to memcheck only gets the memcheck row.
+    for tool, toolRes in (('sanitizer', cfggrind.sanitizerRes),
+                          ('memcheck',  cfggrind.memcheckRes)):
+        if toolRes is None or (tool == 'sanitizer' and cfggrind.memcheckRes):
+            continue
+        recordStage(cFilePath, tool, toolRes.kind,
+                    next((s.seconds for s in reversed(pendingSamples())
+                          if s.tool == tool), 0.0),
+                    ket=ket, optLevel=optLevel, usage=toolRes.usage)
 
-    res, err = CFGgrind(genBinPath, pArgs.fnName).runcmd()
+    if err == failure:
+        manifest.drop(stage)
+        return pArgs.Err(stage, f'CFGgrind {ket} [{genBinPath}]:\n{res}\n')
 
-    return (pArgs if err != failure
-            else pArgs.Err(f'CFGgrind:\n{res}\n'))
+    manifest.record(stage, key)
+    return pArgs
 
 
-def _start(self: Application, ) -> SysExitCode:
+# Runs every case of a single (benchmark, optLevel) binary, one after the other
+async def _runCFGgrindCases(pArgs: BenchInfo) -> BenchInfo:
+    if not valid(pArgs := await _runAsmmap(pArgs)):
+        return pArgs
+    return _fanInCases(pArgs, [await _runCFGgrind(r) for r in _fanOutCases(pArgs)])
 
-    # For each directory passed with -i/--inputdir, do:
-    for benchDir in self.inputBenchmarks:
 
-        #self.optLevelList
-        pArgs = [BenchInfo(cf, ketList=self.ketList, optLevelList=[]) for cf in benchDir.glob('*.c')]
+# Worker function run by --stream: compiles every optLevel of a benchmark
+async def _compileGenBenchAll(pArgs: BenchInfo) -> BenchInfo:
+    return _fanIn(pArgs, [await _compileGenBench(r) for r in _fanOut(pArgs)])
+
+
+# Worker function run by --stream: runs CFGgrind on every compiled optLevel
+async def _runCFGgrindAll(pArgs: BenchInfo) -> BenchInfo:
+    return _fanIn(pArgs, [await _runCFGgrindCases(r) for r in _fanOut(pArgs)])
+
+
+# Stages run in order by --stream, each with the message returned when no
+# benchmark gets through it (the same ones returned by the staged mode)
+_pipeline: list[tuple[Callable[[BenchInfo], Coroutine[Any, Any, BenchInfo]], str]] = [
+    (_genDescriptor, '[PrintDescriptors] No descriptors were generated'),
+    (_runKonstrain,  '[Konstrain] No constraints were generated'),
+    (_runJotai,      '[Jotai] No benchmarks with entry points were generated'),
+    (_compileGenBenchAll, '[Clang] No benchmarks with entry points compiled successfully'),
+    (_runCFGgrindAll,     '[Valgrind/CFGgrind] No binary executed successfully'),
+]
 
-        # [-c] Deletes 
-        if self.args.clean:
-            with Pool(self.nproc) as pool:
-                pool.map(_cleanFn, pArgs, len(pArgs) // self.nproc // 2 + 1)
-                pool.close()
-                pool.join()
-            return success
+
+# Worker function mapped in a multiprocessing.Pool by --stream
+@_collect
+async def _runPipeline(pArgs: BenchInfo, first: int = 0) -> tuple[BenchInfo, int]:
+    '''
+    Runs every stage in _pipeline (from first onwards) on a single benchmark,
+    starting each stage as soon as the previous one finishes for *this*
+    benchmark, instead of waiting for the whole input to get through it.
+    Stops at the first stage the benchmark fails.
+
+    Returns the last result and the number of stages the benchmark passed.
+    '''
+    cacheHits: dict[str, bool] = dict(pArgs.cacheHits) if first else {}
+    passed = first
+    for stage, _ in _pipeline[first:]:
+        pArgs = await stage(pArgs)
+        cacheHits |= pArgs.cacheHits
+        if not valid(pArgs):
+            break
+        passed += 1
+
+    pArgs.cacheHits = cacheHits
+    return pArgs, passed
 
 
-        with Pool(self.nproc, maxtasksperchild=self.mtpc) as pool:
+# Worker function mapped in a multiprocessing.Pool by --stream with batches
+@_collect
+async def _runPipelineBatch(batch: list[BenchInfo]) -> list[tuple[BenchInfo, int]]:
+    '''Same as _runPipeline, with PrintDescriptors run over the whole batch'''
+    return [await _runPipeline(r, 1) if valid(r) else (r, 0)
+            for r in await _genDescriptorBatch(batch)]
 
-            # benchDir/descriptor <- PrintDescriptors
-            resGenDesc = [r for r in pool.map(_genDescriptor, pArgs, self.chunksize) if valid(r)]
-            if not resGenDesc:
-                return '[PrintDescriptors] No descriptors were generated'
 
-            # benchDir/constraints <- Konstrain
-            resKons = [r for r in pool.map(_runKonstrain, resGenDesc, self.chunksize) if valid(r)]
-            if not resKons:
-                return '[Konstrain] No constraints were generated'
+def _batched(pArgs: list[BenchInfo]) -> list[list[BenchInfo]]:
+    '''Splits pArgs in batches of PrintDescriptors.batchSize'''
+    size = PrintDescriptors.batchSize
+    return [pArgs[i:i+size] for i in range(0, len(pArgs), size)]
 
-            # >>> We're 
-            # pollyInput = [BenchInfo(bi.cFilePath, bi.fnName)
-            #               for bi in resGenDesc]
-            # resPolly = [r for r in pool.map(_runPolly, resKons, self.chunksize) if valid(r)]
 
-            # benchDir/genBench.c <- Jotai
-            resJotai = [r for r in pool.map(_runJotai, resKons, self.chunksize) if valid(r)]
-            if not resJotai:
-                return '[Jotai] No benchmarks with entry points were generated'
+def _stream(self: Application, pool: Any, pArgs: list[BenchInfo]) -> int | str:
+    '''
+    [--stream] Feeds every benchmark of pArgs through _runPipeline, tallying
+    each result as it arrives. Returns how many benchmarks passed every stage
+    or, if some stage had no survivors, its message.
+    '''
+    passedStage = [0] * len(_pipeline)
 
-            # clangInput = [BenchInfo(bi.cFilePath, bi.fnName, bi.ket, optLevel)
-            #               for bi in resJotai for optLevel in self.optLevels]
+    if PrintDescriptors.batchSize > 1:
+        resIt = (r for batch in _imap(self, pool, _runPipelineBatch, _batched(pArgs), 'pipeline')
+                   for r in batch)
+    else:
+        resIt = _imap(self, pool, _runPipeline, pArgs, 'pipeline')
 
-            # # benchDir/genBench <- clang
-            # resClang = [r for r in pool.map(_compileGenBench, clangInput, self.chunksize) if valid(r)]
+    self.metrics.submit('descriptor', len(pArgs))
+    self.metrics.submit('pipeline', len(pArgs) * len(self.optLevels))
+    for res, passed in resIt:
+        _tally(self, [res], final=True)
+        if valid(res):
+            _finish(self, res.cFilePath, [o for o in self.optLevels
+                                          if o not in res.optLevelList], False)
+        for idx in range(passed):
+            passedStage[idx] += 1
 
-            # if not resClang:
-            #     return '[Clang] No benchmarks with entry points compiled successfully'
+    for count, (_, errmsg) in zip(passedStage, _pipeline):
+        if not count:
+            return errmsg
 
-            # resValgrind = [r for r in pool.map(_runCFGgrind, resClang, self.chunksize)]
-            # if not resValgrind:
-            #     return '[Valgrind/CFGgrind] No binary executed successfully'
+    return passedStage[-1]
 
-            pool.close()
-            pool.join()
 
-        # # TODO: Refine this
-        # ubCounter = {}
-        # ubCounter = Counter([(e.optLevel, e.exitCode.name) for e in resValgrind])
-        # try:
-        #     with open(self.ubstats, 'w+') as ofhandle:
-        #         ofhandle.write('Undefined behavior count:\n')
-        #         ofhandle.writelines([f'{v, c}' for v, c in ubCounter.items()])
-        #         ofhandle.write('\n')
-        # except Exception as e: logging.error(f'{e}')
+def _staged(self: Application, pool: Any, pArgs: list[BenchInfo]) -> int | str:
+    '''
+    Runs each stage on every benchmark of pArgs before the next one. Returns
+    how many benchmarks passed every stage or, if some stage had no
+    survivors, its message.
+    '''
+    # Results are tallied as they arrive (imap), for --progress
+    self.metrics.submit('pipeline', len(pArgs) * len(self.optLevels))
+
+    # benchDir/descriptor <- PrintDescriptors
+    self.metrics.submit('descriptor', len(pArgs))
+    if PrintDescriptors.batchSize > 1:
+        resBatches = _imap(self, pool, _genDescriptorBatch, _batched(pArgs), 'descriptor')
+        resGenDesc = [r for r in _tally(self, (r for b in resBatches for r in b)) if valid(r)]
+    else:
+        resGenDesc = [r for r in _tally(self, _imap(self, pool, _genDescriptor, pArgs, 'descriptor')) if valid(r)]
+    if not resGenDesc:
+        return '[PrintDescriptors] No descriptors were generated'
+
+    # benchDir/constraints <- Konstrain
+    self.metrics.submit('konstrain', sum(len(r.ketList) for r in resGenDesc))
+    resKons = [r for r in _tally(self, _imap(self, pool, _runKonstrain, resGenDesc, 'konstrain')) if valid(r)]
+    if not resKons:
+        return '[Konstrain] No constraints were generated'
+    # Only the last stage's results are kept alive in the parent
+    del pArgs, resGenDesc
+
+    # >>> We're 
+    # pollyInput = [BenchInfo(bi.cFilePath, bi.fnName)
+    #               for bi in resGenDesc]
+    # resPolly = [r for r in pool.map(_runPolly, resKons, self.chunksize) if valid(r)]
+
+    # benchDir/genBench.c <- Jotai
+    self.metrics.submit('jotai', len(resKons))
+    resJotai = [r for r in _tally(self, _imap(self, pool, _runJotai, resKons, 'jotai')) if valid(r)]
+    if not resJotai:
+        return '[Jotai] No benchmarks with entry points were generated'
+    del resKons
+
+    # One task per (benchmark, optLevel)
+    clangInput = [r for bi in resJotai for r in _fanOut(bi)]
+    del resJotai
+
+    # benchDir/genBench_optLevel <- clang
+    self.metrics.submit('clang', len(clangInput))
+    resClang = [r for r in _tally(self, _imap(self, pool, _compileGenBench, clangInput, 'clang')) if valid(r)]
+    if not resClang:
+        return '[Clang] No benchmarks with entry points compiled successfully'
+    del clangInput
+
+    # benchDir/genBench_optLevel.map <- cfggrind_asmmap, once per binary
+    self.metrics.submit('asmmap', len(resClang))
+    resAsmmap = [r for r in _tally(self, _imap(self, pool, _runAsmmap, resClang, 'asmmap')) if valid(r)]
+    if not resAsmmap:
+        return '[Valgrind/CFGgrind] No binary executed successfully'
+
+    # One task per (benchmark, optLevel, ket): a case of the switch
+    caseInput = [r for bi in resAsmmap for r in _fanOutCases(bi)]
+    del resClang
+
+    # benchDir/genBench_optLevel_ket.info <- CFGgrind
+    self.metrics.submit('cfggrind', len(caseInput))
+    resCases = _tally(self, _imap(self, pool, _runCFGgrind, caseInput, 'cfggrind'), finish=False)
+    offsets  = [0]
+    for bi in resAsmmap:
+        offsets.append(offsets[-1] + len(bi.ketList))
+    resValgrind = [r for r in _tally(self, [_fanInCases(bi, resCases[i:j])
+                                            for bi, i, j in zip(resAsmmap, offsets, offsets[1:])],
+                                     final=True) if valid(r)]
+    if not resValgrind:
+        return '[Valgrind/CFGgrind] No binary executed successfully'
+
+    return len(resValgrind)
+
+
+def _imap(self: Application, pool: Any, fn: Callable[[Any], Coroutine[Any, Any, _R]],
+          tasks: list[Any], stage: str) -> Iterator[_R]:
+    '''
+    pool.imap(fn, tasks), in order, with the chunksize the scheduler picks
+    for stage (see kotai.schedule). The heavy benchmarks at the head of tasks
+    (longest-first) are dispatched one per chunk. Tasks are BenchInfos, or
+    batches of them.
+    '''
+    bench = lambda t: (t[0] if isinstance(t, list) else t).cFilePath
+    nHeavy = next((i for i, t in enumerate(tasks) if not self.scheduler.isHeavy(bench(t))),
+                  len(tasks))
+
+    metrics = self.metrics.stages.get(stage)
+    observed = (metrics.quantile(0.5) if metrics and metrics.ran >= Scheduler.minObserved
+                else None)
+    chunksize = self.scheduler.chunksize(stage, len(tasks) - nHeavy, observed)
+    logging.debug(f'{stage}: {nHeavy} heavy task(s), then '
+                  f'{len(tasks) - nHeavy} in chunks of {chunksize}')
+
+    # Both are queued right away, the heavy ones first
+    heads = pool.imap(fn, tasks[:nHeavy], 1) if nHeavy else iter(())
+    rest  = pool.imap(fn, tasks[nHeavy:], chunksize)
+    return itertools.chain(heads, rest)
+
+
+def _tally(self: Application, results: Iterable[BenchInfo],
+           final: bool = False, finish: bool = True) -> list[BenchInfo]:
+    '''
+    Counts the cache hits/misses of the stage that produced results, and
+    takes the tool runtimes and stage records they carry (so they're not sent
+    to the next stage), as each result arrives. Benchmarks that failed, or
+    passed the final stage, are marked as finished in the results store,
+    unless finish is False (results merged before they're final, e.g. by
+    _fanInCases).
+    '''
+    tallied = []
+    for r in results:
+        self.cacheStats.update(r.cacheHits.items())
+        r.cacheHits = {}
+        if r.samples:
+            self.runtimes.add(r.samples)
+            self.metrics.observeSamples(r.samples)
+            r.samples = []
+        if r.stages:
+            self.metrics.observe(r.stages)
+            self.store.add(r.stages)
+            r.stages = []
+        if finish and not valid(r):
+            _finish(self, r.cFilePath, r.optLevelList or self.optLevels, False)
+        elif finish and final:
+            _finish(self, r.cFilePath, r.optLevelList, True)
+        self.metrics.tick()
+        tallied.append(r)
+    return tallied
+
+
+def _finish(self: Application, bench: Path, optLevels: list[OptLevel],
+            ok: bool) -> None:
+    '''
+    bench left the pipeline with optLevels: marks it in the results store
+    and, with --scratch-dir, deletes their scratch files
+    '''
+    self.metrics.observe(self.store.finish(bench, optLevels, ok))
+    if Artifacts.scratch:
+        Artifacts(bench).clearScratch(optLevels)
+
+
+def _evictCaches() -> None:
+    '''[--objcache, --konstraincache] Keeps the caches within their size bounds'''
+    for cache, entries in ((Clang.cache, 'binaries'), (Konstrain.cache, 'constraints')):
+        if cache and (evicted := cache.evict())[0]:
+            logging.info(f'Evicted {evicted[0]} {entries} ({evicted[1]} '
+                         f'bytes) from {cache.root}')
+
+
+def _reportCache(cacheStats: Counter[tuple[str, bool]]) -> None:
+    '''Run summary: cache hits/misses per stage (stdout and logfile)'''
+    if not cacheStats:
+        return
+
+    stages = sorted({stage for stage, _ in cacheStats})
+    hits   = sum(n for (_, hit), n in cacheStats.items() if hit)
+    misses = sum(n for (_, hit), n in cacheStats.items() if not hit)
+
+    lines = [f'Cache: {hits} hit(s), {misses} miss(es)']
+    lines += [f'    {stage:<24} {cacheStats[(stage, True)]:>8} hit(s) '
+              f'{cacheStats[(stage, False)]:>8} miss(es)' for stage in stages]
+
+    # [--konstraincache] Konstrain runs saved by identical descriptors
+    memo = {k: n for k, n in cacheStats.items() if k[0].startswith('konstraincache_')}
+    if (lookups := sum(memo.values())):
+        deduped = sum(n for (_, hit), n in memo.items() if hit)
+        lines.append(f'Konstrain dedup: {deduped}/{lookups} run(s) '
+                     f'({100 * deduped / lookups:.1f}%) served by --konstraincache')
+
+    for line in lines:
+        print(line)
+        logging.info(line)
+
+
+def _scanBenchmarks(benchDir: Path) -> Iterator[Path]:
+    '''*.c files of benchDir, lazily, in the order os.scandir lists them'''
+    with os.scandir(benchDir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.c') and entry.is_file():
+                yield benchDir / entry.name
+
+
+def _discover(self: Application, benchDir: Path) -> Iterator[Path]:
+    '''The benchmarks of benchDir to run, lazily (see _scanBenchmarks)'''
+    # [--rerun] Benchmarks of benchDir that failed/timed out, from the
+    # results store instead of the filesystem
+    if self.args.rerun:
+        cFiles = (cf for b in self.store.select(ResultKind(k) for k in self.args.rerun)
+                  if (cf := Path(b)).parent == benchDir)
+    else:
+        cFiles = _scanBenchmarks(benchDir)
+
+    # [--shard] Leaves the benchmarks of the other shards to other runs
+    if self.shard:
+        cFiles = (cf for cf in cFiles
+                  if _inShard(cf.relative_to(benchDir), self.shard))
+
+    return cFiles
+
+
+def _windows(cFiles: Iterator[Path], size: int) -> Iterator[list[Path]]:
+    '''cFiles in lists of (at most) size'''
+    while window := list(itertools.islice(cFiles, size)):
+        yield window
+
+
+def _start(self: Application, ) -> SysExitCode:
+
+    # For each directory passed with -i/--inputdir, do:
+    for benchDir in self.inputBenchmarks:
+
+        # [--pch] Precompiles the genBench prelude once, before forking
+        if self.args.pch and not self.args.clean:
+            Clang.pch = {opt: pch for opt in self.optLevels
+                         if (pch := Clang.buildPch(opt, Path(self.args.pchdir)))}
+
+        # [--window] A window of benchmarks at a time, each with its own pool
+        # and bench table, as they're discovered
+        ran, passed, errmsg = 0, 0, ''
+        for cFiles in _windows(_discover(self, benchDir), self.window):
+
+            # [--resume] Skips the benchmarks that finished in a previous run
+            if self.args.resume:
+                finished = self.store.finished(self.optLevels, cFiles)
+                if not (cFiles := [cf for cf in cFiles if str(cf) not in finished]):
+                    continue
+
+            # [--schedule] Longest-first, from the costs of their last run
+            if not self.args.clean:
+                cFiles = self.scheduler.order(cFiles, self.store.costs(cFiles)
+                                              if Scheduler.kind == 'cost' else {})
+
+            # [IPC] BenchInfos travel as indexes in cFiles, see setBenchTable
+            setBenchTable(cFiles)
+            pArgs = [BenchInfo(cf, ketList=self.ketList, optLevelList=self.optLevels) for cf in cFiles]
+            ran += len(pArgs)
+
+            # [-c] Deletes 
+            if self.args.clean:
+                with newPool(self.executor, self.workers) as pool:
+                    pool.map(_cleanFn, pArgs, len(pArgs) // self.workers // 2 + 1)
+                    pool.close()
+                    pool.join()
+                continue
+
+            self.store.forget(cFiles)
+            # [--konstrain-servers] Workers keep their JVMs for the window
+            mtpc = None if Konstrain.servers else self.mtpc
+            with newPool(self.executor, self.workers, mtpc) as pool:
+                # [--stream] Each benchmark goes through every stage on its own
+                res = (_stream if self.args.stream else _staged)(self, pool, pArgs)
+                pool.close()
+                pool.join()
+
+            if isinstance(res, str):
+                errmsg = errmsg or res
+            else:
+                passed += res
+
+            # Not only at the end: a run can fill the caches many times over
+            _evictCaches()
+
+        setBenchTable([])
+        if self.args.clean:
+            return success
+        if not ran and (self.args.rerun or self.args.resume or self.shard):
+            logging.info(f'Nothing left to run in {benchDir}')
+            continue
+        if not passed:
+            return errmsg or _pipeline[0][1]
+
+    # [-u] CFGgrind results of this (and previous) runs, and UB counts. With
+    # --shard, only those of this shard's benchmarks (which are listed
+    # straight from their -i dir, so their relative path is their name).
+    shard = self.shard
+    ingest(self.inputBenchmarks, Path(self.args.dataset), self.nproc,
+           packs=Artifacts.root if Artifacts.storage == 'pack' else None,
+           only=(lambda bench: _inShard(Path(bench.name), shard)) if shard else None)
+    writeReport(Path(self.args.dataset), self.store, Path(self.ubstats))
+    logging.info(f'Report written to {self.ubstats}')
 
     return success
 
 
 def main() -> SysExitCode:
+    # python -m kotai stats ...
+    if sys.argv[1:2] == ['stats']:
+        from kotai.console import stats
+        return stats.main(sys.argv[2:])
+    # python -m kotai merge ...
+    if sys.argv[1:2] == ['merge']:
+        from kotai.console import merge
+        return merge.main(sys.argv[2:])
     return Application().start()
 
 
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# =========================================================================== #
+
+import argparse
+import logging
+from pathlib import Path
+
+from kotai.kotypes import SysExitCode, success
+from kotai.logconf import logFmt
+from kotai.results import ResultStore
+from kotai.stats import merge as mergeDatasets
+from kotai.stats.report import writeReport
+from kotai.timeouts import RuntimeStats
+
+# --------------------------------------------------------------------------- #
+'''
+python -m kotai merge <shard output dirs>, for runs split with --shard i/N:
+
+    results.db      rows of every shard, the latest one on conflicts
+    cfginfo         dataset parts of every shard, as a single new part
+    runtimes.json   runtimes of every shard, for --adaptive-timeouts
+
+are merged into -o/--output, and the report (-u/--ubstats) is written from
+the merged results. Only those files are read: the shards' benchmark
+directories (and their .info files) don't need to be reachable.
+'''
+# --------------------------------------------------------------------------- #
+
+def main(argv: list[str]) -> SysExitCode:
+    cli = argparse.ArgumentParser(prog='python -m kotai merge',
+                                  description='Merges the outputs of --shard runs')
+    cli.add_argument('shards', type=str, nargs='+', help='output dir of each shard')
+    cli.add_argument('-o', '--output',   default='./output')
+    cli.add_argument('--results',        default='results.db')
+    cli.add_argument('--dataset',        default='cfginfo')
+    cli.add_argument('--runtimes',       default='runtimes.json')
+    cli.add_argument('-u', '--ubstats',  default='ubstats.txt')
+
+    args = cli.parse_args(argv)
+    logging.basicConfig(format=logFmt, level=logging.WARNING)
+
+    output = Path(args.output)
+    shards = [Path(s) for s in args.shards]
+
+    store = ResultStore(output / args.results)
+    try:
+        rows = sum(store.merge(shard / args.results) for shard in shards)
+        infos = mergeDatasets([shard / args.dataset for shard in shards],
+                              output / args.dataset)
+
+        runtimes = RuntimeStats(output / args.runtimes)
+        for shard in shards:
+            runtimes.merge(RuntimeStats(shard / args.runtimes))
+        runtimes.save()
+
+        print(f'Merged {len(shards)} shard(s) into {output}: '
+              f'{rows} result(s), {infos} .info row(s)')
+        print(writeReport(output / args.dataset, store, output / args.ubstats))
+    finally:
+        store.close()
+
+    return success
+
+
+
+# =========================================================================== #
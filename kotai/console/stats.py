@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# =========================================================================== #
+
+import argparse
+import logging
+import time
+from pathlib import Path
+
+from kotai.kotypes import SysExitCode, success
+from kotai.logconf import logFmt
+from kotai.results import ResultStore
+from kotai.stats import ingest
+from kotai.stats.report import writeReport
+
+# --------------------------------------------------------------------------- #
+'''
+python -m kotai stats <command>, for the results of previous runs:
+
+    ingest      .info files of the -i dirs -> columnar dataset (kotai.stats)
+    report      dataset + results store -> -u/--ubstats (kotai.stats.report)
+'''
+# --------------------------------------------------------------------------- #
+
+def main(argv: list[str]) -> SysExitCode:
+    cli = argparse.ArgumentParser(prog='python -m kotai stats',
+                                  description='Jotai statistics')
+    sub = cli.add_subparsers(dest='command', required=True)
+
+    cliIngest = sub.add_parser('ingest', help='Parses CFGgrind .info files')
+    cliIngest.add_argument('-i', '--inputdir', type=str, nargs='+', required=True)
+    cliIngest.add_argument('-o', '--dataset',  default='./output/cfginfo')
+    cliIngest.add_argument('-j', '--nproc',    type=int, default=8)
+    cliIngest.add_argument('-J', '--chunksize', type=int, default=256)
+    cliIngest.add_argument('--packs',          default=None,
+                           help='--artifacts-dir of a --storage pack run')
+
+    cliReport = sub.add_parser('report', help='Compares optLevels/kets, counts UB')
+    cliReport.add_argument('-o', '--dataset',  default='./output/cfginfo')
+    cliReport.add_argument('--results',        default='./output/results.db')
+    cliReport.add_argument('-u', '--ubstats',  default='./output/ubstats.txt')
+
+    args = cli.parse_args(argv)
+    logging.basicConfig(format=logFmt, level=logging.WARNING)
+
+    match args.command:
+        case 'ingest':
+            start = time.monotonic()
+            nRows = ingest([Path(p) for p in args.inputdir], Path(args.dataset),
+                           max(args.nproc, 1), max(args.chunksize, 1),
+                           Path(args.packs) if args.packs else None)
+            print(f'Ingested {nRows} .info file(s) into {args.dataset} '
+                  f'in {time.monotonic() - start:.2f}s')
+
+        case 'report':
+            store = ResultStore(Path(args.results))
+            try: print(writeReport(Path(args.dataset), store, Path(args.ubstats)))
+            finally:
+                store.close()
+
+    return success
+
+
+
+# =========================================================================== #
@@ -1,11 +1,133 @@
 #!/usr/bin/env python3
 # =========================================================================== #
 
+import atexit
+import logging
+import os
+import selectors
+import subprocess as sp
+import threading
+import time
 from pathlib import Path
 
-from kotai.kotypes import runproc, CmdResult, KonstrainExecType
+from kotai.cache import ContentCache, digest, toolId
+from kotai.kotypes import arunproc, blocking, out2file, killGroup, spawnLimits, limitsOf, recordSample, CmdResult, CmdSample, ExitCode, KonstrainExecType
 
 # --------------------------------------------------------------------------- #
+'''
+Konstrain worker protocol (--konstrain-servers):
+
+    The jar is started once with Konstrain.server and must answer with the
+    Konstrain.handshake line. After that, each request is a single line
+
+        <descriptor path>\t<ket>\n
+
+    and the reply is Konstrain's usual output followed by the line
+
+        Konstrain.endMarker <exit code>\n
+
+    The server exits when its stdin is closed. A jar that answers something
+    else than the handshake, or exits before it, doesn't support the
+    protocol, and Konstrain falls back to spawning one JVM per (descriptor,
+    ket) for the rest of the run. A JVM that doesn't start in time (e.g. on
+    a loaded machine) only costs that call a one-shot JVM: it's started
+    again on the next call.
+
+    Each request is recorded as a 'konstrain' CmdSample, without rusage (the
+    JVM is shared), so --adaptive-timeouts and the metrics see them too.
+    Pool workers keep their JVMs for the whole window (no maxtasksperchild).
+'''
+# --------------------------------------------------------------------------- #
+
+class KonstrainProtocolError(ConnectionError):
+    '''The jar doesn't speak the worker protocol'''
+
+
+class KonstrainServer:
+
+    # ---------------------------- Member attrs. ---------------------------- #
+
+    __slots__ = (
+        'proc',
+        'sel',
+        'buf',
+    )
+
+    def __init__(self, cmd: list[str], handshake: str, timeout: float):
+        # Sandboxed like a one-shot Konstrain (see runproc), but without the
+        # CPU cap, which would add up over every request of the JVM
+        prefix, preexec = spawnLimits(limitsOf('konstrain')._replace(cpu=None))
+        self.proc = sp.Popen(prefix + cmd, stdin=sp.PIPE, stdout=sp.PIPE,
+                             stderr=sp.DEVNULL, close_fds=True, bufsize=0,
+                             start_new_session=True, preexec_fn=preexec)
+        self.sel  = selectors.DefaultSelector()
+        self.buf  = b''
+
+        assert self.proc.stdout is not None
+        self.sel.register(self.proc.stdout, selectors.EVENT_READ)
+
+        deadline = time.monotonic() + timeout
+        if (line := self._readline(deadline)) != handshake:
+            self.close()
+            if line is None and time.monotonic() >= deadline:
+                raise TimeoutError(f'No handshake from {cmd} after {timeout}s')
+            raise KonstrainProtocolError(f'Bad handshake from {cmd}: {line!r}')
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def _readline(self, deadline: float) -> str | None:
+        '''Next line from the server, or None on EOF/timeout'''
+        while b'\n' not in self.buf:
+            if (remaining := deadline - time.monotonic()) <= 0:
+                return None
+            if not self.sel.select(remaining):
+                return None
+            assert self.proc.stdout is not None
+            if not (chunk := os.read(self.proc.stdout.fileno(), 1 << 16)):
+                return None
+            self.buf += chunk
+        line, _, self.buf = self.buf.partition(b'\n')
+        return line.decode('utf-8', errors='replace')
+
+    def request(self, descriptor: Path, ket: KonstrainExecType,
+                timeout: float) -> CmdResult:
+        '''
+        Sends one request and collects the reply. On timeout or EOF the
+        server is killed, since its output stream is no longer in sync.
+        '''
+        deadline = time.monotonic() + timeout
+        try:
+            assert self.proc.stdin is not None
+            self.proc.stdin.write(f'{descriptor}\t{ket}\n'.encode('utf-8'))
+        except (OSError, ValueError) as e:
+            self.close()
+            return CmdResult(f'{e}', ExitCode.ERR)
+
+        lines: list[str] = []
+        while (line := self._readline(deadline)) is not None:
+            if line.startswith(Konstrain.endMarker):
+                rc = line[len(Konstrain.endMarker):].strip()
+                return CmdResult('\n'.join(lines) + '\n' if lines else '',
+                                 ExitCode.OK if rc == '0' else ExitCode.ERR)
+            lines.append(line)
+
+        logging.error(f'Konstrain server timed out or died on {descriptor} {ket}')
+        self.close()
+        return CmdResult('\n'.join(lines), ExitCode.ERR,
+                         timedOut=time.monotonic() >= deadline)
+
+    def close(self) -> None:
+        try: self.sel.close()
+        except Exception: pass
+        if self.proc.poll() is None:
+            try:
+                assert self.proc.stdin is not None
+                self.proc.stdin.close()
+                self.proc.wait(timeout=1.0)
+            except Exception:
+                killGroup(self.proc.pid)
+                self.proc.wait()
 
 
 # --------------------------------------------------------------------------- #
@@ -21,6 +143,32 @@ class Konstrain:
 
     timeout: float = 3.0
 
+    # [--konstrain-servers] JVMs kept alive per worker process (0: one-shot)
+    servers: int = 0
+
+    # Command that starts a JVM speaking the worker protocol (see above)
+    server: list[str] = ['java', '-jar', f'{exe["konstrain"]}', '--server']
+
+    handshake: str = 'KONSTRAIN-SERVER 1'
+    endMarker: str = '@@KONSTRAIN-END'
+
+    # Time allowed for a JVM to start and print the handshake
+    startTimeout: float = 30.0
+
+    # Set once a server answers a bad handshake, disables the worker mode
+    unsupported: bool = False
+
+    # [--konstraincache] Constraints of every descriptor text seen by this
+    # or previous runs, keyed by Konstrain.memoKey
+    cache: ContentCache | None = None
+
+    # Servers of this process, and the lock of each slot, held while its
+    # server starts or serves a request
+    _pool: list[KonstrainServer | None] = []
+    _slots: list[threading.Lock] = []
+    _next: int = 0
+    _poolLock = threading.Lock()
+
     # ---------------------------- Member attrs. ---------------------------- #
 
     __slots__ = (
@@ -34,14 +182,107 @@ class Konstrain:
         self.ket: KonstrainExecType = ket
         self.ofile: Path            = ofile
 
-    def runcmd(self, *args: str) -> CmdResult:
-        proc_args = [
+    def cmdline(self, *args: str) -> list[str]:
+        return [
             'java', '-jar', f'{Konstrain.exe["konstrain"]}',
             str(self.descriptor),
             str(self.ket),
         ] + [*args]
-        return runproc(proc_args, Konstrain.timeout,
-                       ofpath=self.ofile, breakLines=True)
+
+    @staticmethod
+    def memoKey(descriptorDigest: str, ket: KonstrainExecType) -> str:
+        '''
+        Key of the constraints in Konstrain.cache: Konstrain's output only
+        depends on the descriptor text, the ket and the jar (and java)
+        '''
+        return digest('konstrain', descriptorDigest, ket, toolId('java'),
+                      *[toolId(exe) for exe in Konstrain.exe.values()])
+
+    async def runcmd(self, *args: str) -> CmdResult:
+        if Konstrain.servers > 0 and not args and not Konstrain.unsupported:
+            # Waits for a slot of the pool and its JVM: in a thread of its own
+            if (served := await blocking(self._runserver)) is not None:
+                res, wall = served
+                recordSample(CmdSample('konstrain', wall, res.kind))
+                return out2file(res, self.ofile, breakLines=True)
+
+        return await arunproc(self.cmdline(*args), Konstrain.timeout,
+                              ofpath=self.ofile, breakLines=True, tool='konstrain')
+
+    def _runserver(self) -> tuple[CmdResult, float] | None:
+        '''
+        Runs the request on a pooled JVM, and returns its result and wall
+        time, None if no JVM could be started
+        '''
+        idx, lock = Konstrain._acquire()
+        try:
+            if (server := Konstrain._start(idx)) is None:
+                return None
+            start = time.monotonic()
+            res = server.request(self.descriptor, self.ket, Konstrain.timeout)
+            return res, time.monotonic() - start
+        finally:
+            lock.release()
+
+    # ----------------------------------------------------------------------- #
+
+    @staticmethod
+    def _acquire() -> tuple[int, threading.Lock]:
+        '''
+        Picks a slot of this process' pool (round-robin, preferring idle
+        ones), and returns it with its lock held
+        '''
+        with Konstrain._poolLock:
+            if len(Konstrain._pool) != Konstrain.servers:
+                Konstrain._pool  = [None] * Konstrain.servers
+                Konstrain._slots = [threading.Lock() for _ in range(Konstrain.servers)]
+                atexit.register(Konstrain.shutdown)
+
+            start = Konstrain._next
+            Konstrain._next = (start + 1) % Konstrain.servers
+            order = [(start + i) % Konstrain.servers
+                     for i in range(Konstrain.servers)]
+            idx = next((i for i in order if not Konstrain._slots[i].locked()), start)
+            lock = Konstrain._slots[idx]
+
+        # A JVM starting in another slot doesn't hold up this one
+        lock.acquire()
+        return idx, lock
+
+    @staticmethod
+    def _start(idx: int) -> KonstrainServer | None:
+        '''
+        Server of slot idx (whose lock the caller holds), (re)started if
+        needed, or None if it couldn't be
+        '''
+        server = Konstrain._pool[idx]
+        if server is not None and server.alive():
+            return server
+        if server is not None:
+            server.close()
+        Konstrain._pool[idx] = None
+
+        try:
+            server = KonstrainServer(Konstrain.server, Konstrain.handshake,
+                                     Konstrain.startTimeout)
+        except KonstrainProtocolError as e:
+            logging.warning(f'{e}: falling back to one JVM per Konstrain call')
+            Konstrain.unsupported = True
+            return None
+        except OSError as e:
+            # TimeoutError included: tried again on the next call
+            logging.warning(f'{e}: one JVM for this Konstrain call')
+            return None
+        Konstrain._pool[idx] = server
+        return server
+
+    @staticmethod
+    def shutdown() -> None:
+        for server in Konstrain._pool:
+            if server is not None:
+                server.close()
+        Konstrain._pool  = []
+        Konstrain._slots = []
 
 
 
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# =========================================================================== #
+
+import asyncio
+import concurrent.futures
+import logging
+import resource
+import threading
+from contextlib import contextmanager
+from contextvars import Context
+from multiprocessing import Pool
+from multiprocessing.pool import Pool as PoolType, ThreadPool
+from typing import Any, Callable, Coroutine, Final, Iterable, Iterator, Literal, NamedTuple, TypeVar
+
+from kotai.kotypes import Limits, Spawn, drive, killGroup, spawnLimits
+
+# --------------------------------------------------------------------------- #
+'''
+Executor backends (--executor) for the worker functions of the pipeline.
+
+Workers mostly build an argv and wait on an external tool, so besides the
+default process pool they can run in threads of the main process, which
+avoids forking, respawning workers (maxtasksperchild) and pickling every
+BenchInfo back and forth, or as tasks of a single event loop:
+
+    process: multiprocessing.Pool, each worker drives its coroutine
+    thread:  multiprocessing.pool.ThreadPool, same, one command per thread
+    async:   AsyncPool, every worker is a task of an asyncio event loop,
+             which runs their commands (asyncio.create_subprocess_exec)
+
+The workers are coroutines (see kotai.kotypes.Spawn), mapped with the
+multiprocessing.Pool interface by all of them, and arunproc keeps the same
+contract in all of them.
+
+With async, the number of tool invocations in flight is
+--async-concurrency (AsyncEngine.concurrency), not -j, and it takes no
+thread: a worker waiting on its command is a suspended task. Only the
+blocking calls of the workers (see kotai.kotypes.blocking) run in the
+small, fixed thread pool of the loop. The Python work of the workers is
+serialized on the loop thread, which is fine as long as it's short next to
+the tools. The parent holds a few file descriptors per command (see
+asyncConcurrency), so the concurrency is also capped by RLIMIT_NOFILE, whose
+soft limit is raised up to the hard one as needed.
+'''
+# --------------------------------------------------------------------------- #
+
+ExecutorKind = Literal['process', 'thread', 'async']
+
+Executors: Final[list[ExecutorKind]] = ['process', 'thread', 'async']
+
+_T = TypeVar('_T')
+_R = TypeVar('_R')
+
+
+class AsyncEngine:
+    '''
+    Event loop in a background thread that runs commands, limited by a
+    semaphore, and the tool coroutines awaiting them (see run). Also a
+    ProcEngine (see kotai.kotypes.setProcEngine): the calling thread blocks
+    until its command is done.
+    '''
+
+    # ---------------------------- Static attrs. ---------------------------- #
+
+    # [--async-concurrency] Tool invocations in flight at a time
+    concurrency: int = 256
+
+    # File descriptors the parent holds per command in flight (the stdout
+    # and stderr pipes, the child watcher), and those left for the rest
+    fdsPerCommand: int = 3
+    fdsReserved: int = 256
+
+    # ---------------------------- Member attrs. ---------------------------- #
+
+    __slots__ = (
+        'loop',
+        'thread',
+        'sem',
+    )
+
+    def __init__(self, concurrency: int):
+        self.loop   = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name='AsyncEngine', daemon=True)
+        self.thread.start()
+        self.sem: asyncio.Semaphore = asyncio.run_coroutine_threadsafe(
+            self._newSemaphore(concurrency), self.loop).result()
+
+    @staticmethod
+    async def _newSemaphore(concurrency: int) -> asyncio.Semaphore:
+        return asyncio.Semaphore(concurrency)
+
+    def __call__(self, proc_args: list[str], timeout: float,
+                 limits: Limits) -> tuple[str, str, int, bool, None]:
+        return asyncio.run_coroutine_threadsafe(
+            self._run(proc_args, timeout, limits), self.loop).result()
+
+    async def _run(self, proc_args: list[str], timeout: float,
+                   limits: Limits) -> tuple[str, str, int, bool, None]:
+        prefix, preexec = spawnLimits(limits)
+        async with self.sem:
+            proc = await asyncio.create_subprocess_exec(
+                *prefix, *proc_args, close_fds=True, start_new_session=True,
+                preexec_fn=preexec,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+            assert proc.stdout is not None and proc.stderr is not None
+            done = asyncio.gather(
+                asyncio.gather(proc.stdout.read(), proc.stderr.read()),
+                proc.wait())
+
+            # Like the default engine, the timeout covers the output too,
+            # and whatever was written before it is still returned. The
+            # event loop reaps the child as soon as it exits, so its group
+            # is only killed while something keeps the command from being
+            # done: the child itself, or a grandchild holding the pipes
+            timedOut = False
+            try: await asyncio.wait_for(asyncio.shield(done), timeout)
+            except asyncio.TimeoutError:
+                logging.error(f'Command {proc_args} timed out after '
+                              f'{timeout} seconds')
+                timedOut = True
+                if not done.done():
+                    killGroup(proc.pid)
+
+            (out, err), returncode = await done
+
+        # The event loop reaps the child with os.waitpid: no rusage
+        return out.decode('utf-8'), err.decode('utf-8'), returncode, timedOut, None
+
+    def run(self, coro: Coroutine[Any, Any, _R]) -> 'concurrent.futures.Future[_R]':
+        '''
+        Runs a tool coroutine as a task of the loop, see kotai.kotypes.drive.
+        The task starts from an empty context, as a worker thread would.
+        '''
+        return Context().run(asyncio.run_coroutine_threadsafe,
+                             self._drive(coro), self.loop)
+
+    async def _drive(self, coro: Coroutine[Any, Any, _R]) -> _R:
+        value: Any = None
+        send: Callable[[Any], Any] = coro.send
+        while True:
+            try: step = send(value)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                value = await (self._run(*step) if isinstance(step, Spawn) else
+                               self.loop.run_in_executor(None, step.run))
+                send = coro.send
+            except Exception as e:
+                value, send = e, coro.throw
+
+    def close(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def asyncConcurrency(wanted: int) -> int:
+    '''
+    wanted, or as many commands in flight as RLIMIT_NOFILE allows, after
+    raising its soft limit (up to the hard one) to fit wanted
+    '''
+    wanted = max(wanted, 1)
+    need = wanted * AsyncEngine.fdsPerCommand + AsyncEngine.fdsReserved
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < need:
+        raised = need if hard == resource.RLIM_INFINITY else min(need, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (raised, hard))
+            soft = raised
+        except (ValueError, OSError) as e:
+            logging.warning(f'{e}: RLIMIT_NOFILE stays at {soft}')
+    if soft == resource.RLIM_INFINITY:
+        return wanted
+
+    fits = max((soft - AsyncEngine.fdsReserved) // AsyncEngine.fdsPerCommand, 1)
+    if fits < wanted:
+        logging.warning(f'--async-concurrency {wanted} needs {need} file '
+                        f'descriptors, RLIMIT_NOFILE allows {fits} commands')
+    return min(wanted, fits)
+
+
+class _Driven(NamedTuple):
+    '''fn, for a multiprocessing pool: drives the coroutine it returns'''
+    fn: Callable[[Any], Coroutine[Any, Any, Any]]
+
+    def __call__(self, arg: Any) -> Any:
+        return drive(self.fn(arg))
+
+
+class DrivenPool:
+    '''
+    map and imap of a coroutine function over a multiprocessing pool, each
+    worker driving one coroutine at a time (see kotai.kotypes.drive)
+    '''
+
+    # ---------------------------- Member attrs. ---------------------------- #
+
+    __slots__ = (
+        'pool',
+    )
+
+    def __init__(self, pool: PoolType):
+        self.pool = pool
+
+    def imap(self, fn: Callable[[_T], Coroutine[Any, Any, _R]],
+             iterable: Iterable[_T], chunksize: int = 1) -> Iterator[_R]:
+        return self.pool.imap(_Driven(fn), iterable, chunksize)
+
+    def map(self, fn: Callable[[_T], Coroutine[Any, Any, _R]],
+            iterable: Iterable[_T], chunksize: int | None = None) -> list[_R]:
+        return self.pool.map(_Driven(fn), iterable, chunksize)
+
+    def close(self) -> None:
+        self.pool.close()
+
+    def join(self) -> None:
+        self.pool.join()
+
+
+class AsyncPool:
+    '''
+    map and imap of a coroutine function as tasks of an AsyncEngine, all
+    started at once: the engine's semaphore bounds the commands in flight.
+    The chunksize is only there for the interface of the other pools.
+    '''
+
+    # ---------------------------- Member attrs. ---------------------------- #
+
+    __slots__ = (
+        'engine',
+        'tasks',
+    )
+
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+        self.tasks: list['concurrent.futures.Future[Any]'] = []
+
+    def imap(self, fn: Callable[[_T], Coroutine[Any, Any, _R]],
+             iterable: Iterable[_T], chunksize: int = 1) -> Iterator[_R]:
+        tasks = [self.engine.run(fn(arg)) for arg in iterable]
+        self.tasks += tasks
+        return (task.result() for task in tasks)
+
+    def map(self, fn: Callable[[_T], Coroutine[Any, Any, _R]],
+            iterable: Iterable[_T], chunksize: int | None = None) -> list[_R]:
+        return list(self.imap(fn, iterable))
+
+    def close(self) -> None:
+        pass
+
+    def join(self) -> None:
+        concurrent.futures.wait(self.tasks)
+        self.tasks = []
+
+
+@contextmanager
+def newPool(kind: ExecutorKind, nproc: int,
+            maxtasksperchild: int | None = None) -> Iterator[DrivenPool | AsyncPool]:
+    '''
+    Pool of the given kind, with nproc workers (process, thread) or nproc
+    commands in flight (async, see asyncConcurrency), whose map and imap
+    take a coroutine function
+    '''
+    match kind:
+        case 'thread':
+            with ThreadPool(nproc) as pool:
+                yield DrivenPool(pool)
+
+        case 'async':
+            # A single thread for every worker, see the top of this module
+            engine = AsyncEngine(nproc)
+            try:
+                yield AsyncPool(engine)
+            finally:
+                engine.close()
+
+        case _:
+            with Pool(nproc, maxtasksperchild=maxtasksperchild) as pool:
+                yield DrivenPool(pool)
+
+
+
+# =========================================================================== #
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# =========================================================================== #
+
+import difflib
+import logging
+import re
+import time
+from pathlib import Path
+from typing import Final, Literal, NamedTuple
+
+from kotai.cache import digest
+from kotai.kotypes import CmdResult, ExitCode, KonstrainExecType, ResultKind
+from kotai.plugin.Jotai import Jotai
+from kotai.results import recordStage
+from kotai.templates.benchmark import indent
+
+# --------------------------------------------------------------------------- #
+'''
+Native generator of the switch cases of a genBench (--generator), in the
+process that already has the descriptor and the constraints, instead of a
+Jotai call per (benchmark, ket).
+
+The descriptor (PrintDescriptors) and constraints (Konstrain) are read with
+the grammars below, which are strict: any line that doesn't fit makes the
+generator give up on that ket, and the Jotai binary is run for it instead.
+
+    descriptor      function <name> <return type>
+                    <param type> <param name>     (one line per param)
+                    no-params                     (instead, if none)
+
+    constraints     <param name> <min> <max>           scalar in [min, max]
+                    <param name> [<length>] <min> <max>
+                                                  pointer to <length> elements
+
+Types are arithmetic C types, with at most one '*' for the params that have
+a [<length>]. The case declares every param, initialized to <min> (every
+element, for pointers), calls the function and frees the pointers. That's
+this module's reading of the formats, not Jotai's per-ket value selection,
+which it doesn't know: <max> isn't used, so every ket gets the same case,
+and its cases are not Jotai's. It never replaces Jotai's output.
+
+--generator diff runs both and keeps Jotai's output, but adds a 'generator'
+row per ket to the results (kotai.results): ok if both outputs are the same
+(up to whitespace at the ends), fail otherwise, with the diff in the log.
+The row lists generatorVersion as its artifact. A descriptor or constraints
+file that can't be read makes the generator fail on it (logged), instead of
+raising in the worker.
+'''
+# --------------------------------------------------------------------------- #
+
+GeneratorMode = Literal['jotai', 'diff']
+
+GeneratorModes: Final[list[GeneratorMode]] = ['jotai', 'diff']
+
+# Words of the types the generator knows how to initialize
+_arithmetic: Final[frozenset[str]] = frozenset({
+    'char', 'short', 'int', 'long', 'signed', 'unsigned', 'float', 'double',
+    '_Bool', 'bool', 'size_t', 'ssize_t', 'ptrdiff_t',
+    'int8_t', 'int16_t', 'int32_t', 'int64_t',
+    'uint8_t', 'uint16_t', 'uint32_t', 'uint64_t',
+    'const', 'volatile',
+})
+
+_ident  = re.compile(r'[A-Za-z_]\w*')
+_number = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?[uUlLfF]*')
+_length = re.compile(r'\[(\d+)\]')
+
+
+class GeneratorError(ValueError):
+    '''The descriptor or constraints don't fit the grammars of this module'''
+
+
+class Param(NamedTuple):
+    name: str
+    ctype: str          # without the '*'
+    pointers: int
+
+
+class Descriptor(NamedTuple):
+    fnName: str
+    retType: str
+    params: tuple[Param, ...]
+
+
+class Bound(NamedTuple):
+    name: str
+    length: int | None  # None for scalars
+    lo: str
+    hi: str
+
+
+# --------------------------------------------------------------------------- #
+
+def _splitType(words: list[str]) -> tuple[str, int]:
+    '''(type without '*', number of '*') of the words of a C type'''
+    text = ' '.join(words)
+    pointers = text.count('*')
+    ctype = ' '.join(text.replace('*', ' ').split())
+    if not ctype or not set(ctype.split()) <= _arithmetic:
+        raise GeneratorError(f'Unsupported type: {text}')
+    return ctype, pointers
+
+
+def parseDescriptor(text: str) -> Descriptor:
+    lines = [line.split() for line in text.splitlines() if line.strip()]
+    if not lines or lines[0][0] != 'function' or len(lines[0]) < 3:
+        raise GeneratorError(f'Not a descriptor: {lines[:1]}')
+
+    fnName = lines[0][1]
+    if not _ident.fullmatch(fnName):
+        raise GeneratorError(f'Bad function name: {fnName}')
+    retType = ' '.join(lines[0][2:])
+
+    if lines[1:] == [['no-params']]:
+        return Descriptor(fnName, retType, ())
+
+    params: list[Param] = []
+    for words in lines[1:]:
+        # 'int *p' and 'int* p' are the same param
+        name = words[-1].lstrip('*')
+        if len(words) < 2 or not _ident.fullmatch(name):
+            raise GeneratorError(f'Bad param: {" ".join(words)}')
+        params.append(Param(name, *_splitType(words[:-1] + ['*'] * words[-1].count('*'))))
+    return Descriptor(fnName, retType, tuple(params))
+
+
+def parseConstraints(text: str, descriptor: Descriptor) -> list[Bound]:
+    '''Bounds of every param of descriptor, in the order of its params'''
+    bounds: dict[str, Bound] = {}
+    for line in text.splitlines():
+        if not (words := line.split()):
+            continue
+        length = None
+        if len(words) == 4 and (m := _length.fullmatch(words[1])):
+            length = int(m[1])
+            del words[1]
+        if len(words) != 3 or not all(_number.fullmatch(w) for w in words[1:]):
+            raise GeneratorError(f'Bad constraint: {line}')
+        if words[0] in bounds:
+            raise GeneratorError(f'Param constrained twice: {words[0]}')
+        bounds[words[0]] = Bound(words[0], length, words[1], words[2])
+
+    params = {p.name for p in descriptor.params}
+    if set(bounds) != params:
+        raise GeneratorError(f'Constraints for {sorted(bounds)}, params {sorted(params)}')
+    return [bounds[p.name] for p in descriptor.params]
+
+
+def genCase(descriptor: Descriptor, bounds: list[Bound]) -> str:
+    '''Body of the switch case for descriptor, as genSwitch takes it'''
+    decls: list[str] = []
+    frees: list[str] = []
+    for p, b in zip(descriptor.params, bounds):
+        if p.pointers == 0 and b.length is None:
+            decls.append(f'{p.ctype} {p.name} = {b.lo};')
+        elif p.pointers == 1 and b.length is not None:
+            decls += [f'{p.ctype} *{p.name} = malloc({b.length} * sizeof({p.ctype}));',
+                      f'for (int _i = 0; _i < {b.length}; ++_i) {p.name}[_i] = {b.lo};']
+            frees.append(f'free({p.name});')
+        else:
+            raise GeneratorError(f'Bound {b} doesn\'t fit param {p}')
+
+    call = f'{descriptor.fnName}({", ".join(p.name for p in descriptor.params)});'
+    body = [*decls, call, *frees]
+    return '{\n' + ''.join(f'{indent*3}{line}\n' for line in body) + f'{indent*2}}}'
+
+
+def generate(descriptorText: str, constraintsText: str) -> CmdResult:
+    '''Same as Jotai's CmdResult for these inputs, ERR if they don't parse'''
+    try:
+        descriptor = parseDescriptor(descriptorText)
+        return CmdResult(genCase(descriptor, parseConstraints(constraintsText, descriptor)),
+                         ExitCode.OK)
+    except GeneratorError as e:
+        return CmdResult(f'{e}', ExitCode.ERR)
+
+
+def _read(path: Path) -> str | None:
+    try: return path.read_text(encoding='utf-8')
+    except (OSError, UnicodeDecodeError) as e:
+        logging.error(f'{e}: generator input [{path}]')
+        return None
+
+
+# Part of the key of the genBenches made with this module: changing it
+# invalidates them
+generatorDigest: str = digest(Path(__file__).read_bytes())
+
+# What the --generator diff rows checked
+generatorVersion: str = f'generator@{generatorDigest[:16]}'
+
+
+# --------------------------------------------------------------------------- #
+
+class Generator:
+
+    # ---------------------------- Static attrs. ---------------------------- #
+
+    # [--generator] Who writes the switch cases, see the top of this module
+    mode: GeneratorMode = 'jotai'
+
+    @staticmethod
+    async def runbatch(bench: Path, kets: list[KonstrainExecType], descriptorPath: Path,
+                       constraintsPaths: list[Path]) -> list[CmdResult]:
+        '''Same as Jotai.runbatch, with Generator.mode deciding who runs'''
+        if Generator.mode == 'jotai' or not kets:
+            return await Jotai.runbatch(constraintsPaths, descriptorPath)
+
+        # diff: the generator is only checked against Jotai, unreadable
+        # inputs included
+        start = time.monotonic()
+        descriptorText = _read(descriptorPath)
+        native = [generate(descriptorText, constraintsText)
+                  if descriptorText is not None
+                  and (constraintsText := _read(c)) is not None
+                  else CmdResult(f'Unreadable inputs of {c}', ExitCode.ERR)
+                  for c in constraintsPaths]
+        seconds = (time.monotonic() - start) / len(kets)
+
+        # Jotai's output is kept
+        jotai = await Jotai.runbatch(constraintsPaths, descriptorPath)
+        for ket, mine, theirs in zip(kets, native, jotai):
+            same = mine.err == theirs.err and (mine.err != ExitCode.OK
+                                               or mine.msg.strip() == theirs.msg.strip())
+            recordStage(bench, 'generator', ResultKind.OK if same else ResultKind.FAIL,
+                        seconds, Path(generatorVersion), ket=ket)
+            if not same:
+                diff = difflib.unified_diff(theirs.msg.strip().splitlines(),
+                                            mine.msg.strip().splitlines(),
+                                            'jotai', 'generator', lineterm='')
+                logging.warning(f'Generator differs from Jotai on {bench} {ket}:\n'
+                                + '\n'.join(diff))
+        return jotai
+
+
+
+# =========================================================================== #
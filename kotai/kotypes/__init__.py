@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 # =========================================================================== #
 
-from typing import Callable, Final, Generic, Iterator, Iterable, NamedTuple, Literal, Any, TypeAlias, TypeGuard, TypeVar, final
+from typing import Awaitable, Callable, Coroutine, Final, Generator, Generic, Iterator, Iterable, NamedTuple, Literal, Any, TypeAlias, TypeGuard, TypeVar, final
+from contextvars import ContextVar
 from enum import Enum
 from pathlib import Path
 import subprocess as sp
 import logging
+import os
+import resource
+import selectors
+import shutil
+import signal
+import time
 
 def noop(*args: Any, **kwargs: Any): pass
 
@@ -111,6 +118,58 @@ success: Final[Success] = ExitCode.OK
 failure: Final[Failure] = ExitCode.ERR
 '''Value representing failure'''
 
+# ---------------------------------- Bench table ---------------------------- #
+'''
+[IPC] A BenchInfo crosses the process boundary of the pool twice per stage
+(task and result), so its pickled form is kept small (see BenchInfo.__reduce__):
+
+    cFilePath       index in the bench table, when it's there
+    ketList         one byte per ket (index in KonstrainExecTypes)
+    optLevelList    one byte per optLevel (index in OptLevels)
+    exitCodes       bools instead of ExitCode members
+
+The bench table holds the cFilePaths of the benchDir being run. The parent
+sets it (setBenchTable) before creating the pool, and the workers inherit it
+when they're forked, like the rest of the static state (Clang.pch, ...). The
+descriptor of a benchmark never travels: it stays in <bench>.d/descriptor,
+where Konstrain reads it.
+'''
+
+_benchTable: list[Path]      = []
+_benchIndex: dict[Path, int] = {}
+
+def setBenchTable(paths: Iterable[Path]) -> None:
+    '''Sets the bench table, before the pool is created'''
+    global _benchTable, _benchIndex
+    _benchTable = list(paths)
+    _benchIndex = {path: i for i, path in enumerate(_benchTable)}
+
+
+def _packNames(values: list[str], names: list) -> bytes | list[str]:
+    if all(v in names for v in values):
+        return bytes(names.index(v) for v in values)
+    return values
+
+def _unpackNames(packed: bytes | list[str], names: list) -> list:
+    if isinstance(packed, bytes):
+        return [names[i] for i in packed]
+    return packed
+
+
+def _unpackBenchInfo(path: int | Path, fnName: str, kets: bytes | list[str],
+                     optLevels: bytes | list[str], exitCodes: dict[Any, bool],
+                     cacheHits: dict[str, bool], samples: list['CmdSample'],
+                     stages: list['StageRecord']) -> 'BenchInfo':
+    return BenchInfo(_benchTable[path] if isinstance(path, int) else path,
+                     fnName,
+                     _unpackNames(kets, KonstrainExecTypes),
+                     _unpackNames(optLevels, OptLevels),
+                     {k: success if v else failure for k, v in exitCodes.items()},
+                     cacheHits, samples, stages)
+
+
+# ---------------------------------- BenchInfo ------------------------------ #
+
 class BenchInfo:
     __slots__ = (
                  'cFilePath',
@@ -118,24 +177,45 @@ class BenchInfo:
                  'ketList',
                  'optLevelList',
                  'exitCodes',
-                 'descriptor'
+                 'cacheHits',
+                 'samples',
+                 'stages',
                  )
 
     def __init__(self,
                  cFilePath: Path,
                  fnName: str = '',
-                 ketList: list[KonstrainExecType] = [],
-                 optLevelList: list[OptLevel] = [],
-                 exitCodes: dict[Any, ExitCode] = {},
-                 descriptor: str = '',
+                 ketList: list[KonstrainExecType] | None = None,
+                 optLevelList: list[OptLevel] | None = None,
+                 exitCodes: dict[Any, ExitCode] | None = None,
+                 cacheHits: dict[str, bool] | None = None,
+                 samples: list['CmdSample'] | None = None,
+                 stages: list['StageRecord'] | None = None,
             ) -> None:
 
         self.cFilePath: Path                  = cFilePath
         self.fnName: str                      = fnName
-        self.ketList: list[KonstrainExecType] = ketList
-        self.optLevelList: list[OptLevel]     = optLevelList
-        self.exitCodes: dict[Any, ExitCode]   = exitCodes
-        self.descriptor: str                  = descriptor
+        self.ketList: list[KonstrainExecType] = ketList if ketList is not None else []
+        self.optLevelList: list[OptLevel]     = optLevelList if optLevelList is not None else []
+        self.exitCodes: dict[Any, ExitCode]   = exitCodes if exitCodes is not None else {}
+
+        # Stage -> whether it was skipped thanks to the manifest (last stage)
+        self.cacheHits: dict[str, bool]       = cacheHits or {}
+
+        # Tool runtimes recorded by the worker, collected by the parent
+        self.samples: list[CmdSample]         = samples or []
+
+        # Stage outcomes recorded by the worker, stored by the parent
+        self.stages: list[StageRecord]        = stages or []
+
+    def __reduce__(self):
+        '''[IPC] Compact pickle, see the bench table'''
+        return (_unpackBenchInfo, (_benchIndex.get(self.cFilePath, self.cFilePath),
+                                   self.fnName,
+                                   _packNames(self.ketList, KonstrainExecTypes),
+                                   _packNames(self.optLevelList, OptLevels),
+                                   {k: bool(v) for k, v in self.exitCodes.items()},
+                                   self.cacheHits, self.samples, self.stages))
 
     #def __bool__(self): return bool(self.exitCode)
     def __bool__(self): return any(self.exitCodes.values())
@@ -160,10 +240,68 @@ def foo(result: BenchInfo | Failure) -> str:
 
 SysExitCode = ExitCode | str
 
-# CmdResult just models (result,errcode) as (str,int)
+class ResultKind(Enum):
+    OK      = 'ok'
+    FAIL    = 'fail'
+    TIMEOUT = 'timeout'
+    LIMIT   = 'limit'
+
+class Rusage(NamedTuple):
+    '''Resources used by a child process (os.wait4), or a sum of them'''
+    wall: float         # seconds
+    user: float         # CPU seconds, user mode
+    sys: float          # CPU seconds, kernel mode
+    maxRss: int         # KiB
+    signal: int = 0     # signal that killed the child, 0 if it exited
+
+def sumUsage(usages: Iterable['Rusage | None']) -> 'Rusage | None':
+    '''Sum of usages (largest maxRss, first signal), None if none is known'''
+    known = [u for u in usages if u is not None]
+    if not known:
+        return None
+    return Rusage(sum(u.wall for u in known), sum(u.user for u in known),
+                  sum(u.sys for u in known), max(u.maxRss for u in known),
+                  next((u.signal for u in known if u.signal), 0))
+
+# CmdResult just models (result,errcode) as (str,int), plus whether the
+# command was killed by its timeout, its actual exit status, the resources
+# it used (None if unknown, e.g. with the async engine) and whether it
+# failed on one of its Limits
 class CmdResult(NamedTuple):
     msg: str
     err: ExitCode = failure
+    timedOut: bool = False
+    returncode: int | None = None
+    usage: Rusage | None = None
+    limited: bool = False
+    stderr: str = ''
+
+    @property
+    def kind(self) -> ResultKind:
+        if self.timedOut: return ResultKind.TIMEOUT
+        if self.limited:  return ResultKind.LIMIT
+        return ResultKind.OK if self.err == ExitCode.OK else ResultKind.FAIL
+
+
+class CmdSample(NamedTuple):
+    '''Wall time of one runproc call of a tool, how it ended and its usage'''
+    tool: str
+    seconds: float
+    kind: ResultKind
+    usage: Rusage | None = None
+
+
+class StageRecord(NamedTuple):
+    '''Outcome of one stage for one (benchmark, ket, optLevel), see kotai.results'''
+    bench: str
+    stage: str
+    ket: str
+    optLevel: str
+    kind: ResultKind
+    seconds: float
+    cached: bool
+    artifacts: tuple[str, ...] = ()
+    usage: Rusage | None = None
 
 
 # When returning, if logging is desired, this allows `return logret(msg, ret)`
@@ -207,36 +345,340 @@ def out2file(ret: CmdResult, ofpath: Path, breakLines: bool) -> CmdResult:
         return ret
 
 
+class Limits(NamedTuple):
+    '''
+    Resource limits of a tool (--limit), None for unlimited. They're the soft
+    limits the tool starts with (and the hard one for the CPU, so SIGKILL
+    follows SIGXCPU), see spawnLimits, and inherited by its own children,
+    e.g. the benchmark under valgrind, which honors RLIMIT_CORE for its
+    vgcore files too.
+    '''
+    core: int | None = 0            # bytes of a core dump (0: no core dumps)
+    addressSpace: int | None = None # bytes, malloc fails past it
+    cpu: int | None = None          # CPU seconds, SIGXCPU (SIGKILL 1s later)
+    fileSize: int | None = None     # bytes of a file written, SIGXFSZ
+
+# Limits of the tools without their own (see setLimits)
+_defaultLimits: Limits = Limits()
+_toolLimits: dict[str, Limits] = {}
+
+# util-linux's prlimit, which starts a tool with its limits (see spawnLimits)
+_prlimit: str | None = shutil.which('prlimit')
+
+def setLimits(default: Limits, perTool: dict[str, Limits] | None = None) -> None:
+    '''
+    Also sets the core limit of default on this process, which it doesn't
+    get in the way of, so the tools without their own inherit it and start
+    without any wrapper
+    '''
+    global _defaultLimits, _toolLimits
+    _defaultLimits, _toolLimits = default, dict(perTool or {})
+    if default.core is not None:
+        hard = resource.getrlimit(resource.RLIMIT_CORE)[1]
+        soft = default.core if hard == resource.RLIM_INFINITY else min(default.core, hard)
+        try: resource.setrlimit(resource.RLIMIT_CORE, (soft, hard))
+        except (OSError, ValueError) as e:
+            logging.warning(f'{e}: core limit {soft} of Kotai')
+    if _prlimit is None and any(_wanted(limits) for limits in [default, *_toolLimits.values()]):
+        logging.warning('No prlimit in PATH: tools get their limits from a '
+                        'preexec_fn, slower and not safe with threads')
+
+def limitsOf(tool: str) -> Limits:
+    return _toolLimits.get(tool, _defaultLimits)
+
+def _wanted(limits: Limits) -> list[tuple[str, int, int, int]]:
+    '''
+    (prlimit option, rlimit, soft, hard) of the limits that differ from
+    those of this process, within its hard limits, which can't be raised
+    '''
+    wanted = []
+    for option, rlimit, value in (('core',  resource.RLIMIT_CORE,  limits.core),
+                                  ('as',    resource.RLIMIT_AS,    limits.addressSpace),
+                                  ('cpu',   resource.RLIMIT_CPU,   limits.cpu),
+                                  ('fsize', resource.RLIMIT_FSIZE, limits.fileSize)):
+        if value is None:
+            continue
+        soft, hard = resource.getrlimit(rlimit)
+        clamp = (lambda v: v) if hard == resource.RLIM_INFINITY else (lambda v: min(v, hard))
+        want = (clamp(value), clamp(value + 1) if rlimit == resource.RLIMIT_CPU else hard)
+        if want != (soft, hard):
+            wanted.append((option, rlimit, *want))
+    return wanted
+
+def spawnLimits(limits: Limits) -> tuple[list[str], Callable[[], None] | None]:
+    '''
+    (argv prefix, preexec_fn) that start a tool with limits. Neither for the
+    limits it inherits anyway (see setLimits), prlimit, which sets them and
+    execs the tool, otherwise. A preexec_fn only without prlimit: it isn't
+    safe in a process with threads, and takes Popen off its vfork path.
+    '''
+    if not (wanted := _wanted(limits)):
+        return [], None
+    if _prlimit is not None:
+        return [_prlimit, *[f'--{option}={soft}:'
+                            f'{"unlimited" if hard == resource.RLIM_INFINITY else hard}'
+                            for option, _, soft, hard in wanted], '--'], None
+
+    def preexec() -> None:
+        for _, rlimit, soft, hard in wanted:
+            try: resource.setrlimit(rlimit, (soft, hard))
+            except (OSError, ValueError):
+                pass
+    return [], preexec
+
+def killGroup(pid: int) -> None:
+    '''Kills the process group of the tool started as pid, grandchildren included'''
+    try: os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+# What tools print when malloc fails, e.g. past Limits.addressSpace
+_outOfMemory: tuple[str, ...] = ('out of memory', 'Cannot allocate memory',
+                                 'bad_alloc', 'MemoryError')
+
+def limitHit(returncode: int, err: str, limits: Limits,
+             ru: resource.struct_rusage | None) -> bool:
+    '''Whether a command that ended with returncode failed on one of limits'''
+    if limits.cpu is not None and (
+            returncode == -signal.SIGXCPU
+            or (returncode == -signal.SIGKILL and ru is not None
+                and ru.ru_utime + ru.ru_stime >= limits.cpu)):
+        return True
+    # Tools that ignore SIGXFSZ (e.g. python) get EFBIG instead
+    if limits.fileSize is not None and returncode != 0 and (
+            returncode == -signal.SIGXFSZ or 'File too large' in err):
+        return True
+    # Best effort: a failed malloc has no signal of its own
+    return (limits.addressSpace is not None and returncode != 0
+            and any(m in err for m in _outOfMemory))
+
+
+ProcEngine = Callable[[list[str], float, Limits],
+                      tuple[str, str, int, bool, resource.struct_rusage | None]]
+'''
+Runs (proc_args, timeout, limits) in a child process, the leader of a new
+process group (session), with limits (see spawnLimits). The whole group is
+killed on timeout, never once the child has been reaped, since its id may
+belong to another group by then. Returns its (stdout, stderr, returncode,
+timedOut, rusage), rusage being None if the engine can't tell. Exceptions
+are handled by runproc
+'''
+
+def _popen(proc_args: list[str], timeout: float, limits: Limits
+           ) -> tuple[str, str, int, bool, resource.struct_rusage | None]:
+    '''
+    Default ProcEngine, blocks the calling thread on subprocess.Popen. The
+    output and the exit are waited for here, like communicate would, but
+    the child is reaped here too, with os.wait4 for its rusage, after what's
+    left of its group (e.g. a daemonized grandchild) is killed
+    '''
+    prefix, preexec = spawnLimits(limits)
+    proc = sp.Popen(prefix + proc_args, close_fds=True, stdout=sp.PIPE,
+                    stderr=sp.PIPE, start_new_session=True, preexec_fn=preexec)
+    assert proc.stdout is not None and proc.stderr is not None
+
+    deadline = time.monotonic() + timeout
+    timedOut = False
+    output: dict[int, list[bytes]] = {proc.stdout.fileno(): [],
+                                      proc.stderr.fileno(): []}
+
+    def expired() -> bool:
+        nonlocal timedOut
+        if not timedOut and time.monotonic() >= deadline:
+            logging.error(f'Command {proc_args} timed out after {timeout} seconds')
+            timedOut = True
+            killGroup(proc.pid)  # Not reaped yet
+        return timedOut
+
+    try:
+        with selectors.DefaultSelector() as sel:
+            for fd in output:
+                sel.register(fd, selectors.EVENT_READ)
+            while sel.get_map():
+                wait = None if expired() else deadline - time.monotonic()
+                for key, _ in sel.select(wait):
+                    if chunk := os.read(key.fd, 1 << 16):
+                        output[key.fd].append(chunk)
+                    else:
+                        sel.unregister(key.fd)
+
+        # Exited, but not reaped (WNOWAIT). Usually right away, once the
+        # pipes are closed
+        delay = 0.0005
+        while os.waitid(os.P_PID, proc.pid,
+                        os.WEXITED | os.WNOWAIT | os.WNOHANG) is None:
+            expired()
+            time.sleep(delay if timedOut else min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, 0.05)
+    finally:
+        proc.stdout.close()
+        proc.stderr.close()
+        # Still a zombie (or killed here, if the above failed): its group id
+        # can't be anyone else's yet
+        killGroup(proc.pid)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+    # Universal newlines, as Popen(text=True) would
+    out, err = (b''.join(chunks).decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+                for chunks in output.values())
+    return out, err, proc.returncode, timedOut, rusage
+
+_procEngine: ProcEngine = _popen
+
+def setProcEngine(engine: ProcEngine | None) -> None:
+    '''Changes how runproc runs commands (None restores the default)'''
+    global _procEngine
+    _procEngine = engine if engine else _popen
+
+
+# [--timeout-retry] A command killed by its timeout is run once more with
+# the timeout multiplied by this (0: no retries)
+_retryEscalation: float = 0.0
+
+def setTimeoutRetry(escalation: float) -> None:
+    global _retryEscalation
+    _retryEscalation = escalation
+
+
+# CmdSamples of the runproc calls made by the current thread (or task of the
+# async executor, which runs each one in its own context), see drainSamples
+_samples: ContextVar[list[CmdSample]] = ContextVar('samples')
+
+def pendingSamples() -> list[CmdSample]:
+    '''CmdSamples recorded by the calling thread since the last drainSamples'''
+    return _samples.get([])
+
+def drainSamples() -> list[CmdSample]:
+    '''Returns and forgets the CmdSamples recorded by the calling thread'''
+    samples = _samples.get([])
+    _samples.set([])
+    return samples
+
+def recordSample(sample: CmdSample) -> None:
+    '''Records a command that didn't go through runproc, see drainSamples'''
+    if (samples := _samples.get(None)) is None:
+        _samples.set(samples := [])
+    samples.append(sample)
+
+
+# ------------------------------ Tool coroutines ---------------------------- #
+'''
+The tools and the worker functions of the pipeline are coroutines, which
+await two things only: a Spawn (a command, see arunproc) and blocking (any
+other call that may block, e.g. on a lock). They don't run on an event loop
+of their own, but are driven by the executor:
+
+    drive           runs a coroutine in the calling thread, each Spawn with
+                    the ProcEngine and each blocking call right away (the
+                    process and thread executors, and runproc)
+    AsyncPool       runs each one as a task of an event loop, each Spawn with
+                    the AsyncEngine and each blocking call in a thread of the
+                    loop's executor (the async executor, see kotai.executor)
+
+So the same code runs one command at a time per thread, or as many as the
+async executor allows from a single thread.
+'''
+
+_R = TypeVar('_R')
+
+class Spawn(NamedTuple):
+    '''A command for the ProcEngine, awaited by arunproc'''
+    proc_args: list[str]
+    timeout: float
+    limits: Limits
+
+    def run(self) -> tuple[str, str, int, bool, resource.struct_rusage | None]:
+        return _procEngine(self.proc_args, self.timeout, self.limits)
+
+    def __await__(self) -> Generator[Any, Any, Any]:
+        return (yield self)
+
+
+class _Blocking(NamedTuple):
+    fn: Callable[[], Any]
+
+    def run(self) -> Any:
+        return self.fn()
+
+    def __await__(self) -> Generator[Any, Any, Any]:
+        return (yield self)
+
+def blocking(fn: Callable[[], _R]) -> Awaitable[_R]:
+    '''
+    fn(), for a tool coroutine: in another thread with the async executor,
+    whose CmdSamples (see recordSample) are not the caller's
+    '''
+    return _Blocking(fn)
+
+
+def drive(coro: Coroutine[Any, Any, _R]) -> _R:
+    '''Runs a tool coroutine to its end in the calling thread, see Spawn'''
+    value: Any = None
+    send: Callable[[Any], Any] = coro.send
+    while True:
+        try: step = send(value)
+        except StopIteration as stop:
+            return stop.value
+        try: value, send = step.run(), coro.send
+        except Exception as e:
+            value, send = e, coro.throw
+
+
 def runproc(proc_args: list[str], timeout: float,
-            ofpath: Path | None = None, breakLines: bool = False) -> CmdResult:
+            ofpath: Path | None = None, breakLines: bool = False,
+            tool: str = '') -> CmdResult:
+    '''arunproc, in the calling thread'''
+    return drive(arunproc(proc_args, timeout, ofpath, breakLines, tool))
+
+
+async def arunproc(proc_args: list[str], timeout: float,
+                   ofpath: Path | None = None, breakLines: bool = False,
+                   tool: str = '') -> CmdResult:
     '''
     Wrapper to subprocces.run that tries to: run, decode, write, return
     Exceptions raised are converted to error-values
 
     - runs command with args and a timeout, provided in proc_args and timeout
+      (see setProcEngine), retrying once on timeout (see setTimeoutRetry)
+    - records its runtime and usage under tool, if given (see drainSamples)
     - decodes the result
     - writes it to ofpath when defined, and
     - returns it with the proper ExitCode
     '''
 
-    try: proc = sp.Popen(proc_args, text=True, close_fds=True,
-                         stdout=sp.PIPE, stderr=sp.PIPE, encoding='utf-8')
+    res = await _runproc(proc_args, timeout, tool)
+    if res.timedOut and _retryEscalation > 0:
+        logging.info(f'Retrying {proc_args} with a '
+                     f'{timeout * _retryEscalation}s timeout')
+        res = await _runproc(proc_args, timeout * _retryEscalation, tool)
+
+    return out2file(res, ofpath, breakLines) if ofpath else res
+
+
+async def _runproc(proc_args: list[str], timeout: float, tool: str) -> CmdResult:
+    start  = time.monotonic()
+    limits = limitsOf(tool)
 
     # Common exceptions(s): OSError, ValueError
+    try: out, err, returncode, timedOut, ru = await Spawn(proc_args, timeout, limits)
     except Exception as e:
         return logret(e)
+    wall = time.monotonic() - start
 
-    # Common exceptions(s): TimeoutExpired
-    try: proc.communicate(timeout=timeout)
-    except Exception as e: logging.error(f'{e}:"{proc.args}"')
-
-    proc.kill()  # After this point, proc.returncode can't be None
-    out, err = proc.communicate()  # Results
     if out: logging.debug(f'{out=}')
     if err: logging.error(f'{err=}')
 
-    res = CmdResult(out, ExitCode.ERR if proc.returncode else ExitCode.OK)
-    return out2file(res, ofpath, breakLines) if ofpath else res
+    usage = (Rusage(wall, ru.ru_utime, ru.ru_stime, ru.ru_maxrss,
+                    max(-returncode, 0)) if ru else None)
+    limited = not timedOut and limitHit(returncode, err, limits, ru)
+    if limited:
+        logging.error(f'Command {proc_args} stopped by its limits {limits}')
+    res = CmdResult(out, ExitCode.ERR if returncode else ExitCode.OK, timedOut,
+                    returncode, usage, limited, err)
+    if tool:
+        recordSample(CmdSample(tool, wall, res.kind, usage))
+    return res
 
 
 
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# =========================================================================== #
+
+import logging
+import os
+import time
+from collections import deque
+from pathlib import Path
+from typing import Iterable
+
+from kotai.cache import tmpPath
+from kotai.kotypes import CmdSample, ResultKind, Rusage, StageRecord
+from kotai.results import TaskStages
+
+# --------------------------------------------------------------------------- #
+'''
+Live metrics of a run (--progress, --metrics).
+
+The counters are only updated by the parent, from the StageRecords that the
+workers already send back with their results (see _tally), so workers don't
+do any extra work for them. Per stage (the stage of kotai.results):
+
+    submitted   records expected, as declared by the parent (Metrics.submit)
+    ok, fail, timeout, limit
+    in flight   submitted - (ok + fail + timeout + limit), never negative
+    p50, p95    latency of the most recent Metrics.window records that
+                actually ran (cached and 'pipeline' ones are only counted)
+
+Every Metrics.interval seconds, Metrics.tick prints a progress line for the
+stage submitted last (throughput since its first submission and its ETA),
+and rewrites --metrics in the Prometheus textfile format, for the textfile
+collector of node_exporter.
+
+The resources used by the child processes (kotai.kotypes.Rusage) are summed
+per tool, from the CmdSamples, and per stage, from the StageRecords: see
+Metrics.usageSummary, printed at the end of the run.
+
+Idle core time (Metrics.idleSummary, also printed at the end): the
+Metrics.workers pool workers were available from the first submission of a
+pool task to the last record of one, and busy for the seconds of the records
+of the pool tasks (kotai.results.TaskStages, cached ones included). The
+difference is the time cores waited: on the last tasks of a stage, between
+windows... Per stage too, without --stream (where stages overlap), over the
+time from each submission of the stage (once per --window) to its last
+record.
+'''
+# --------------------------------------------------------------------------- #
+
+class StageMetrics:
+
+    __slots__ = (
+        'submitted',
+        'counts',
+        'latencies',
+        'seconds',
+        'ran',
+        'started',
+        'busy',
+        'last',
+        'wall',
+        'segment',
+    )
+
+    def __init__(self, window: int):
+        self.submitted: int                    = 0
+        self.counts: dict[ResultKind, int]     = {kind: 0 for kind in ResultKind}
+        self.latencies: deque[float]           = deque(maxlen=window)
+        self.seconds: float                    = 0.0
+        self.ran: int                          = 0
+        self.started: float | None             = None
+        self.busy: float                       = 0.0
+        self.last: float | None                = None
+        self.wall: float                       = 0.0
+        self.segment: float | None             = None
+
+    @property
+    def span(self) -> float:
+        '''Time from each submission of the stage to its last record'''
+        if self.segment is None:
+            return self.wall
+        return self.wall + max((self.last or self.segment) - self.segment, 0.0)
+
+    def close(self) -> None:
+        '''Ends the current submission of the stage, see Metrics.idle'''
+        self.wall, self.segment = self.span, None
+
+    @property
+    def done(self) -> int:
+        return sum(self.counts.values())
+
+    @property
+    def inFlight(self) -> int:
+        return max(self.submitted - self.done, 0)
+
+    def quantile(self, q: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class UsageTotals:
+    '''Sum of the Rusage of several child processes'''
+
+    __slots__ = (
+        'runs',
+        'wall',
+        'user',
+        'sys',
+        'maxRss',
+        'signaled',
+    )
+
+    def __init__(self) -> None:
+        self.runs: int     = 0
+        self.wall: float   = 0.0
+        self.user: float   = 0.0
+        self.sys: float    = 0.0
+        self.maxRss: int   = 0
+        self.signaled: int = 0
+
+    def add(self, usage: Rusage) -> None:
+        self.runs     += 1
+        self.wall     += usage.wall
+        self.user     += usage.user
+        self.sys      += usage.sys
+        self.maxRss    = max(self.maxRss, usage.maxRss)
+        self.signaled += bool(usage.signal)
+
+    def row(self) -> list[str]:
+        cpu = self.user + self.sys
+        return [f'{self.runs}', f'{self.wall:.1f}', f'{self.user:.1f}',
+                f'{self.sys:.1f}', f'{100 * cpu / self.wall if self.wall else 0:.0f}',
+                f'{self.maxRss / 1024:.1f}', f'{self.signaled}']
+
+
+class Metrics:
+
+    # ---------------------------- Static attrs. ---------------------------- #
+
+    # [--progress] Seconds between progress lines/metrics writes (0: never)
+    interval: float = 10.0
+
+    # Most recent latencies kept per stage, for the quantiles
+    window: int = 4096
+
+    # Prefix of every Prometheus metric
+    prefix: str = 'kotai'
+
+    # [-j] Pool workers, for the idle core time
+    workers: int = 1
+
+    # ---------------------------- Member attrs. ---------------------------- #
+
+    __slots__ = (
+        'path',
+        'stages',
+        'current',
+        'started',
+        'lastTick',
+        'toolUsage',
+        'stageUsage',
+        'firstTask',
+        'lastTask',
+    )
+
+    def __init__(self, path: Path | None):
+        self.path: Path | None                = path
+        self.stages: dict[str, StageMetrics]  = {}
+        self.current: str                     = ''
+        self.started: float                   = time.monotonic()
+        self.lastTick: float                  = self.started
+        self.toolUsage: dict[str, UsageTotals]  = {}
+        self.stageUsage: dict[str, UsageTotals] = {}
+        self.firstTask: float | None          = None
+        self.lastTask: float | None           = None
+
+    def _stage(self, stage: str) -> StageMetrics:
+        if stage not in self.stages:
+            self.stages[stage] = StageMetrics(Metrics.window)
+        return self.stages[stage]
+
+    def submit(self, stage: str, n: int) -> None:
+        '''n more records of stage are expected, stage is now the current one'''
+        now = time.monotonic()
+        metrics = self._stage(stage)
+        metrics.submitted += n
+        if metrics.started is None:
+            metrics.started = now
+        self.current = stage
+
+        if stage in TaskStages:
+            for other in TaskStages:
+                if other != stage and other in self.stages:
+                    self.stages[other].close()
+            if metrics.segment is None:
+                metrics.segment = now
+            if self.firstTask is None:
+                self.firstTask = now
+
+    def observe(self, records: Iterable[StageRecord]) -> None:
+        now = time.monotonic()
+        for r in records:
+            metrics = self._stage(r.stage)
+            metrics.counts[r.kind] += 1
+            if r.stage in TaskStages:
+                metrics.busy += r.seconds
+                metrics.last = self.lastTask = now
+            # 'pipeline' rows only mark where a benchmark left the pipeline
+            if not r.cached and r.stage != 'pipeline':
+                metrics.latencies.append(r.seconds)
+                metrics.seconds += r.seconds
+                metrics.ran += 1
+            if r.usage:
+                self.stageUsage.setdefault(r.stage, UsageTotals()).add(r.usage)
+
+    def observeSamples(self, samples: Iterable[CmdSample]) -> None:
+        for sample in samples:
+            if sample.usage:
+                self.toolUsage.setdefault(sample.tool, UsageTotals()).add(sample.usage)
+
+    def tick(self, force: bool = False) -> None:
+        '''Progress line and --metrics, at most once per Metrics.interval'''
+        now = time.monotonic()
+        if not force and (Metrics.interval <= 0
+                          or now - self.lastTick < Metrics.interval):
+            return
+        self.lastTick = now
+
+        if Metrics.interval > 0 and (line := self.progress(now)):
+            print(line, flush=True)
+            logging.info(line)
+        if self.path:
+            self.write(now)
+
+    # ----------------------------------------------------------------------- #
+
+    def eta(self, stage: str, now: float) -> tuple[float, float]:
+        '''Throughput (records/s) of stage and seconds left, at that rate'''
+        metrics = self.stages[stage]
+        elapsed = now - (metrics.started or self.started)
+        rate = metrics.done / elapsed if elapsed > 0 else 0.0
+        return rate, (metrics.inFlight / rate if rate > 0 else float('inf'))
+
+    def progress(self, now: float) -> str:
+        if not (metrics := self.stages.get(self.current)):
+            return ''
+        rate, eta = self.eta(self.current, now)
+        return (f'[{_hms(now - self.started)}] {self.current} '
+                f'{metrics.done}/{metrics.submitted} '
+                f'ok {metrics.counts[ResultKind.OK]} '
+                f'fail {metrics.counts[ResultKind.FAIL]} '
+                f'timeout {metrics.counts[ResultKind.TIMEOUT]} '
+                f'limit {metrics.counts[ResultKind.LIMIT]} | '
+                f'{rate:.1f}/s p50 {metrics.quantile(0.5):.2f}s '
+                f'p95 {metrics.quantile(0.95):.2f}s | ETA {_hms(eta)}')
+
+    def prometheus(self, now: float) -> str:
+        p = Metrics.prefix
+        lines = [
+            f'# HELP {p}_stage_records_total Stage outcomes, by stage and kind',
+            f'# TYPE {p}_stage_records_total counter',
+            *[f'{p}_stage_records_total{{stage="{stage}",kind="{kind.value}"}} {n}'
+              for stage, m in self.stages.items() for kind, n in m.counts.items()],
+            f'# HELP {p}_stage_in_flight Stage records expected, not done yet',
+            f'# TYPE {p}_stage_in_flight gauge',
+            *[f'{p}_stage_in_flight{{stage="{stage}"}} {m.inFlight}'
+              for stage, m in self.stages.items()],
+            f'# HELP {p}_stage_latency_seconds Stage wall time (not cached)',
+            f'# TYPE {p}_stage_latency_seconds summary',
+        ]
+        for stage, m in self.stages.items():
+            lines += [f'{p}_stage_latency_seconds{{stage="{stage}",quantile="{q}"}} '
+                      f'{m.quantile(q):.6f}' for q in (0.5, 0.95)]
+            lines += [f'{p}_stage_latency_seconds_sum{{stage="{stage}"}} {m.seconds:.6f}',
+                      f'{p}_stage_latency_seconds_count{{stage="{stage}"}} {m.ran}']
+
+        for label, totals in (('tool', self.toolUsage), ('stage', self.stageUsage)):
+            lines += [
+                f'# HELP {p}_{label}_cpu_seconds_total CPU time of the child processes, by {label}',
+                f'# TYPE {p}_{label}_cpu_seconds_total counter',
+                *[f'{p}_{label}_cpu_seconds_total{{{label}="{k}",mode="{mode}"}} {v:.6f}'
+                  for k, u in totals.items() for mode, v in (('user', u.user), ('system', u.sys))],
+                f'# HELP {p}_{label}_max_rss_bytes Largest max RSS of a child process, by {label}',
+                f'# TYPE {p}_{label}_max_rss_bytes gauge',
+                *[f'{p}_{label}_max_rss_bytes{{{label}="{k}"}} {u.maxRss * 1024}'
+                  for k, u in totals.items()],
+                f'# HELP {p}_{label}_signaled_total Child processes killed by a signal, by {label}',
+                f'# TYPE {p}_{label}_signaled_total counter',
+                *[f'{p}_{label}_signaled_total{{{label}="{k}"}} {u.signaled}'
+                  for k, u in totals.items()],
+            ]
+
+        eta = self.eta(self.current, now)[1] if self.current in self.stages else 0.0
+        lines += [
+            f'# HELP {p}_idle_core_seconds Core time the pool workers spent waiting',
+            f'# TYPE {p}_idle_core_seconds gauge',
+            f'{p}_idle_core_seconds {self.idle()[2]:.3f}',
+            f'# HELP {p}_run_elapsed_seconds Time since the run started',
+            f'# TYPE {p}_run_elapsed_seconds gauge',
+            f'{p}_run_elapsed_seconds {now - self.started:.3f}',
+            f'# HELP {p}_run_eta_seconds Time left in the current stage',
+            f'# TYPE {p}_run_eta_seconds gauge',
+            f'{p}_run_eta_seconds {eta if eta != float("inf") else -1:.3f}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def idle(self, stage: str | None = None) -> tuple[float, float, float]:
+        '''(wall, busy, idle core seconds) of stage, or of every pool task'''
+        if stage is None:
+            wall = ((self.lastTask or 0.0) - self.firstTask
+                    if self.firstTask is not None else 0.0)
+            busy = sum(m.busy for s, m in self.stages.items() if s in TaskStages)
+        elif (metrics := self.stages.get(stage)):
+            wall, busy = metrics.span, metrics.busy
+        else:
+            return 0.0, 0.0, 0.0
+        return wall, busy, max(Metrics.workers * wall - busy, 0.0)
+
+    def idleSummary(self, perStage: bool) -> list[str]:
+        '''Run summary: core time the workers spent waiting (see idle)'''
+        wall, busy, idle = self.idle()
+        if wall <= 0:
+            return []
+        total = Metrics.workers * wall
+        lines = [f'Idle cores: {idle:.1f} of {total:.1f} core-second(s) '
+                 f'({100 * idle / total:.1f}%), {Metrics.workers} worker(s) '
+                 f'over {_hms(wall)}']
+        if perStage:
+            header = ['wall(s)', 'busy(s)', 'idle(s)', 'idle%']
+            lines.append(f'    {"stage":<24}' + ''.join(f'{h:>12}' for h in header))
+            for stage in TaskStages:
+                wall, busy, idle = self.idle(stage)
+                if wall > 0:
+                    lines.append(f'    {stage:<24}' + ''.join(f'{c:>12}' for c in [
+                        f'{wall:.1f}', f'{busy:.1f}', f'{idle:.1f}',
+                        f'{100 * idle / (Metrics.workers * wall):.1f}']))
+        return lines
+
+    def usageSummary(self) -> list[str]:
+        '''Run summary: resources used by the child processes, per tool and stage'''
+        header = ['runs', 'wall(s)', 'user(s)', 'sys(s)', 'cpu%', 'maxRSS(MiB)', 'signaled']
+        lines: list[str] = []
+        for label, totals in (('tool', self.toolUsage), ('stage', self.stageUsage)):
+            if not totals:
+                continue
+            lines.append(f'Resource usage per {label}:')
+            lines.append(f'    {label:<24}' + ''.join(f'{h:>12}' for h in header))
+            lines += [f'    {k:<24}' + ''.join(f'{c:>12}' for c in u.row())
+                      for k, u in sorted(totals.items())]
+        return lines
+
+    def write(self, now: float) -> None:
+        '''--metrics, replaced atomically so the scraper never reads half of it'''
+        assert self.path
+        tmpFile = tmpPath(self.path)
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmpFile, 'w', encoding='utf-8') as fhandle:
+                fhandle.write(self.prometheus(now))
+            os.replace(tmpFile, self.path)
+        except OSError as e:
+            logging.error(f'{e}: metrics [{self.path}]')
+            tmpFile.unlink(missing_ok=True)
+
+
+def _hms(seconds: float) -> str:
+    if seconds == float('inf'):
+        return '--:--:--'
+    minutes, secs = divmod(int(seconds), 60)
+    return f'{minutes // 60}:{minutes % 60:02}:{secs:02}'
+
+
+
+# =========================================================================== #
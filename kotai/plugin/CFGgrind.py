@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 # =========================================================================== #
 
+import os
 from pathlib import Path
-from shutil import which
+from typing import Final, Literal
 
-from kotai.kotypes import ExitCode, CmdResult, runproc
+from kotai.kotypes import ExitCode, CmdResult, arunproc
 
 # --------------------------------------------------------------------------- #
 
+UBScreen = Literal['memcheck', 'sanitizer']
+
+UBScreens: Final[list[UBScreen]] = ['memcheck', 'sanitizer']
+
+
 class CFGgrind:
 
     # ---------------------------- Static attrs. ---------------------------- #
@@ -20,6 +26,22 @@ class CFGgrind:
 
     timeout: float = 3.0
 
+    # Per-subprocess timeouts (see runcmd), CFGgrind.timeout if missing
+    timeouts: dict[str, float] = {}
+
+    # [--ub-screen] How programs with undefined behavior are rejected before
+    # the cfggrind pass: valgrind's memcheck, or a native run of the
+    # <bin>_san build (see Clang.sanitize), much faster, but blind to reads of
+    # uninitialized memory
+    ubScreen: UBScreen = 'memcheck'
+
+    # [--no-memcheck-fallback] Run memcheck when the sanitized run can't tell
+    # whether there is UB (no <bin>_san, crash, non-zero exit, timeout)
+    memcheckFallback: bool = True
+
+    # Exit status of <bin>_san when a sanitizer reports an error
+    sanitizerExitCode: int = 86
+
     # ---------------------------- Member attrs. ---------------------------- #
 
     __slots__ = (
@@ -28,33 +50,47 @@ class CFGgrind:
         'mapFilePath',
         'cfgOutFilePath',
         'cfggInfoOutPath',
+        'memcheckRes',
+        'sanitizerRes',
     )
 
     # ----------------------------------------------------------------------- #
-    def __init__(self, binPath: Path, benchFn: str):
-        self.binPath = b if (b := which(binPath)) else ''
+    def __init__(self, binPath: Path, benchFn: str, ket: str = ''):
+        self.binPath: Path = Path(binPath)
         self.benchFn = benchFn
+        caseStem = str(self.binPath) + (f'_{ket}' if ket else '')
 
-        ''' path/to/benchName.d/benchName_optFlag.map '''
+        ''' path/to/benchName.d/benchName_optFlag.map, shared by every case '''
         self.mapFilePath: Path = Path(str(self.binPath) + '.map')
 
-        ''' path/to/benchName.d/benchName_optFlag.cfg '''
-        self.cfgOutFilePath: Path = Path(str(self.binPath) + '.cfg')
+        ''' path/to/benchName.d/benchName_optFlag[_ket].cfg '''
+        self.cfgOutFilePath: Path = Path(caseStem + '.cfg')
+
+        ''' path/to/benchName.d/benchName_optFlag[_ket].info '''
+        self.cfggInfoOutPath: Path = Path(caseStem + '.info')
+
+        ''' Results of memcheck and <bin>_san in the last runcmd, None if they
+            didn't get to run '''
+        self.memcheckRes: CmdResult | None  = None
+        self.sanitizerRes: CmdResult | None = None
 
-        ''' path/to/benchName.d/benchName_optFlag.map '''
-        self.cfggInfoOutPath: Path = Path(str(self.binPath) + '.info')
+    @property
+    def sanBinPath(self) -> Path:
+        ''' path/to/benchName.d/benchName_optFlag_san '''
+        return Path(str(self.binPath) + '_san')
     # ----------------------------------------------------------------------- #
 
-    def _run_cfggrind_asmmap(self, timeout: float, *args: str) -> CmdResult:
+    async def _run_cfggrind_asmmap(self, timeout: float, *args: str) -> CmdResult:
         proc_args = [
             f'{CFGgrind.exe["cfggrind_asmmap"]}',
             f'{self.binPath}',
         ] + [*args]
         #print(f'cfgg_asmmap: {proc_args}')
-        return runproc(proc_args, timeout, ofpath=self.mapFilePath)
+        return await arunproc(proc_args, timeout, ofpath=self.mapFilePath,
+                              tool='cfggrind_asmmap')
 
 
-    def _run_valgrind_memcheck(self, timeout: float, *args: str) -> CmdResult:
+    async def _run_valgrind_memcheck(self, timeout: float, *args: str) -> CmdResult:
         proc_args = [
             f'{CFGgrind.exe["valgrind"]}',
             '--tool=memcheck',
@@ -62,10 +98,21 @@ class CFGgrind:
             f'{self.binPath}',
         ] + [*args]  # e.g., switch-case 'idx'
         #print(f'valgrind: {proc_args}')
-        return runproc(proc_args, timeout)
+        return await arunproc(proc_args, timeout, tool='memcheck')
 
 
-    def _run_valgrind(self, timeout: float, *args: str) -> CmdResult:
+    async def _run_sanitized(self, timeout: float, *args: str) -> CmdResult:
+        code = CFGgrind.sanitizerExitCode
+        proc_args = [
+            'env',
+            f'ASAN_OPTIONS=exitcode={code}:detect_leaks=0',
+            f'UBSAN_OPTIONS=halt_on_error=1:exitcode={code}',
+            f'{self.sanBinPath}',
+        ] + [*args]  # e.g., switch-case 'idx'
+        return await arunproc(proc_args, timeout, tool='sanitizer')
+
+
+    async def _run_valgrind(self, timeout: float, *args: str) -> CmdResult:
         proc_args = [
             f'{CFGgrind.exe["valgrind"]}',
             '--tool=cfggrind',
@@ -74,35 +121,82 @@ class CFGgrind:
             f'{self.binPath}',
         ] + [*args]  # e.g., switch-case 'idx'
         #print(f'valgrind: {proc_args}')
-        return runproc(proc_args, timeout)
+        return await arunproc(proc_args, timeout, tool='cfggrind')
 
 
-    def _run_cfggrind_info(self, timeout: float, *args: str) -> CmdResult:
+    async def _run_cfggrind_info(self, timeout: float, *args: str) -> CmdResult:
         proc_args = [
             f'{CFGgrind.exe["cfggrind_info"]}',
-            '-f', f'{Path(self.binPath).name}::{self.benchFn}',
+            '-f', f'{self.binPath.name}::{self.benchFn}',
             '-s', 'functions',
             '-m', 'json',
             f'{self.cfgOutFilePath}'
         ] + [*args]
         #print(f'cfgg_info: {proc_args}')
-        return runproc(proc_args, timeout, ofpath=self.cfggInfoOutPath)
-
-
-    def runcmd(self, *args: str) -> CmdResult:
-        cfggMapRes = self._run_cfggrind_asmmap(CFGgrind.timeout, *args)
-        if cfggMapRes.err != ExitCode.OK:
-            return cfggMapRes
-
-        valgrindMemcheckRes = self._run_valgrind_memcheck(CFGgrind.timeout, *args)
-        if valgrindMemcheckRes.err != ExitCode.OK:
-            return valgrindMemcheckRes
-
-        valgrindRes = self._run_valgrind(CFGgrind.timeout, *args)
+        return await arunproc(proc_args, timeout, ofpath=self.cfggInfoOutPath,
+                              tool='cfggrind_info')
+
+
+    @staticmethod
+    def _timeout(tool: str) -> float:
+        return CFGgrind.timeouts.get(tool, CFGgrind.timeout)
+
+    def _missing(self) -> CmdResult | None:
+        ''' ERR if there's no binary to run, before any artifact is written '''
+        if self.binPath.is_file() and os.access(self.binPath, os.X_OK):
+            return None
+        return CmdResult(f'No executable binary [{self.binPath}]', ExitCode.ERR)
+
+    async def _screen(self, *args: str) -> CmdResult:
+        '''
+        [--ub-screen] Fails if the binary has UB. With 'sanitizer', memcheck
+        only runs (unless disabled) when the sanitized run is inconclusive,
+        so its failures stay comparable to the memcheck-only ones.
+        '''
+        if CFGgrind.ubScreen == 'sanitizer':
+            if self.sanBinPath.exists():
+                res = self.sanitizerRes = await self._run_sanitized(
+                    CFGgrind._timeout('sanitizer'), *args)
+                if (res.err == ExitCode.OK
+                        or res.returncode == CFGgrind.sanitizerExitCode):
+                    return res
+            if not CFGgrind.memcheckFallback:
+                return self.sanitizerRes or CmdResult(f'No {self.sanBinPath}',
+                                                      ExitCode.ERR)
+
+        res = self.memcheckRes = await self._run_valgrind_memcheck(
+            CFGgrind._timeout('memcheck'), *args)
+        return res
+
+    async def asmmap(self) -> CmdResult:
+        ''' Writes the .map, which only depends on the binary, not the case '''
+        if missing := self._missing():
+            return missing
+        return await self._run_cfggrind_asmmap(CFGgrind._timeout('cfggrind_asmmap'))
+
+    async def runcmd(self, *args: str) -> CmdResult:
+        '''
+        args are passed to the benchmark binary, e.g., switch-case 'idx'.
+        The .map of a previous asmmap() is reused, so the cases of a binary
+        can run in parallel without recomputing it.
+        '''
+        self.memcheckRes = self.sanitizerRes = None
+        if missing := self._missing():
+            return missing
+        if not self.mapFilePath.exists():
+            cfggMapRes = await self.asmmap()
+            if cfggMapRes.err != ExitCode.OK:
+                return cfggMapRes
+
+        screenRes = await self._screen(*args)
+        if screenRes.err != ExitCode.OK:
+            return screenRes
+
+        valgrindRes = await self._run_valgrind(CFGgrind._timeout('cfggrind'), *args)
         if valgrindRes.err != ExitCode.OK:
             return valgrindRes
 
-        return self._run_cfggrind_info(CFGgrind.timeout, *args)
+        return await self._run_cfggrind_info(CFGgrind._timeout('cfggrind_info'))
 
 
 
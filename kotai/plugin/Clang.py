@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 # =========================================================================== #
 
+import logging
+import os
+import re
 from pathlib import Path
+from typing import Final, Literal
 
-from kotai.kotypes import CmdResult, OptLevel, runproc
+from kotai.cache import ContentCache, digest, fileDigest, tmpPath, toolId
+from kotai.kotypes import CmdResult, OptLevel, arunproc, drive, runproc
+from kotai.templates.benchmark import GenBenchPrelude
 
 # --------------------------------------------------------------------------- #
 
+ObjKeyKind = Literal['source', 'preprocessed']
+
+ObjKeyKinds: Final[list[ObjKeyKind]] = ['source', 'preprocessed']
+
+
 class Clang():
 
     # ---------------------------- Static attrs. ---------------------------- #
@@ -19,25 +30,55 @@ class Clang():
 
     OptLevels = ['0','1','2','3','fast','z','s',]
 
+    # [--objcache] Compiled binaries, keyed by Clang.objKey
+    cache: ContentCache | None = None
+
+    # [--objcache-key] What Clang.objKey digests: the source as is, or the
+    # preprocessed source (a `clang -E` per cache miss, but a change to a
+    # system header changes the key)
+    objKeyKind: ObjKeyKind = 'source'
+
+    # [--pch] Precompiled GenBenchPrelude per optLevel (see buildPch)
+    pch: dict[str, Path] = {}
+
+    # Added by Clang(sanitize=True), for the --ub-screen sanitizer build
+    sanitizerFlags: list[str] = [
+        '-fsanitize=address,undefined',
+        '-fno-sanitize-recover=all',
+        '-fno-omit-frame-pointer',
+    ]
+
+    # What clang says when it rejects a PCH (stale, other flags/version...)
+    pchRejected: re.Pattern = re.compile(r'precompiled header|PCH file|AST file',
+                                         re.IGNORECASE)
+
+    _version: str | None = None
+
     # ---------------------------- Member attrs. ---------------------------- #
 
     __slots__ = (
         'optLevel',
         'ofile',
         'ifile',
+        'sanitize',
     )
 
     # ----------------------------------------------------------------------- #
-    def __init__(self, optLevel: OptLevel, ofile: Path, ifile: Path):
-        self.optLevel: str = optLevel
-        self.ofile: Path   = ofile
-        self.ifile: Path   = ifile
+    def __init__(self, optLevel: OptLevel, ofile: Path, ifile: Path,
+                 sanitize: bool = False):
+        self.optLevel: str  = optLevel
+        self.ofile: Path    = ofile
+        self.ifile: Path    = ifile
+        self.sanitize: bool = sanitize
     # ----------------------------------------------------------------------- #
 
-    def runcmd(self) -> CmdResult:
+    def flags(self) -> list[str]:
+        '''Every flag passed to clang, except for the input and output files'''
+        return self._optFlags() + (Clang.sanitizerFlags if self.sanitize else [])
+
+    def _optFlags(self) -> list[str]:
         if self.optLevel == 'O0':
-            proc_args = [
-                f'{Clang.exe["clang"]}',
+            return [
                 '-g',
                 '-ggdb',
                 '-Xclang',
@@ -47,12 +88,9 @@ class Clang():
                 '-Wall',
                 '-fno-stack-protector',
                 '-no-pie',
-                '-o', f'{self.ofile}',
-                f'{self.ifile}',
             ]
         else:
-            proc_args = [
-                f'{Clang.exe["clang"]}',
+            return [
                 '-g',
                 '-ggdb',
                 f'-{self.optLevel}',
@@ -60,10 +98,106 @@ class Clang():
                 '-Wall',
                 '-fno-stack-protector',
                 '-no-pie',
-                '-o', f'{self.ofile}',
-                f'{self.ifile}',
             ]
-        return runproc(proc_args, Clang.timeout)
+
+    async def runcmd(self) -> CmdResult:
+        proc_args = [
+            f'{Clang.exe["clang"]}',
+            *self.flags(),
+            '-o', f'{self.ofile}',
+            f'{self.ifile}',
+        ]
+
+        # [--pch] Falls back to a plain compilation only if clang rejects
+        # the PCH itself, not on compile errors, timeouts or limits
+        if not self.sanitize and (pch := Clang.pch.get(self.optLevel)):
+            res = await arunproc(proc_args[:1] + ['-include-pch', f'{pch}'] + proc_args[1:],
+                                 Clang.timeout, tool='clang')
+            if (res.err or res.timedOut or res.limited
+                    or not Clang.pchRejected.search(res.stderr)):
+                return res
+            logging.debug(f'PCH {pch} rejected for {self.ifile}, compiling without it')
+
+        return await arunproc(proc_args, Clang.timeout, tool='clang')
+
+    async def preprocess(self) -> CmdResult:
+        '''Runs only the preprocessor, with the same flags, to stdout'''
+        proc_args = [
+            f'{Clang.exe["clang"]}',
+            *self.flags(),
+            '-E',
+            f'{self.ifile}',
+        ]
+        return await arunproc(proc_args, Clang.timeout, tool='clang_preprocess')
+
+    async def objKey(self) -> str | None:
+        '''
+        Key of the binary in Clang.cache: source, clang and flags, as in the
+        other caches. With Clang.objKeyKind 'preprocessed', the preprocessed
+        source and the clang version instead, None if preprocessing fails
+        (the binary is not cached). The linemarkers only keep the name of
+        ifile, which may be a temp copy (see kotai.artifacts).
+        '''
+        if Clang.objKeyKind == 'source':
+            if not (source := fileDigest(self.ifile)):
+                return None
+            return digest('source', source,
+                          *[toolId(exe) for exe in Clang.exe.values()],
+                          *self.flags())
+
+        msg, err, *_ = await self.preprocess()
+        if not err:
+            return None
+        msg = msg.replace(f'"{self.ifile}"', f'"{self.ifile.name}"')
+        return digest(msg, await Clang.version(), *self.flags())
+
+    @staticmethod
+    def buildPch(optLevel: OptLevel, root: Path) -> Path | None:
+        '''
+        Precompiles GenBenchPrelude with the flags of optLevel, into a
+        directory of root named after the clang version, flags and prelude,
+        so it's only rebuilt when one of them changes. Returns the PCH path,
+        or None if clang couldn't build it.
+        '''
+        clang  = Clang(optLevel, ofile=Path(), ifile=Path())
+        pchDir = root / digest(drive(Clang.version()), *clang.flags(), GenBenchPrelude)
+        header = pchDir / 'prelude.h'
+        pch    = pchDir / 'prelude.h.pch'
+
+        if pch.exists():
+            return pch
+
+        try:
+            pchDir.mkdir(parents=True, exist_ok=True)
+            header.write_text(GenBenchPrelude, encoding='utf-8')
+        except OSError as e:
+            logging.error(f'{e}: PCH [{header}]')
+            return None
+
+        # Built aside and renamed, in case another run is building it too
+        tmpPch = tmpPath(pch)
+        proc_args = [
+            f'{Clang.exe["clang"]}',
+            *clang.flags(),
+            '-x', 'c-header',
+            '-o', f'{tmpPch}',
+            f'{header}',
+        ]
+        if not (res := runproc(proc_args, Clang.timeout * 10)).err:
+            logging.error(f'PCH [{header}]:"{res.msg=}"')
+            tmpPch.unlink(missing_ok=True)
+            return None
+
+        os.replace(tmpPch, pch)
+        return pch
+
+    @staticmethod
+    async def version() -> str:
+        '''`clang --version`, run once per process'''
+        if Clang._version is None:
+            msg, *_ = await arunproc([f'{Clang.exe["clang"]}', '--version'], Clang.timeout)
+            Clang._version = msg
+        return Clang._version
 
 
 
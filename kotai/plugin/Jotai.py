@@ -4,7 +4,7 @@
 import logging
 from pathlib import Path
 
-from kotai.kotypes import CmdResult, runproc
+from kotai.kotypes import CmdResult, ExitCode, arunproc
 
 # --------------------------------------------------------------------------- #
 
@@ -18,6 +18,19 @@ class Jotai():
 
     timeout: float = 3.0
 
+    # [--jotai-batch] A single Jotai call per benchmark, for all of its kets
+    batch: bool = False
+
+    # Line printed after the output of each constraints file of a batched
+    # call, followed by the exit status Jotai would have had on that file alone
+    endMarker: str = '@@JOTAI-END'
+
+    # Set when a batched call answers no end marker at all, while none has
+    # worked in this process (the binary doesn't know --batch), disables
+    # batching
+    unsupported: bool = False
+    _batchWorked: bool = False
+
     # ---------------------------- Member attrs. ---------------------------- #
 
     __slots__ = (
@@ -31,15 +44,68 @@ class Jotai():
         self.descriptorPath:  Path = descriptorPath
     # ----------------------------------------------------------------------- #
 
-    def runcmd(self, *args: str) -> CmdResult:
-        proc_args = [
+    def cmdline(self, *args: str) -> list[str]:
+        return [
             f'{Jotai.exe["jotai"]}',
             f'{self.constraintsPath}',
             f'{self.descriptorPath}',
         ] + [*args]
+
+    async def runcmd(self, *args: str) -> CmdResult:
         logging.info(f'Running jotai with {self.constraintsPath=}, '
                      f'{self.descriptorPath=}')
-        return runproc(proc_args, Jotai.timeout)
+        return await arunproc(self.cmdline(*args), Jotai.timeout, tool='jotai')
+
+    # ----------------------------------------------------------------------- #
+
+    @staticmethod
+    async def runbatch(constraintsPaths: list[Path], descriptorPath: Path) -> list[CmdResult]:
+        '''
+        Same as [Jotai(c, descriptorPath).runcmd() for c in constraintsPaths],
+        but with a single call, which parses the descriptor once:
+
+            Jotai --batch <descriptor> <constraints>...
+
+        prints, for each constraints file in order, what Jotai prints for it
+        alone, then a "<endMarker> <status>" line. Without exactly one such
+        line per file, every file of this call is run on its own. Only a
+        call without any of them (the binary doesn't know --batch) disables
+        batching, not one cut short (e.g., a crash or timeout on some file).
+        '''
+        if not Jotai.batch or Jotai.unsupported or len(constraintsPaths) <= 1:
+            return [await Jotai(c, descriptorPath).runcmd() for c in constraintsPaths]
+
+        proc_args = [f'{Jotai.exe["jotai"]}', '--batch', f'{descriptorPath}',
+                     *[f'{c}' for c in constraintsPaths]]
+        res = await arunproc(proc_args, Jotai.timeout * len(constraintsPaths),
+                             tool='jotai_batch')
+
+        if len(results := Jotai._split(res.msg)) == len(constraintsPaths):
+            Jotai._batchWorked = True
+            return results
+
+        if (not results and not Jotai._batchWorked
+                and not res.timedOut and not res.limited):
+            logging.warning(f'Jotai --batch {res.returncode=}: '
+                            'falling back to one Jotai call per ket')
+            Jotai.unsupported = True
+        return [await Jotai(c, descriptorPath).runcmd() for c in constraintsPaths]
+
+    @staticmethod
+    def _split(msg: str) -> list[CmdResult]:
+        '''The output of a batched call, back into one CmdResult per file'''
+        results: list[CmdResult] = []
+        lines: list[str] = []
+        for line in msg.splitlines(keepends=True):
+            if not line.startswith(Jotai.endMarker):
+                lines.append(line)
+                continue
+            status = line[len(Jotai.endMarker):].strip()
+            results.append(CmdResult(''.join(lines),
+                                     ExitCode.OK if status == '0' else ExitCode.ERR,
+                                     returncode=int(status) if status.isdigit() else None))
+            lines = []
+        return results
 
 
 
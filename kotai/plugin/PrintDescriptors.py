@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 # =========================================================================== #
 
+import logging
+import os
+import tempfile
 from pathlib import Path
 
-from kotai.kotypes import CmdResult, runproc
+from kotai.cache import tmpPath
+from kotai.kotypes import CmdResult, ExitCode, arunproc
 
 class PrintDescriptors():
 
@@ -16,6 +20,19 @@ class PrintDescriptors():
 
     timeout: float = 3.0
 
+    # [--descriptor-batch] Files per clang invocation (1: one per file)
+    batchSize: int = 1
+
+    # Translation unit placed after each file of a batch. Its descriptor is
+    # what the combined output of the batch is split on
+    separatorSrc: str = ('void __kotai_descriptor_separator'
+                         '(int __kotai_descriptor_separator_arg) {}\n')
+
+    # (separator file, its descriptor), built once per process. None if the
+    # separator yields no usable descriptor, which disables batching
+    _separator: tuple[Path, str] | None = None
+    _separatorTried: bool = False
+
     # ---------------------------- Member attrs. ---------------------------- #
 
     __slots__ = (
@@ -26,17 +43,82 @@ class PrintDescriptors():
         self.ifile = ifile
 
 
-    def runcmd(self, *args: str) -> CmdResult:
-        proc_args = [
+    @staticmethod
+    def _flags() -> list[str]:
+        return [
             f'{PrintDescriptors.exe["clang"]}',
             '-cc1',
             '-load',
             f'{PrintDescriptors.exe["libPath"]}',
             '-plugin',
             'print-descriptors',
-            f'{self.ifile}',
-        ] + [*args]
-        return runproc(proc_args, timeout=PrintDescriptors.timeout)
+        ]
+
+    def cmdline(self, *args: str) -> list[str]:
+        return PrintDescriptors._flags() + [f'{self.ifile}'] + [*args]
+
+    async def runcmd(self, *args: str) -> CmdResult:
+        return await arunproc(self.cmdline(*args), timeout=PrintDescriptors.timeout,
+                              tool='printdescriptors')
+
+    # ----------------------------------------------------------------------- #
+
+    @staticmethod
+    async def runbatch(ifiles: list[Path]) -> list[CmdResult]:
+        '''
+        Same as [PrintDescriptors(f).runcmd() for f in ifiles], but clang and
+        the plugin are loaded once for the whole batch (clang -cc1 runs the
+        plugin over each input in turn).
+
+        The separator TU goes after every file, so the combined output splits
+        back into one descriptor per file. If clang fails, the batch is split
+        in halves and retried, which isolates the failing files in a few more
+        invocations, down to the exact single-file run for each of them.
+        '''
+        if len(ifiles) <= 1 or (separator := await PrintDescriptors._getSeparator()) is None:
+            return [await PrintDescriptors(f).runcmd() for f in ifiles]
+
+        sepPath, sepDescriptor = separator
+        inputs = [str(p) for f in ifiles for p in (f, sepPath)]
+        msg, err, *_ = await arunproc(PrintDescriptors._flags() + inputs,
+                                      timeout=PrintDescriptors.timeout * len(ifiles),
+                                      tool='printdescriptors_batch')
+
+        descriptors = msg.split(sepDescriptor)
+        if (err == ExitCode.OK and len(descriptors) == len(ifiles) + 1
+                and not descriptors[-1].strip()):
+            return [CmdResult(d, ExitCode.OK) for d in descriptors[:-1]]
+
+        mid = len(ifiles) // 2
+        return (await PrintDescriptors.runbatch(ifiles[:mid])
+                + await PrintDescriptors.runbatch(ifiles[mid:]))
+
+    @staticmethod
+    async def _getSeparator() -> tuple[Path, str] | None:
+        if PrintDescriptors._separatorTried:
+            return PrintDescriptors._separator
+        PrintDescriptors._separatorTried = True
+
+        # Shared by every worker process, replaced atomically if outdated
+        sepPath = Path(tempfile.gettempdir()) / f'kotai-separator-{os.getuid()}.c'
+        try:
+            if (not sepPath.exists() or sepPath.read_text(encoding='utf-8')
+                    != PrintDescriptors.separatorSrc):
+                tmpSep = tmpPath(sepPath)
+                tmpSep.write_text(PrintDescriptors.separatorSrc, encoding='utf-8')
+                os.replace(tmpSep, sepPath)
+        except OSError as e:
+            logging.warning(f'{e}: descriptor batching disabled')
+            return None
+
+        msg, err, *_ = await PrintDescriptors(sepPath).runcmd()
+        if err != ExitCode.OK or '__kotai_descriptor_separator' not in msg:
+            logging.warning(f'Separator descriptor {msg=}: '
+                            'descriptor batching disabled')
+            return None
+
+        PrintDescriptors._separator = (sepPath, msg)
+        return PrintDescriptors._separator
 
 
 
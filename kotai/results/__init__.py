@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# =========================================================================== #
+
+import json
+import logging
+import sqlite3
+import time
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Iterable
+
+from kotai.kotypes import OptLevel, ResultKind, Rusage, StageRecord
+
+# --------------------------------------------------------------------------- #
+'''
+Results store (--results), an SQLite database with one row per (benchmark,
+stage, ket, optLevel):
+
+    stage       descriptor, konstrain, jotai, generator (--generator diff),
+                clang, asmmap, memcheck or sanitizer (--ub-screen), cfggrind,
+                or pipeline
+    ket         '' unless the stage runs once per ket (konstrain, generator,
+                memcheck, sanitizer, cfggrind)
+    optLevel    '' unless the stage runs once per optLevel (clang, asmmap,
+                memcheck, sanitizer, cfggrind)
+    exitCode    0 on success, 1 otherwise
+    kind        ok, fail, timeout or limit (see ResultKind and --limit)
+    seconds     wall time of the stage
+    cached      1 if the stage was skipped thanks to the manifest/objcache
+    artifacts   json list of the files the stage produced (generator: the
+                version of kotai.generator that was checked)
+    userSeconds, sysSeconds, maxRss (KiB), signal
+                resources used by the tools the stage ran (see Rusage), NULL
+                if unknown (cached, async engine...)
+
+Workers record their rows with recordStage, the rows travel back to the parent
+with the BenchInfo of the worker (BenchInfo.stages), and only the parent
+writes to the database, in batches. A 'pipeline' row per (benchmark,
+optLevel) marks that the benchmark left the pipeline, be it through a failure
+or after the last stage, which is what --resume looks for.
+
+A row is replaced whenever its stage runs again, so the database holds the
+latest outcome of everything. E.g., the benchmarks with timeouts:
+
+    SELECT DISTINCT bench FROM results WHERE kind = 'timeout';
+
+Or the benchmarks that used the most CPU time in CFGgrind:
+
+    SELECT bench, SUM(userSeconds + sysSeconds) AS cpu FROM results
+    WHERE stage = 'cfggrind' GROUP BY bench ORDER BY cpu DESC LIMIT 20;
+'''
+# --------------------------------------------------------------------------- #
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS results (
+    bench     TEXT NOT NULL,
+    stage     TEXT NOT NULL,
+    ket       TEXT NOT NULL DEFAULT '',
+    optLevel  TEXT NOT NULL DEFAULT '',
+    exitCode  INTEGER NOT NULL,
+    kind      TEXT NOT NULL,
+    seconds   REAL NOT NULL,
+    cached    INTEGER NOT NULL,
+    artifacts TEXT NOT NULL,
+    updated   REAL NOT NULL,
+    userSeconds REAL,
+    sysSeconds  REAL,
+    maxRss      INTEGER,
+    signal      INTEGER,
+    PRIMARY KEY (bench, stage, ket, optLevel)
+);
+CREATE INDEX IF NOT EXISTS results_kind ON results (kind);
+'''
+
+# Stages whose rows time the pool tasks (konstrain: a row per ket of the
+# task), for kotai.schedule and the idle core time of kotai.metrics
+TaskStages: list[str] = ['descriptor', 'konstrain', 'jotai', 'clang',
+                         'asmmap', 'cfggrind']
+
+_columns: list[str] = ['bench', 'stage', 'ket', 'optLevel', 'exitCode', 'kind',
+                       'seconds', 'cached', 'artifacts', 'updated',
+                       'userSeconds', 'sysSeconds', 'maxRss', 'signal']
+
+# Columns added after the first version of _schema, to databases without them
+_addedColumns: dict[str, str] = {
+    'userSeconds': 'REAL',
+    'sysSeconds':  'REAL',
+    'maxRss':      'INTEGER',
+    'signal':      'INTEGER',
+}
+
+
+# StageRecords of the current thread (or task of the async executor), see
+# drainStages
+_stages: ContextVar[list[StageRecord]] = ContextVar('stages')
+
+def recordStage(bench: Path, stage: str, kind: ResultKind, seconds: float,
+                *artifacts: Path, ket: str = '', optLevel: str = '',
+                cached: bool = False, usage: Rusage | None = None) -> None:
+    '''Records the outcome of a stage of bench, see BenchInfo.stages'''
+    if (stages := _stages.get(None)) is None: _stages.set(stages := [])
+    stages.append(StageRecord(str(bench), stage, ket, optLevel, kind,
+                              seconds, cached,
+                              tuple(str(a) for a in artifacts), usage))
+
+def drainStages() -> list[StageRecord]:
+    '''Returns and forgets the StageRecords recorded by the calling thread'''
+    stages = _stages.get([])
+    _stages.set([])
+    return stages
+
+
+# --------------------------------------------------------------------------- #
+
+class ResultStore:
+
+    # ---------------------------- Static attrs. ---------------------------- #
+
+    # Rows buffered before they're written in a single transaction
+    batchSize: int = 512
+
+    # ---------------------------- Member attrs. ---------------------------- #
+
+    __slots__ = (
+        'path',
+        'db',
+        'pending',
+    )
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path: Path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(_schema)
+        self._migrate('main')
+        self.pending: list[tuple] = []
+
+    def _tableColumns(self, schema: str) -> set[str]:
+        return {row[1] for row in self.db.execute(f'PRAGMA {schema}.table_info(results)')}
+
+    def _migrate(self, schema: str) -> None:
+        '''Adds the _addedColumns missing from a database of an older version'''
+        present = self._tableColumns(schema)
+        with self.db:
+            for column, sqlType in _addedColumns.items():
+                if column not in present:
+                    self.db.execute(f'ALTER TABLE {schema}.results '
+                                    f'ADD COLUMN {column} {sqlType}')
+
+    def add(self, records: Iterable[StageRecord]) -> None:
+        now = time.time()
+        self.pending += [(r.bench, r.stage, r.ket, r.optLevel,
+                          0 if r.kind == ResultKind.OK else 1, r.kind.value,
+                          r.seconds, int(r.cached), json.dumps(r.artifacts), now,
+                          *((u.user, u.sys, u.maxRss, u.signal)
+                            if (u := r.usage) else (None,) * 4))
+                         for r in records]
+        if len(self.pending) >= ResultStore.batchSize:
+            self.flush()
+
+    def finish(self, bench: Path, optLevels: Iterable[OptLevel],
+               ok: bool) -> list[StageRecord]:
+        '''Marks bench as done with optLevels (see --resume)'''
+        kind = ResultKind.OK if ok else ResultKind.FAIL
+        records = [StageRecord(str(bench), 'pipeline', '', optLevel, kind, 0.0, False)
+                   for optLevel in optLevels]
+        self.add(records)
+        return records
+
+    def forget(self, benches: Iterable[Path]) -> None:
+        '''Deletes every row of benches, before they're run again'''
+        self.flush()
+        try:
+            with self.db:
+                self.db.executemany('DELETE FROM results WHERE bench = ?',
+                                    [(str(b),) for b in benches])
+        except sqlite3.Error as e:
+            logging.error(f'{e}: results [{self.path}]')
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        try:
+            with self.db:
+                self.db.executemany(
+                    f'INSERT OR REPLACE INTO results ({", ".join(_columns)}) '
+                    f'VALUES ({",".join("?" * len(_columns))})', self.pending)
+        except sqlite3.Error as e:
+            logging.error(f'{e}: results [{self.path}]')
+        self.pending = []
+
+    def finished(self, optLevels: list[OptLevel],
+                 benches: Iterable[Path] | None = None) -> set[str]:
+        '''
+        Benchmarks that left the pipeline with every one of optLevels, among
+        benches (e.g. the next --window of them) or among all of them
+        '''
+        self.flush()
+        marks = ','.join('?' * len(optLevels))
+        query = ('SELECT bench FROM results WHERE stage = \'pipeline\' '
+                 f'AND optLevel IN ({marks}) {{}}GROUP BY bench '
+                 'HAVING COUNT(DISTINCT optLevel) = ?')
+        if benches is None:
+            rows = self.db.execute(query.format(''), (*optLevels, len(optLevels)))
+            return {bench for bench, in rows}
+
+        # In chunks, below SQLite's limit on the number of parameters
+        names, found = [str(b) for b in benches], set()
+        for i in range(0, len(names), ResultStore.batchSize):
+            chunk = names[i:i + ResultStore.batchSize]
+            rows = self.db.execute(query.format(f'AND bench IN ({",".join("?" * len(chunk))}) '),
+                                   (*optLevels, *chunk, len(optLevels)))
+            found |= {bench for bench, in rows}
+        return found
+
+    def costs(self, benches: Iterable[Path]) -> dict[str, float]:
+        '''Seconds of the TaskStages of each one of benches, in its last run'''
+        self.flush()
+        names, costs = [str(b) for b in benches], {}
+        stages = ','.join('?' * len(TaskStages))
+        for i in range(0, len(names), ResultStore.batchSize):
+            chunk = names[i:i + ResultStore.batchSize]
+            rows = self.db.execute(
+                f'SELECT bench, SUM(seconds) FROM results WHERE stage IN ({stages}) '
+                f'AND bench IN ({",".join("?" * len(chunk))}) GROUP BY bench',
+                (*TaskStages, *chunk))
+            costs.update(rows)
+        return costs
+
+    def latencies(self) -> dict[str, float]:
+        '''Mean seconds of a row of each one of TaskStages'''
+        self.flush()
+        stages = ','.join('?' * len(TaskStages))
+        return dict(self.db.execute(
+            f'SELECT stage, AVG(seconds) FROM results WHERE stage IN ({stages}) '
+            'GROUP BY stage', TaskStages))
+
+    def select(self, kinds: Iterable[ResultKind]) -> list[str]:
+        '''
+        Benchmarks with some stage that ended as one of kinds ('generator'
+        rows are checks, not stages the benchmark went through)
+        '''
+        self.flush()
+        values = [k.value for k in kinds]
+        marks = ','.join('?' * len(values))
+        rows = self.db.execute(
+            'SELECT DISTINCT bench FROM results '
+            'WHERE stage NOT IN (\'pipeline\', \'generator\') '
+            f'AND kind IN ({marks}) ORDER BY bench', values)
+        return [bench for bench, in rows]
+
+    def merge(self, other: Path) -> int:
+        '''
+        Copies the rows of the database at other (e.g. of a --shard run) into
+        this one. Rows found in both keep the most recently updated one.
+        Returns the number of rows copied.
+        '''
+        self.flush()
+        if not other.is_file():
+            logging.error(f'No such file: results [{other}]')
+            return 0
+        try:
+            self.db.execute('ATTACH DATABASE ? AS shard', (str(other),))
+        except sqlite3.Error as e:
+            logging.error(f'{e}: results [{other}]')
+            return 0
+        try:
+            # Columns the shard doesn't have yet (older version) are NULL
+            present = self._tableColumns('shard')
+            with self.db:
+                return self.db.execute(
+                    f'INSERT OR REPLACE INTO results ({", ".join(_columns)}) '
+                    f'SELECT {", ".join(f"s.{c}" if c in present else "NULL" for c in _columns)} '
+                    'FROM shard.results s LEFT JOIN results r '
+                    'USING (bench, stage, ket, optLevel) '
+                    'WHERE r.updated IS NULL OR s.updated >= r.updated').rowcount
+        except sqlite3.Error as e:
+            logging.error(f'{e}: results [{other}]')
+            return 0
+        finally:
+            self.db.execute('DETACH DATABASE shard')
+
+    def rows(self, stage: str) -> list[tuple[str, str, str, str]]:
+        '''(bench, ket, optLevel, kind) of every row of stage'''
+        self.flush()
+        return self.db.execute('SELECT bench, ket, optLevel, kind FROM results '
+                               'WHERE stage = ?', (stage,)).fetchall()
+
+    def close(self) -> None:
+        self.flush()
+        self.db.close()
+
+
+
+# =========================================================================== #
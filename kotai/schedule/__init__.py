@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# =========================================================================== #
+
+import statistics
+from pathlib import Path
+from typing import Final, Literal
+
+from kotai.artifacts import Artifacts
+
+# --------------------------------------------------------------------------- #
+'''
+Cost-aware scheduling (--schedule cost, the default).
+
+Each window of benchmarks is dispatched longest-first, so the pathological
+ones start while there's still plenty of other work to overlap with them,
+instead of ending the run on one or two busy cores. The cost of a benchmark
+is, in order of preference:
+
+    history     seconds its pool tasks took in the last run that ran it (the
+                task stages of kotai.results, cached ones included, so a
+                benchmark that will be cached again is cheap)
+    proxy       source size * (1 + lines of its descriptor, about one per
+                param), scaled to seconds by the benchmarks of the window
+                that have a history (left unscaled, only good for ordering,
+                if none has)
+
+Every stage of a window is mapped with its own chunksize, unless -J fixes
+it, picked once as the stage is dispatched: enough tasks per chunk for
+Scheduler.targetChunk seconds of work, from the p50 latency of the stage in
+this run so far (once it has Scheduler.minObserved records) or its mean
+latency in the results store, but never so many that a worker gets fewer
+than Scheduler.chunksPerWorker chunks of the stage. The heavy head of the
+window (cost above Scheduler.heavyFactor times the median) is dispatched one
+task per chunk.
+
+--schedule input keeps the discovery order, without estimating any cost
+(nor a heavy head). The chunksizes are picked the same way.
+'''
+# --------------------------------------------------------------------------- #
+
+ScheduleKind = Literal['cost', 'input']
+
+Schedules: Final[list[ScheduleKind]] = ['cost', 'input']
+
+
+class Scheduler:
+
+    # ---------------------------- Static attrs. ---------------------------- #
+
+    # [--schedule] Order of the benchmarks of a window
+    kind: ScheduleKind = 'cost'
+
+    # Seconds of work per chunk, which amortizes the IPC of each chunk
+    targetChunk: float = 0.5
+
+    # Chunks per worker, at least, so the last chunks are short
+    chunksPerWorker: int = 4
+
+    # Chunksize without any latency to go by, and the largest one
+    defaultChunk: int = 64
+    maxChunk: int = 1024
+
+    # Records of a stage in this run before its p50 replaces the history
+    minObserved: int = 32
+
+    # Benchmarks this many times costlier than the median go one per chunk
+    heavyFactor: float = 8.0
+
+    # ---------------------------- Member attrs. ---------------------------- #
+
+    __slots__ = (
+        'fixed',
+        'nproc',
+        'latencies',
+        'costs',
+        'seconds',
+        'heavy',
+    )
+
+    def __init__(self, fixed: int, nproc: int, latencies: dict[str, float]):
+        self.fixed: int                   = fixed
+        self.nproc: int                   = nproc
+        self.latencies: dict[str, float]  = latencies
+        self.costs: dict[Path, float]     = {}
+        self.seconds: bool                = False
+        self.heavy: float                 = float('inf')
+
+    def order(self, cFiles: list[Path], history: dict[str, float]) -> list[Path]:
+        '''
+        Estimates the cost of every benchmark of a window (history: seconds
+        per benchmark, see ResultStore.costs), and returns them in
+        dispatch order
+        '''
+        if Scheduler.kind == 'input':
+            self.costs, self.seconds, self.heavy = {}, False, float('inf')
+            return cFiles
+
+        proxies = [_proxy(cf) for cf in cFiles]
+        known = [(history[str(cf)], p) for cf, p in zip(cFiles, proxies)
+                 if str(cf) in history]
+        knownProxy = sum(p for _, p in known)
+        scale = sum(h for h, _ in known) / knownProxy if knownProxy > 0 else 1.0
+
+        self.seconds = bool(known)
+        self.costs = {cf: history.get(str(cf), p * scale)
+                      for cf, p in zip(cFiles, proxies)}
+        self.heavy = (statistics.median(self.costs.values()) * Scheduler.heavyFactor
+                      if self.costs else float('inf'))
+        return sorted(cFiles, key=lambda cf: -self.costs[cf])
+
+    def isHeavy(self, cFile: Path) -> bool:
+        return self.costs.get(cFile, 0.0) > self.heavy
+
+    def chunksize(self, stage: str, n: int, observed: float | None) -> int:
+        '''Chunksize to map n tasks of stage with (observed: p50 of the run)'''
+        if self.fixed:
+            return self.fixed
+
+        # --stream: a task is a whole pipeline, as costly as its benchmark
+        if stage == 'pipeline' and self.seconds and self.costs:
+            observed = statistics.median(self.costs.values())
+
+        latency = observed or self.latencies.get(stage)
+        wanted = (int(Scheduler.targetChunk / latency) if latency
+                  else Scheduler.defaultChunk)
+        tail = n // (self.nproc * Scheduler.chunksPerWorker)
+        return max(min(wanted, tail, Scheduler.maxChunk), 1)
+
+
+def _proxy(cFile: Path) -> float:
+    '''Cost of a benchmark without a history, in no particular unit'''
+    try: size = cFile.stat().st_size
+    except OSError:
+        size = 0
+    try: params = len(Artifacts(cFile).read('descriptor').splitlines())
+    except (OSError, ValueError):
+        params = 0
+    return float(size * (1 + params))
+
+
+
+# =========================================================================== #
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# =========================================================================== #
+
+import itertools
+import json
+import logging
+import os
+import time
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Callable, Iterator
+
+import numpy as np
+
+from kotai.artifacts import packedFiles, readRecord
+from kotai.kotypes import KonstrainExecTypes, OptLevels
+
+# --------------------------------------------------------------------------- #
+'''
+CFGgrind statistics dataset (python -m kotai stats ingest).
+
+The .info files written by CFGgrind._run_cfggrind_info (cfggrind_info -m
+json) are parsed in a process pool and flattened like flattenCfgInfo in
+util/statParser.ipynb, one row per file:
+
+    bench       path/to/<bench>.c, from the path/to/<bench>.d directory
+                holding the file, as found under the roots, so the same as
+                in kotai.results when the roots are the -i of the run
+    optLevel    from <bench>_<optLevel>[_<ket>].info
+    ket         '' if the file name has none
+    path, mtime of the .info file
+    InfoColumns int64 counts (booleans as 0/1, lists by their length)
+
+Rows are stored column-wise as numpy arrays, in part files
+(<dataset>/part-<ns>.npz). Each ingestion only parses the .info files that
+are new or changed since the parts already there, and adds a single part with
+them. load() concatenates the parts, keeping the latest row of each path.
+
+merge() (python -m kotai merge) adds the rows of the datasets of other runs,
+e.g. the shards of a --shard run, from their parts only, without reading any
+.info file again.
+
+With --storage pack, the .info files are records of the packs (see
+kotai.artifacts), found with packedFiles instead of walkInfo, and their path
+is <bench>.d/<name> as with the dirs backend, the bench path absolute.
+'''
+# --------------------------------------------------------------------------- #
+
+InfoColumns: list[str] = [
+    'invoked',
+    'complete',
+    'blocks',
+    'phantoms',
+    'exit',
+    'halt',
+    'edges',
+    'static_instructions',
+    'static_calls',
+    'static_signals',
+    'dynamic_instructions',
+    'dynamic_calls',
+    'dynamic_signals',
+]
+
+KeyColumns: list[str] = ['bench', 'optLevel', 'ket', 'path', 'mtime']
+
+# Longest first, so 'big-arr-10x' isn't taken for 'big-arr'
+_kets: list[str] = sorted(KonstrainExecTypes, key=len, reverse=True)
+
+InfoRow = tuple[str, str, str, str, float, list[int]]
+
+
+def infoKey(infoPath: Path) -> tuple[str, str, str] | None:
+    '''
+    (bench, optLevel, ket) of a .info file, None if it isn't named like one.
+    bench is a path, as benchmarks of different dirs can share a name.
+    '''
+    benchDir = infoPath.parent
+    if benchDir.suffix != '.d' or infoPath.suffix != '.info':
+        return None
+
+    name = infoPath.stem
+    ket  = next((k for k in _kets if name.endswith(f'_{k}')), '')
+    if ket:
+        name = name[:-len(ket) - 1]
+
+    if not (opt := next((o for o in OptLevels if name == f'{benchDir.stem}_{o}'), '')):
+        return None
+
+    return str(benchDir.with_suffix('.c')), opt, ket
+
+
+def _count(value: object) -> int:
+    if isinstance(value, (list, dict)):
+        return len(value)
+    return int(value)  # type: ignore[call-overload]
+
+
+def flattenCfgInfo(cfgInfo: dict) -> list[int]:
+    '''Values of InfoColumns in a cfggrind_info entry (KeyError if missing)'''
+    return [_count(cfgInfo[col] if col in cfgInfo
+                   else cfgInfo[col.partition('_')[0]][col.partition('_')[2]])
+            for col in InfoColumns]
+
+
+def parseInfo(item: tuple) -> InfoRow | None:
+    '''
+    Worker function: parses and flattens a single .info file, (path, mtime)
+    or, if it's packed, (path, time, readRecord args)
+    '''
+    path, mtime, *record = item
+    if (key := infoKey(Path(path))) is None:
+        return None
+
+    try:
+        if record:
+            info = json.loads(readRecord(Path(record[0][0]), *record[0][1:]))
+        else:
+            with open(path, 'rb') as fhandle:
+                info = json.load(fhandle)
+        values = flattenCfgInfo(info[0] if isinstance(info, list) else info)
+    except Exception as e:
+        logging.warning(f'{e}: CFGgrind info [{path}]')
+        return None
+
+    return (*key, path, mtime, values)
+
+
+def walkInfo(roots: list[Path]) -> Iterator[tuple[str, float]]:
+    '''(path, mtime) of every <bench>.d/*.info under roots, lazily'''
+    for root in roots:
+        try: benchDirs = os.scandir(root)
+        except OSError as e:
+            logging.error(f'{e}: stats [{root}]')
+            continue
+
+        with benchDirs:
+            for benchDir in benchDirs:
+                if not benchDir.name.endswith('.d') or not benchDir.is_dir():
+                    continue
+                with os.scandir(benchDir.path) as entries:
+                    for entry in entries:
+                        if entry.name.endswith('.info') and entry.is_file():
+                            yield entry.path, entry.stat().st_mtime
+
+
+# --------------------------------------------------------------------------- #
+
+def load(dataset: Path) -> dict[str, np.ndarray]:
+    '''
+    Every column of the dataset. A path ingested more than once keeps the
+    row of its latest part.
+    '''
+    parts = sorted(dataset.glob('part-*.npz'))
+    if not parts:
+        return _columns([])
+
+    chunks = []
+    for part in parts:
+        with np.load(part) as npz:
+            chunks.append({col: npz[col] for col in npz.files})
+    cols = {col: np.concatenate([c[col] for c in chunks]) for col in chunks[0]}
+
+    # np.unique keeps the first occurrence, so search the reversed rows
+    _, lastIdx = np.unique(cols['path'][::-1], return_index=True)
+    keep = np.sort(len(cols['path']) - 1 - lastIdx)
+    return {col: arr[keep] for col, arr in cols.items()}
+
+
+def _columns(rows: list[InfoRow]) -> dict[str, np.ndarray]:
+    values = (np.array([r[5] for r in rows], dtype=np.int64) if rows
+              else np.empty((0, len(InfoColumns)), dtype=np.int64))
+    cols = {
+        'bench':    np.array([r[0] for r in rows], dtype=str),
+        'optLevel': np.array([r[1] for r in rows], dtype=str),
+        'ket':      np.array([r[2] for r in rows], dtype=str),
+        'path':     np.array([r[3] for r in rows], dtype=str),
+        'mtime':    np.array([r[4] for r in rows], dtype=np.float64),
+    }
+    cols |= {col: values[:, idx] for idx, col in enumerate(InfoColumns)}
+    return cols
+
+
+def ingest(roots: list[Path], dataset: Path, nproc: int = 8,
+           chunksize: int = 256, packs: Path | None = None,
+           only: Callable[[Path], bool] | None = None) -> int:
+    '''
+    Parses the .info files under roots (and in the packs of the artifacts
+    dir packs) that aren't in dataset yet (or changed since), and stores them
+    as a new part. Returns the number of new rows. only, if given, picks the
+    benchmarks (path/to/<bench>.c) whose files are parsed.
+    '''
+    dataset.mkdir(parents=True, exist_ok=True)
+    known = load(dataset)
+
+    # Rows of older datasets, whose bench was a bare <bench>.c, are parsed again
+    seen = {path: mtime for path, mtime, bench
+            in zip(known['path'].tolist(), known['mtime'].tolist(), known['bench'].tolist())
+            if bench == str(Path(path).parent.with_suffix('.c'))}
+
+    found = itertools.chain(walkInfo(roots), packedFiles(packs, '.info') if packs else [])
+    todo = (item for item in found if seen.get(item[0]) != item[1]
+            and (only is None or only(Path(item[0]).parent.with_suffix('.c'))))
+
+    with Pool(nproc) as pool:
+        rows = [r for r in pool.imap_unordered(parseInfo, todo, chunksize) if r]
+        pool.close()
+        pool.join()
+
+    if rows:
+        _writePart(dataset, _columns(rows))
+
+    return len(rows)
+
+
+def merge(datasets: list[Path], dataset: Path) -> int:
+    '''
+    Adds the rows of datasets to dataset, as a single new part. A path found
+    in more than one of them keeps its row with the latest mtime. Returns the
+    number of rows added.
+    '''
+    dataset.mkdir(parents=True, exist_ok=True)
+    loaded = [load(d) for d in datasets]
+    cols = {col: np.concatenate([c[col] for c in loaded]) for col in loaded[0]}
+    if not len(cols['path']):
+        return 0
+
+    # Sorted by path, then mtime: the last row of each path is the latest
+    order = np.lexsort((cols['mtime'], cols['path']))
+    paths = cols['path'][order]
+    keep  = order[np.append(paths[1:] != paths[:-1], True)]
+
+    _writePart(dataset, {col: arr[keep] for col, arr in cols.items()})
+    return len(keep)
+
+
+def _writePart(dataset: Path, cols: dict[str, np.ndarray]) -> None:
+    part = dataset / f'part-{time.time_ns()}.npz'
+    tmpPart = part.with_name(f'.{part.name}')
+    with open(tmpPart, 'wb') as fhandle:
+        np.savez(fhandle, **cols)
+    os.replace(tmpPart, part)
+
+
+
+# =========================================================================== #
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# =========================================================================== #
+
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from kotai.kotypes import OptLevels
+from kotai.results import ResultStore
+from kotai.stats import load
+
+# --------------------------------------------------------------------------- #
+'''
+Run report (-u/--ubstats, python -m kotai stats report): compares the
+CFGgrind columns of kotai.stats across optLevels and kets, and counts the
+undefined behavior found by memcheck and the sanitizers (--ub-screen, their
+rows in kotai.results), and how often the native generator agreed with Jotai
+(--generator diff).
+
+Everything is computed over whole numpy arrays: rows get an int id per
+(optLevel, ket) group (see _factorize), and each group's stats come from a
+single sort (np.lexsort) plus np.bincount, so the cost doesn't depend on the
+number of groups and there are no per-row Python loops.
+'''
+# --------------------------------------------------------------------------- #
+
+Quantiles: list[float] = [0.0, 0.25, 0.5, 0.75, 0.95, 1.0]
+
+
+def _factorize(*columns: np.ndarray) -> tuple[list[np.ndarray], np.ndarray]:
+    '''
+    Distinct values of each column, and an int id per row for the combination
+    of its values (ids of the 1d columns mixed, instead of np.unique(axis=0)
+    over strings, which is much slower)
+    '''
+    uniques, ids = [], np.zeros(len(columns[0]), dtype=np.int64)
+    for column in columns:
+        values, inverse = np.unique(column, return_inverse=True)
+        uniques.append(values)
+        ids = ids * len(values) + inverse.ravel()
+    return uniques, ids
+
+
+def _groups(optLevel: np.ndarray, ket: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''Distinct (optLevel, ket) pairs in OptLevels order, and each row's group'''
+    if not len(optLevel):
+        return np.empty((0, 2), dtype=str), np.empty(0, dtype=np.intp)
+    (opts, kets), ids = _factorize(optLevel, ket)
+    rank = np.array([OptLevels.index(o) if o in OptLevels else len(OptLevels)
+                     for o in opts])
+
+    # Group ids sorted by (optLevel rank, ket)
+    present = np.unique(ids)
+    optIdx, ketIdx = np.divmod(present, len(kets))
+    order = np.lexsort((ketIdx, rank[optIdx]))
+    remap = np.empty(ids.max() + 1, dtype=np.intp)
+    remap[present[order]] = np.arange(len(present))
+
+    keys = np.stack([opts[optIdx[order]], kets[ketIdx[order]]], axis=1)
+    return keys, remap[ids]
+
+
+def groupMean(ids: np.ndarray, nGroups: int, values: np.ndarray) -> np.ndarray:
+    '''Mean of values per group id (nan for empty groups)'''
+    counts = np.bincount(ids, minlength=nGroups)
+    sums   = np.bincount(ids, weights=values.astype(np.float64), minlength=nGroups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums / counts
+
+
+def groupStats(ids: np.ndarray, nGroups: int,
+               values: np.ndarray) -> dict[str, np.ndarray]:
+    '''count, mean, std and Quantiles of values, per group id'''
+    values = values.astype(np.float64)
+    counts = np.bincount(ids, minlength=nGroups)
+    safe   = np.maximum(counts, 1)
+    mean   = np.bincount(ids, weights=values, minlength=nGroups) / safe
+    sqMean = np.bincount(ids, weights=values * values, minlength=nGroups) / safe
+    stats  = {
+        'n':    counts,
+        'mean': mean,
+        'std':  np.sqrt(np.maximum(sqMean - mean * mean, 0.0)),
+    }
+
+    # Sorted by group, then value: each group is a sorted slice
+    ordered = values[np.lexsort((values, ids))]
+    starts  = np.cumsum(counts) - counts
+    for q in Quantiles:
+        idx = starts + np.floor(q * (safe - 1)).astype(np.intp)
+        stats[f'p{round(q * 100)}'] = np.where(counts > 0,
+                                               ordered[np.minimum(idx, len(ordered) - 1)]
+                                               if len(ordered) else 0.0, np.nan)
+    return stats
+
+
+def reductionRatios(values: np.ndarray, optLevel: np.ndarray,
+                    pairIds: np.ndarray) -> np.ndarray:
+    '''
+    values of each row over the values of the O0 row with the same pair id
+    (bench, ket), nan for O0 rows and rows without a (non-zero) O0 counterpart
+    '''
+    if not len(values):
+        return np.empty(0)
+    values = values.astype(np.float64)
+
+    baseline = np.full(pairIds.max() + 1, np.nan)
+    isO0 = optLevel == 'O0'
+    baseline[pairIds[isO0]] = values[isO0]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = values / baseline[pairIds]
+    ratios[isO0 | ~np.isfinite(ratios)] = np.nan
+    return ratios
+
+
+# --------------------------------------------------------------------------- #
+
+def _table(title: str, header: list[str], rows: list[list[str]]) -> list[str]:
+    widths = [max(len(h), *(len(r[i]) for r in rows)) if rows else len(h)
+              for i, h in enumerate(header)]
+    fmt = lambda cells: '  '.join(c.rjust(w) if i > 1 else c.ljust(w)
+                                  for i, (c, w) in enumerate(zip(cells, widths)))
+    return [title, '', fmt(header), fmt(['-' * w for w in widths]),
+            *[fmt(r) for r in rows], '']
+
+
+def _num(x: float) -> str:
+    if np.isnan(x): return '-'
+    return f'{x:,.0f}' if abs(x) >= 100 or float(x).is_integer() else f'{x:.3f}'
+
+
+def report(cols: dict[str, np.ndarray],
+           memcheck: list[tuple[str, str, str, str]],
+           sanitizer: list[tuple[str, str, str, str]] | None = None,
+           generator: list[tuple[str, str, str, str]] | None = None) -> str:
+    '''
+    The report, from the columns of kotai.stats.load and the (bench, ket,
+    optLevel, kind) memcheck, sanitizer and generator rows of
+    kotai.results.ResultStore.rows. Each run has a row of either memcheck or
+    sanitizer, never both.
+    '''
+    (benches, _), pairIds = _factorize(cols['bench'], cols['ket'])
+    lines = [f'Jotai report: {len(cols["bench"])} CFGgrind result(s), '
+             f'{len(benches)} benchmark(s)', '']
+
+    # Undefined behavior: memcheck/sanitizer failures per (optLevel, ket)
+    ub = np.array([*memcheck, *(sanitizer or [])], dtype=str).reshape(-1, 4)
+    keys, ids = _groups(ub[:, 2], ub[:, 1])
+    runs     = np.bincount(ids, minlength=len(keys))
+    fails    = np.bincount(ids, weights=ub[:, 3] == 'fail', minlength=len(keys))
+    timeouts = np.bincount(ids, weights=ub[:, 3] == 'timeout', minlength=len(keys))
+    bySan    = np.bincount(ids[len(memcheck):], minlength=len(keys))
+    lines += _table('Undefined behavior (memcheck/sanitizer failures)',
+                    ['optLevel', 'ket', 'runs', 'ub', 'ub%', 'timeouts', 'sanitizer'],
+                    [[o, k or '-', _num(r), _num(f), f'{100 * f / r:.2f}', _num(t), _num(s)]
+                     for (o, k), r, f, t, s in zip(keys, runs, fails, timeouts, bySan)])
+
+    # --generator diff: kets where the native generator wrote what Jotai did
+    if generator:
+        gen = np.array(generator, dtype=str).reshape(-1, 4)
+        (genKets,), ids = _factorize(gen[:, 1])
+        runs = np.bincount(ids, minlength=len(genKets))
+        same = np.bincount(ids, weights=gen[:, 3] == 'ok', minlength=len(genKets))
+        lines += _table('Native generator vs. Jotai (--generator diff)',
+                        ['ket', 'runs', 'same', 'same%'],
+                        [[k, _num(r), _num(m), f'{100 * m / r:.2f}']
+                         for k, r, m in zip(genKets, runs, same)])
+
+    keys, ids = _groups(cols['optLevel'], cols['ket'])
+    complete  = groupMean(ids, len(keys), cols['complete'] > 0)
+    halted    = groupMean(ids, len(keys), cols['halt'] > 0)
+    qs = [f'p{round(q * 100)}' for q in Quantiles]
+
+    for column in ('dynamic_instructions', 'static_instructions'):
+        stats = groupStats(ids, len(keys), cols[column])
+        lines += _table(f'{column} per optLevel/ket',
+                        ['optLevel', 'ket', 'n', 'mean', 'std', *qs],
+                        [[o, k or '-', *[_num(stats[s][g]) for s in ['n', 'mean', 'std', *qs]]]
+                         for g, (o, k) in enumerate(keys)])
+
+    lines += _table('Completeness per optLevel/ket',
+                    ['optLevel', 'ket', 'complete%', 'halt%'],
+                    [[o, k or '-', f'{100 * complete[g]:.2f}', f'{100 * halted[g]:.2f}']
+                     for g, (o, k) in enumerate(keys)])
+
+    # O0 -> On: ratios of the same (bench, ket), geometric mean and quantiles
+    for column in ('dynamic_instructions', 'static_instructions'):
+        ratios = reductionRatios(cols[column], cols['optLevel'], pairIds)
+        paired = np.isfinite(ratios) & (ratios > 0)
+        stats  = groupStats(ids[paired], len(keys), ratios[paired])
+        geomean = np.exp(groupMean(ids[paired], len(keys), np.log(ratios[paired])))
+        lines += _table(f'{column} O0 -> On ratio (On / O0)',
+                        ['optLevel', 'ket', 'pairs', 'geomean', 'p25', 'p50', 'p75'],
+                        [[o, k or '-', _num(stats['n'][g]),
+                          _num(geomean[g]),
+                          _num(stats['p25'][g]), _num(stats['p50'][g]), _num(stats['p75'][g])]
+                         for g, (o, k) in enumerate(keys) if o != 'O0'])
+
+    return '\n'.join(lines)
+
+
+
+def writeReport(dataset: Path, store: ResultStore, ubstats: Path) -> str:
+    '''Reports on dataset and the memcheck/sanitizer rows of store, into ubstats'''
+    text = report(load(dataset), store.rows('memcheck'), store.rows('sanitizer'),
+                  store.rows('generator'))
+    try:
+        ubstats.parent.mkdir(parents=True, exist_ok=True)
+        ubstats.write_text(text + '\n', encoding='utf-8')
+    except OSError as e:
+        logging.error(f'{e}: report [{ubstats}]')
+    return text
+
+
+# =========================================================================== #
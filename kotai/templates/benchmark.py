@@ -1,11 +1,20 @@
 
+import re
+
+from kotai.cache import digest
 from kotai.logconf import sep, src_sep
 
 indent = '    '
 
 runtimeInfoPlaceholder = '// [JOTAI-RUNTIME-INFO] //'
 
-GenBenchTemplatePrefix: str = (f'''{src_sep}\n'''
+# Guard around the prelude: a precompiled header of GenBenchPrelude defines
+# it, so the copy inside each genBench is skipped when compiling with --pch
+GenBenchPreludeGuard: str = 'JOTAI_GENBENCH_PRELUDE'
+
+GenBenchPrelude: str = (f'''#ifndef {GenBenchPreludeGuard}
+#define {GenBenchPreludeGuard}
+'''
 '''
 // includes
 #include "stdio.h"
@@ -32,7 +41,12 @@ int usage() {
 ");
     return 1;
 }
-''' f'''
+
+#endif
+''')
+
+GenBenchTemplatePrefix: str = (f'''{src_sep}\n
+{GenBenchPrelude}
 {sep}
 {runtimeInfoPlaceholder}\n\n
 ''')
@@ -61,3 +75,19 @@ def genSwitch(idx: int, out: str, ketDesc: str = '') -> str:
         f'{indent*2}{out}\n'
         f'{indent*2}break;\n'
     )
+
+# ket -> case number of the switch of a genBench written with genSwitch
+_caseRe = re.compile(rf'^{indent}// (\S+)\n{indent}case (\d+):$', re.M)
+
+def switchCases(genBench: str) -> dict[str, int]:
+    '''Case number of each ket in the switch of genBench, in case order'''
+    return {ket: int(idx) for ket, idx in _caseRe.findall(genBench)}
+
+# Key used by the stage cache: editing any template above invalidates every
+# genBench generated with the previous version
+templateDigest: str = digest(GenBenchTemplatePrefix,
+                             GenBenchTemplateMainBegin,
+                             GenBenchTemplateMainEnd,
+                             GenBenchSwitchBegin,
+                             GenBenchSwitchEnd,
+                             genSwitch(0, '', 'ket'))
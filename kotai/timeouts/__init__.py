@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# =========================================================================== #
+
+import json
+import logging
+import math
+import os
+from pathlib import Path
+from typing import Iterable
+
+from kotai.cache import tmpPath
+from kotai.kotypes import CmdSample, ResultKind
+
+# --------------------------------------------------------------------------- #
+'''
+Adaptive timeouts (--adaptive-timeouts).
+
+Every runproc call of a tool records its wall time (see CmdSample). The
+recent runtimes of each tool are kept in a json file across runs, and the
+next run can set the timeout of each tool from them:
+
+    clamp(percentile(runtimes, RuntimeStats.percentile) * RuntimeStats.multiplier,
+          RuntimeStats.floor, RuntimeStats.ceiling)
+
+so a fast tool gives up on a hung benchmark sooner, and a slow one stops
+killing benchmarks that were about to finish. A run that hit the timeout is
+recorded at its wall time, i.e., the timeout: it needed at least that, so
+enough of them raise the next timeout instead of leaving it where it was.
+Runs stopped by their --limit are not recorded, their wall time says
+nothing about the runtime.
+'''
+# --------------------------------------------------------------------------- #
+
+class RuntimeStats:
+
+    # ---------------------------- Static attrs. ---------------------------- #
+
+    percentile: float = 99.0
+    multiplier: float = 3.0
+
+    # Bounds of the adaptive timeouts, in seconds
+    floor: float   = 1.0
+    ceiling: float = 60.0
+
+    # A tool with fewer runtimes than this keeps its default timeout
+    minSamples: int = 32
+
+    # Most recent runtimes kept per tool
+    maxSamples: int = 4096
+
+    # ---------------------------- Member attrs. ---------------------------- #
+
+    __slots__ = (
+        'path',
+        'runtimes',
+    )
+
+    def __init__(self, path: Path):
+        self.path: Path                       = path
+        self.runtimes: dict[str, list[float]] = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as fhandle:
+                loaded = json.load(fhandle)
+        except (OSError, ValueError):
+            return
+        if isinstance(loaded, dict):
+            self.runtimes = {tool: [float(t) for t in ts]
+                             for tool, ts in loaded.items()
+                             if isinstance(ts, list)}
+
+    def add(self, samples: Iterable[CmdSample]) -> None:
+        for sample in samples:
+            if sample.kind == ResultKind.LIMIT:
+                continue
+            runtimes = self.runtimes.setdefault(sample.tool, [])
+            runtimes.append(sample.seconds)
+            if len(runtimes) > 2 * RuntimeStats.maxSamples:
+                del runtimes[:-RuntimeStats.maxSamples]
+
+    def merge(self, other: 'RuntimeStats') -> None:
+        '''Adds the runtimes of other (e.g. of a --shard run)'''
+        for tool, runtimes in other.runtimes.items():
+            merged = self.runtimes.setdefault(tool, [])
+            merged += runtimes
+            del merged[:-RuntimeStats.maxSamples]
+
+    def timeout(self, tool: str, default: float) -> float:
+        '''Adaptive timeout of tool, or default without enough runtimes'''
+        runtimes = self.runtimes.get(tool, [])
+        if len(runtimes) < RuntimeStats.minSamples:
+            return default
+        ordered = sorted(runtimes[-RuntimeStats.maxSamples:])
+        rank = math.ceil(RuntimeStats.percentile / 100 * len(ordered)) - 1
+        timeout = ordered[min(max(rank, 0), len(ordered) - 1)] * RuntimeStats.multiplier
+        return min(max(timeout, RuntimeStats.floor), RuntimeStats.ceiling)
+
+    def save(self) -> None:
+        tmpFile = tmpPath(self.path)
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmpFile, 'w', encoding='utf-8') as fhandle:
+                json.dump({tool: [round(t, 4) for t in ts[-RuntimeStats.maxSamples:]]
+                           for tool, ts in self.runtimes.items()}, fhandle)
+            os.replace(tmpFile, self.path)
+        except OSError as e:
+            logging.error(f'{e}: runtimes [{self.path}]')
+            tmpFile.unlink(missing_ok=True)
+
+
+
+# =========================================================================== #
@@ -0,0 +1,24 @@
+import sys
+from pathlib import Path
+from typing import Callable
+
+import pytest
+
+from kotai.kotypes import setLog
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    '''No worker log files from the tests'''
+    setLog(False)
+
+
+@pytest.fixture
+def pyScript(tmp_path: Path) -> Callable[[str, str], Path]:
+    '''Writes an executable Python script, e.g. a fake tool, to tmp_path'''
+    def write(name: str, body: str) -> Path:
+        script = tmp_path / name
+        script.write_text(f'#!{sys.executable}\n{body}')
+        script.chmod(0o755)
+        return script
+    return write
@@ -0,0 +1,83 @@
+from pathlib import Path
+
+import pytest
+
+from kotai.artifacts import Artifacts, Pack, packedFiles, readRecord
+from kotai.cache import fileDigest
+
+
+@pytest.fixture
+def packed(tmp_path, monkeypatch):
+    '''Pack storage under tmp_path/artifacts'''
+    monkeypatch.setattr(Artifacts, 'storage', 'pack')
+    monkeypatch.setattr(Artifacts, 'root', tmp_path / 'artifacts')
+    monkeypatch.setattr(Artifacts, 'compress', True)
+    monkeypatch.setattr(Artifacts, '_opened', {})
+    return tmp_path / 'artifacts'
+
+
+def test_pack_artifacts(tmp_path, packed):
+    bench = tmp_path / 'bench' / 'fn.c'
+    artifacts = Artifacts(bench)
+    assert artifacts.workDir.parent.parent.parent == packed / 'work'
+    assert not artifacts.exists('descriptor')
+
+    artifacts.write('descriptor', 'old')
+    artifacts.write('descriptor', 'function fn int')
+    assert Artifacts(bench).read('descriptor') == 'function fn int'
+
+    # Tools get temp files, and what they write there is packed
+    with artifacts.files('descriptor', 'fn_O0_big-arr.info', 'fn_O0') as (desc, info, binary):
+        assert binary == artifacts.workDir / 'fn_O0' and not desc.is_relative_to(artifacts.workDir)
+        assert desc.read_text() == 'function fn int'
+        info.write_text('{"invoked": 1}')
+        artifacts.store('fn_O0_big-arr.info', info)
+        assert artifacts.digest('fn_O0_big-arr.info') == fileDigest(info)
+    assert not desc.exists()
+
+    [(path, _, record)] = packedFiles(packed, '.info')
+    assert path == str(bench.with_suffix('.d') / 'fn_O0_big-arr.info')
+    assert readRecord(Path(record[0]), *record[1:]) == b'{"invoked": 1}'
+
+    artifacts.remove()
+    assert not Artifacts(bench).exists('descriptor')
+    assert list(packedFiles(packed, '.info')) == []
+
+
+def test_pack_index_shards(tmp_path, packed, monkeypatch):
+    monkeypatch.setattr(Artifacts, 'packs', 1)
+    benches = [tmp_path / f'fn{i}.c' for i in range(16)]
+    for bench in benches:
+        Artifacts(bench).write('descriptor', bench.stem)
+
+    # A lookup only reads the shard of its benchmark
+    pack = Pack(packed / 'packs', 0)
+    for bench in benches:
+        key = Artifacts(bench).key
+        assert pack.indexPath(key).read_text().count(f'{key}\t') == 1
+        assert pack.lookup(key).keys() == {'descriptor'}
+    assert len(list(pack.indexDir.glob('*.idx'))) > 1
+
+    # Records appended by another worker are seen by the next lookup
+    Pack(packed / 'packs', 0).put(Artifacts(benches[0]).key, 'descriptor', b'new')
+    assert Artifacts(benches[0]).read('descriptor') == 'new'
+
+
+def test_scratch_artifacts(tmp_path, monkeypatch):
+    monkeypatch.setattr(Artifacts, 'scratch', tmp_path / 'scratch')
+    artifacts = Artifacts(tmp_path / 'fn.c')
+
+    # Only what's outside the keep-set, and produced by clang/CFGgrind
+    for name in ('descriptor', 'constraint_big-arr', 'manifest', 'fn.c', 'fn_O0_big-arr.info'):
+        assert artifacts.path(name) == tmp_path / 'fn.d' / name
+    names = ['fn_O0', 'fn_O0_san', 'fn_O0.map', 'fn_O0_big-arr.cfg', 'fn_Ofast', 'fn_Ofast.map']
+    for name in names:
+        assert artifacts.path(name) == artifacts.scratchDir / name
+
+    artifacts.scratchDir.mkdir(parents=True)
+    for name in names:
+        artifacts.path(name).touch()
+    artifacts.clearScratch(['O0'])
+    assert sorted(p.name for p in artifacts.scratchDir.iterdir()) == ['fn_Ofast', 'fn_Ofast.map']
+    artifacts.clearScratch(['Ofast'])
+    assert not artifacts.scratchDir.exists()
@@ -0,0 +1,51 @@
+import os
+
+from kotai.cache import ContentCache, Manifest, digest
+
+
+def test_manifest_hit(tmp_path):
+    out = tmp_path / 'descriptor'
+    key = digest('source', 'clang', '-cc1')
+
+    manifest = Manifest(tmp_path)
+    assert not manifest.hit('descriptor', key, out)
+
+    out.write_text('function foo')
+    manifest.record('descriptor', key)
+
+    # A fresh instance reads the keys back from disk
+    manifest = Manifest(tmp_path)
+    assert manifest.hit('descriptor', key, out)
+    assert not manifest.hit('descriptor', digest('source', 'clang'), out)
+
+    out.unlink()
+    assert not manifest.hit('descriptor', key, out)
+
+
+def test_digest_parts_are_delimited():
+    assert digest('ab', 'c') != digest('a', 'bc')
+
+
+def test_content_cache_lru(tmp_path):
+    cache = ContentCache(tmp_path / 'store', maxBytes=250)
+    for i, key in enumerate(['aa1', 'bb2', 'cc3']):
+        src = tmp_path / key
+        src.write_bytes(b'x' * 100)
+        cache.put(key, src)
+        os.utime(cache._path(key), (i, i))
+
+    # Refreshes 'aa1', so 'bb2' becomes the least recently used entry
+    assert cache.get('aa1', tmp_path / 'out')
+    assert (tmp_path / 'out').read_bytes() == b'x' * 100
+    assert not cache.get('dd4', tmp_path / 'out')
+
+    # Entries still linked from elsewhere hold no space of their own
+    assert cache.evict() == (0, 0)
+    for key in ['aa1', 'bb2', 'cc3']:
+        (tmp_path / key).unlink()
+    assert cache.evict() == (0, 0)
+    (tmp_path / 'out').unlink()
+
+    assert cache.evict() == (1, 100)
+    assert not cache.get('bb2', tmp_path / 'out')
+    assert cache.get('cc3', tmp_path / 'out')
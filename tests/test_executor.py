@@ -0,0 +1,135 @@
+import resource
+import sys
+import time
+
+from kotai.executor import AsyncEngine, asyncConcurrency, newPool
+from kotai import kotypes
+from kotai.kotypes import (CmdSample, Limits, ResultKind, drainSamples, failure,
+                           limitsOf, arunproc, runproc, setLimits, setProcEngine,
+                           setTimeoutRetry, spawnLimits, success)
+from kotai.timeouts import RuntimeStats
+
+
+def test_runproc_same_contract_in_async_engine(tmp_path):
+    script = 'import sys, time; print("out"); sys.stdout.flush(); time.sleep(float(sys.argv[1]))'
+
+    def runs():
+        return [runproc([sys.executable, '-c', script, '0'], 5.0),
+                runproc([sys.executable, '-c', script, '5'], 0.5),
+                runproc([sys.executable, '-c', 'raise SystemExit(3)'], 5.0),
+                runproc(['/nonexistent/tool'], 5.0),
+                runproc([sys.executable, '-c', script, '0'], 5.0,
+                        ofpath=tmp_path / 'out', breakLines=True)]
+
+    expected = runs()
+    assert [r.err for r in expected] == [success, failure, failure, failure, success]
+    assert expected[1].msg == 'out\n'
+
+    # Only the default engine knows the rusage of the child (os.wait4)
+    assert expected[1].usage.signal == 9 and expected[0].usage.maxRss > 0
+    assert expected[3].usage is None
+    expected = [r._replace(usage=None) for r in expected]
+
+    engine = AsyncEngine(2)
+    setProcEngine(engine)
+    try:
+        assert runs() == expected
+    finally:
+        setProcEngine(None)
+        engine.close()
+    assert (tmp_path / 'out').read_text() == 'out\n'
+
+
+def test_async_concurrency_beyond_nproc():
+    # 64 half-second commands in flight at once, from a single process
+    sleeper = [sys.executable, '-c', 'import time; time.sleep(0.5)']
+    start = time.monotonic()
+    with newPool('async', asyncConcurrency(64)) as pool:
+        results = pool.map(lambda _: arunproc(sleeper, 10.0), range(64), 1)
+    assert [r.err for r in results] == [success] * 64
+    assert time.monotonic() - start < 8.0
+
+    # Never more than RLIMIT_NOFILE allows
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        assert asyncConcurrency(hard) < hard
+        assert resource.getrlimit(resource.RLIMIT_NOFILE)[0] == hard
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+def test_adaptive_timeouts_and_retry(tmp_path):
+    stats = RuntimeStats(tmp_path / 'runtimes.json')
+    stats.add([CmdSample('clang', 0.1, ResultKind.OK)] * (RuntimeStats.minSamples - 1))
+    stats.add([CmdSample('clang', 0.5, ResultKind.LIMIT)])
+    assert stats.timeout('clang', 3.0) == 3.0  # Not enough samples yet
+
+    stats.add([CmdSample('clang', 0.2, ResultKind.FAIL)])
+    stats.save()
+    stats = RuntimeStats(tmp_path / 'runtimes.json')
+    assert stats.timeout('clang', 3.0) == max(0.2 * RuntimeStats.multiplier,
+                                              RuntimeStats.floor)
+
+    # A timed out run needed at least its timeout: it can grow back
+    stats.add([CmdSample('clang', 3.0, ResultKind.TIMEOUT)])
+    assert stats.timeout('clang', 3.0) == min(3.0 * RuntimeStats.multiplier,
+                                              RuntimeStats.ceiling)
+
+    sleeper = [sys.executable, '-c', 'import time; time.sleep(0.5)']
+    drainSamples()
+    try:
+        assert runproc(sleeper, 0.1, tool='sleep').kind == ResultKind.TIMEOUT
+        setTimeoutRetry(20.0)
+        assert runproc(sleeper, 0.1, tool='sleep').kind == ResultKind.OK
+    finally:
+        setTimeoutRetry(0.0)
+    assert [s.kind for s in drainSamples()] == [ResultKind.TIMEOUT] * 2 + [ResultKind.OK]
+
+
+def test_runproc_sandbox(tmp_path, monkeypatch):
+    setLimits(Limits(), {'spin':  Limits(cpu=1),
+                         'write': Limits(fileSize=1 << 16)})
+    try:
+        # Without --limit, tools inherit the core limit: no wrapper at all
+        assert spawnLimits(limitsOf('any')) == ([], None)
+        prefix, preexec = spawnLimits(limitsOf('spin'))
+        assert prefix[-2:] == ['--cpu=1:2', '--'] and preexec is None
+
+        # No core dumps by default, already set when the tool starts
+        script = 'import resource; print(resource.getrlimit(resource.RLIMIT_CORE)[0])'
+        for engine in (None, AsyncEngine(2)):
+            setProcEngine(engine)
+            try:
+                assert runproc([sys.executable, '-c', script], 5.0, tool='any').msg == '0\n'
+            finally:
+                setProcEngine(None)
+                if engine:
+                    engine.close()
+
+        spin = runproc([sys.executable, '-c', 'while True: pass'], 10.0, tool='spin')
+        assert spin.kind == ResultKind.LIMIT and not spin.timedOut
+        # No prlimit: the same limits, from a preexec_fn
+        monkeypatch.setattr(kotypes, '_prlimit', None)
+        spin = runproc([sys.executable, '-c', 'while True: pass'], 10.0, tool='spin')
+        assert spin.kind == ResultKind.LIMIT and not spin.timedOut
+        monkeypatch.undo()
+        write = runproc([sys.executable, '-c', f'open({str(tmp_path / "big")!r}, "w").write("x" * (1 << 20))'],
+                        5.0, tool='write')
+        assert write.kind == ResultKind.LIMIT
+        assert runproc([sys.executable, '-c', 'raise SystemExit(1)'], 5.0, tool='spin').kind == ResultKind.FAIL
+
+        # The grandchild holds the pipes: killed with its group on timeout
+        for engine in (None, AsyncEngine(2)):
+            setProcEngine(engine)
+            try:
+                start = time.monotonic()
+                res = runproc(['sh', '-c', 'sleep 30 & sleep 30'], 0.3, tool='any')
+                assert res.kind == ResultKind.TIMEOUT and time.monotonic() - start < 5.0
+                # The child exits at once, its grandchild keeps the pipes
+                res = runproc(['sh', '-c', 'sleep 30 &'], 0.3, tool='any')
+                assert res.kind == ResultKind.TIMEOUT and time.monotonic() - start < 5.0
+            finally:
+                setProcEngine(None)
+                if engine:
+                    engine.close()
+    finally:
+        setLimits(Limits())
@@ -0,0 +1,142 @@
+import logging
+import sys
+from pathlib import Path
+
+import pytest
+
+from kotai.artifacts import Artifacts
+from kotai.cache import ContentCache, Manifest
+from kotai.console import application as app
+from kotai.constraints.genkonstrain import Konstrain
+from kotai.generator import Generator
+from kotai.kotypes import BenchInfo, CmdResult, drive, success, valid
+from kotai.metrics import Metrics
+from kotai.plugin.CFGgrind import CFGgrind
+from kotai.plugin.Clang import Clang
+from kotai.plugin.Jotai import Jotai
+from kotai.plugin.PrintDescriptors import PrintDescriptors
+from kotai.schedule import Scheduler
+from kotai.templates.benchmark import (GenBenchSwitchBegin, GenBenchSwitchEnd,
+                                       genSwitch, switchCases)
+
+
+# Static attrs set by the options of Application
+_options = [
+    (Manifest, ['enabled']),
+    (Konstrain, ['servers', 'cache']),
+    (PrintDescriptors, ['batchSize']),
+    (Jotai, ['batch']),
+    (Generator, ['mode']),
+    (Artifacts, ['storage', 'root', 'compress', 'scratch', 'keep']),
+    (Clang, ['cache', 'objKeyKind']),
+    (CFGgrind, ['ubScreen', 'memcheckFallback']),
+    (Metrics, ['interval', 'workers']),
+    (Scheduler, ['kind']),
+]
+
+
+@pytest.fixture
+def application(tmp_path, monkeypatch):
+    '''Application of the given options, run from tmp_path, undone afterwards'''
+    for cls, attrs in _options:
+        for attr in attrs:
+            monkeypatch.setattr(cls, attr, getattr(cls, attr))
+    monkeypatch.chdir(tmp_path)
+    built = []
+
+    def build(*argv: str) -> app.Application:
+        monkeypatch.setattr(sys, 'argv', ['kotai', '--no-log', '-i', str(tmp_path), *argv])
+        built.append(app.Application())
+        return built[-1]
+
+    yield build
+    for application in built:
+        application.store.close()
+    logging.getLogger().disabled = False
+    logging.getLogger().propagate = True
+
+
+def test_pipeline_stops_at_first_failed_stage(monkeypatch):
+    def ok(stage):
+        async def fn(pArgs):
+            pArgs.exitCodes = {stage: success}
+            pArgs.cacheHits = {stage: True}
+            return pArgs
+        return fn
+
+    async def fail(pArgs):
+        pArgs.cacheHits = {'fail': False}
+        return pArgs.Err('fail')
+
+    monkeypatch.setattr(app, '_pipeline', [(ok('a'), ''), (fail, ''), (ok('b'), '')])
+    res, passed = drive(app._runPipeline(BenchInfo(Path('x.c'))))
+    assert passed == 1
+    assert not res
+    assert res.cacheHits == {'a': True, 'fail': False}
+
+
+def test_cfggrind_cases_fan_in():
+    genBench = (GenBenchSwitchBegin + genSwitch(0, 'a();', 'big-arr')
+                + genSwitch(1, 'b();', 'int-bounds') + GenBenchSwitchEnd)
+    assert switchCases(genBench) == {'big-arr': 0, 'int-bounds': 1}
+
+    pArgs = BenchInfo(Path('a.c'), 'fn', ketList=list(switchCases(genBench)),
+                      optLevelList=['O2'], exitCodes={'clang_O2': success},
+                      cacheHits={'asmmap_O2': True})
+    cases = app._fanOutCases(pArgs)
+    cases[1].cacheHits = {'cfggrind_O2_int-bounds': False}
+    assert [(c.ketList, c.optLevelList) for c in cases] == [(['big-arr'], ['O2']),
+                                                            (['int-bounds'], ['O2'])]
+
+    # The binary survives as long as one of its cases does
+    cases[0].Err('cfggrind_O2_big-arr')
+    assert valid(merged := app._fanInCases(pArgs, cases)) and merged.ketList == ['int-bounds']
+    assert merged.cacheHits == {'asmmap_O2': True, 'cfggrind_O2_int-bounds': False}
+    cases[1].Err('cfggrind_O2_int-bounds')
+    assert not valid(app._fanInCases(pArgs, cases))
+
+
+def test_konstrain_memo(tmp_path, monkeypatch):
+    calls = []
+    async def runcmd(self, *args):
+        calls.append(self.descriptor.read_text())
+        self.ofile.write_text(f'constraints of {calls[-1]} {self.ket}\n')
+        return CmdResult('', success)
+    monkeypatch.setattr(Konstrain, 'runcmd', runcmd)
+    monkeypatch.setattr(Konstrain, 'cache', ContentCache(tmp_path / 'memo', 1 << 20))
+
+    # Two benchmarks with the same descriptor text, one with another
+    benches = [tmp_path / f'{name}.c' for name in ('a', 'b', 'c')]
+    for bench, text in zip(benches, ['function f int', 'function f int', 'function g int']):
+        Artifacts(bench).workDir.mkdir()
+        Artifacts(bench).write('descriptor', text)
+
+    results = [drive(app._runKonstrain(BenchInfo(b, ketList=['int-bounds', 'big-arr'])))
+               for b in benches]
+    assert sorted(calls) == ['function f int'] * 2 + ['function g int'] * 2
+    assert [r.cacheHits['konstraincache_big-arr'] for r in results] == [False, True, False]
+    assert (Artifacts(benches[1]).read('constraint_big-arr')
+            == 'constraints of function f int big-arr\n')
+
+    # A later run on its own (the manifest is stale) never writes into the cache
+    (benches[0].parent / 'a.d' / 'manifest').unlink()
+    calls.clear()
+    drive(app._runKonstrain(BenchInfo(benches[0], ketList=['big-arr'])))
+    assert not calls
+    Artifacts(benches[0]).write('descriptor', 'function h int')
+    drive(app._runKonstrain(BenchInfo(benches[0], ketList=['big-arr'])))
+    assert calls == ['function h int']
+    assert (Artifacts(benches[1]).read('constraint_big-arr')
+            == 'constraints of function f int big-arr\n')
+
+
+def test_scratch_root_created(tmp_path, application):
+    # Neither the scratch dir nor its parent exist before the run
+    scratch = tmp_path / 'shm' / 'kotai'
+    application('--storage', 'pack', '--scratch-dir', str(scratch))
+    assert scratch.is_dir()
+
+    artifacts = Artifacts(tmp_path / 'fn.c')
+    artifacts.write('descriptor', 'function fn int')
+    with artifacts.files('descriptor') as [desc]:
+        assert desc.is_relative_to(scratch) and desc.read_text() == 'function fn int'
@@ -0,0 +1,147 @@
+import pickle
+import time
+from pathlib import Path
+
+import pytest
+
+from kotai.kotypes import (BenchInfo, CmdSample, ResultKind, Rusage, StageRecord,
+                           failure, setBenchTable, success)
+from kotai.metrics import Metrics
+from kotai.results import ResultStore
+from kotai.schedule import Scheduler
+
+
+@pytest.fixture
+def benches(tmp_path):
+    '''Sources of 10, 1000, 100 and 20 bytes'''
+    paths = []
+    for name, size in [('a', 10), ('b', 1000), ('c', 100), ('d', 20)]:
+        paths.append(tmp_path / f'{name}.c')
+        paths[-1].write_text('x' * size)
+    return paths
+
+
+def test_results_store(tmp_path):
+    store = ResultStore(tmp_path / 'results.db')
+    store.add([StageRecord('a.c', 'clang', '', 'O0', ResultKind.OK, 0.1, False, ('a_O0',)),
+               StageRecord('b.c', 'konstrain', 'big-arr', '', ResultKind.TIMEOUT, 3.0, False)])
+    store.finish(Path('a.c'), ['O0', 'O1'], True)
+    store.finish(Path('b.c'), ['O0'], False)
+    store.close()
+
+    store = ResultStore(tmp_path / 'results.db')
+    assert store.finished(['O0']) == {'a.c', 'b.c'}
+    assert store.finished(['O0', 'O1']) == {'a.c'}
+    assert store.finished(['O0'], [Path('b.c'), Path('c.c')]) == {'b.c'}
+    assert store.select([ResultKind.TIMEOUT]) == ['b.c']
+    store.forget([Path('b.c')])
+    assert store.select([ResultKind.TIMEOUT, ResultKind.FAIL]) == []
+    store.close()
+
+
+def test_shards_and_merge(tmp_path):
+    from kotai.console.application import _inShard
+
+    # Every benchmark lands in exactly one shard, the same one every time
+    paths = [Path(f'fn_{i}.c') for i in range(1000)]
+    shards = [[p for p in paths if _inShard(p, (i, 3))] for i in range(3)]
+    assert sorted(p for s in shards for p in s) == sorted(paths)
+    assert all(250 < len(s) < 420 for s in shards)
+
+    for i, kind in enumerate([ResultKind.FAIL, ResultKind.OK]):
+        store = ResultStore(tmp_path / f's{i}' / 'results.db')
+        store.add([StageRecord(f'{i}.c', 'clang', '', 'O0', kind, 0.1, False),
+                   StageRecord('both.c', 'clang', '', 'O0', kind, 0.1, False)])
+        store.close()
+        time.sleep(0.01)
+
+    merged = ResultStore(tmp_path / 'results.db')
+    assert merged.merge(tmp_path / 's0' / 'results.db') == 2
+    assert merged.merge(tmp_path / 's1' / 'results.db') == 2
+    assert merged.merge(tmp_path / 's0' / 'results.db') == 1    # 0.c only
+    assert sorted(merged.rows('clang')) == [('0.c', '', 'O0', 'fail'),
+                                            ('1.c', '', 'O0', 'ok'),
+                                            ('both.c', '', 'O0', 'ok')]
+    merged.close()
+
+
+def test_metrics(tmp_path):
+    metrics = Metrics(tmp_path / 'metrics.prom')
+    metrics.submit('clang', 4)
+    metrics.observe([StageRecord('a.c', 'clang', '', 'O0', ResultKind.OK, 1.0, False),
+                     StageRecord('b.c', 'clang', '', 'O0', ResultKind.TIMEOUT, 3.0, False),
+                     StageRecord('c.c', 'clang', '', 'O0', ResultKind.OK, 0.0, True)])
+    metrics.tick(force=True)
+
+    assert metrics.stages['clang'].inFlight == 1
+    prom = (tmp_path / 'metrics.prom').read_text().splitlines()
+    assert 'kotai_stage_records_total{stage="clang",kind="ok"} 2' in prom
+    assert 'kotai_stage_records_total{stage="clang",kind="timeout"} 1' in prom
+    assert 'kotai_stage_in_flight{stage="clang"} 1' in prom
+    assert 'kotai_stage_latency_seconds_count{stage="clang"} 2' in prom
+    assert 'kotai_stage_latency_seconds{stage="clang",quantile="0.95"} 3.000000' in prom
+
+    usage = Rusage(2.0, 1.5, 0.25, 2048, 9)
+    metrics.observeSamples([CmdSample('clang', 2.0, ResultKind.TIMEOUT, usage),
+                            CmdSample('clang', 1.0, ResultKind.OK)])
+    assert [line.split() for line in metrics.usageSummary()][2] == \
+        ['clang', '1', '2.0', '1.5', '0.2', '88', '2.0', '1']
+
+
+def test_bench_info_pickle():
+    # No state shared between instances through the default arguments
+    a, b = BenchInfo(Path('a.c')), BenchInfo(Path('b.c'))
+    a.exitCodes['descriptor'] = success
+    a.ketList.append('big-arr')
+    assert b.exitCodes == {} and b.ketList == []
+
+    paths = [Path(f'/bench/dir/fn_{i}.c') for i in range(100)]
+    bi = BenchInfo(paths[42], 'fn', ['int-bounds', 'big-arr'], ['O0', 'Oz'],
+                   {'clang_O0': success, 'big-arr': failure})
+    setBenchTable([])
+    unindexed = pickle.dumps(bi)
+    setBenchTable(paths)
+    try:
+        packed = pickle.dumps(bi)
+        assert len(packed) < len(unindexed)
+        copy = pickle.loads(packed)
+        assert (copy.cFilePath, copy.fnName, copy.ketList, copy.optLevelList,
+                copy.exitCodes) == (bi.cFilePath, bi.fnName, bi.ketList,
+                                    bi.optLevelList, bi.exitCodes)
+        assert copy.exitCodes['big-arr'] is failure
+    finally:
+        setBenchTable([])
+
+
+def test_scheduler(benches, monkeypatch):
+    # a and c ran before, b and d are estimated from their size
+    scheduler = Scheduler(0, 2, {'cfggrind': 0.01})
+    order = scheduler.order(benches, {str(benches[0]): 1.0, str(benches[2]): 10.0})
+    assert [b.stem for b in order] == ['b', 'c', 'd', 'a']
+    assert scheduler.costs[benches[1]] == 100.0 and scheduler.costs[benches[3]] == 2.0
+    assert scheduler.isHeavy(benches[1]) and not scheduler.isHeavy(benches[2])
+
+    # 0.5s of work per chunk, but at least 4 chunks per worker
+    assert scheduler.chunksize('cfggrind', 10000, None) == 50
+    assert scheduler.chunksize('cfggrind', 80, None) == 10
+    assert scheduler.chunksize('cfggrind', 10000, 1.0) == 1
+    assert Scheduler(16, 2, {}).chunksize('cfggrind', 10000, 1.0) == 16
+    # No cost to estimate, so the benchmarks aren't even looked at
+    monkeypatch.setattr(Scheduler, 'kind', 'input')
+    monkeypatch.setattr('kotai.schedule._proxy', None)
+    assert scheduler.order(benches, {}) == benches
+    assert not scheduler.costs and not scheduler.isHeavy(benches[1])
+
+
+def test_idle_cores(monkeypatch):
+    # 2 workers, 1 second: 0.5s of a stage's records leave 1.5 core-seconds idle
+    monkeypatch.setattr(Metrics, 'workers', 2)
+    metrics = Metrics(None)
+    metrics.submit('clang', 1)
+    metrics.stages['clang'].segment -= 1.0
+    metrics.firstTask -= 1.0
+    metrics.observe([StageRecord('a.c', 'clang', '', 'O0', ResultKind.OK, 0.5, False)])
+    wall, busy, idle = metrics.idle('clang')
+    assert 1.0 <= wall < 1.5 and busy == 0.5 and abs(idle - (2 * wall - 0.5)) < 1e-9
+    assert metrics.idle()[2] == idle
+    assert metrics.idleSummary(True)[0].startswith('Idle cores:')
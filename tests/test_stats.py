@@ -0,0 +1,92 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from kotai.stats import InfoColumns, infoKey, ingest, load
+from kotai.stats.report import groupStats, reductionRatios, report
+
+
+def _info(path: Path, dyn: int) -> None:
+    '''A CFGgrind .info with dyn dynamic instructions'''
+    path.write_text(json.dumps([{
+        'invoked': 1, 'complete': True, 'blocks': 3, 'phantoms': 0,
+        'exit': 1, 'halt': [], 'edges': 4,
+        'static': {'instructions': 10, 'calls': 0, 'signals': 0},
+        'dynamic': {'instructions': dyn, 'calls': 1, 'signals': 0}}]))
+
+
+def test_stats_ingest_incremental(tmp_path):
+    assert infoKey(Path('b/x.d/x_O2.info')) == ('b/x.c', 'O2', '')
+    assert infoKey(Path('b/x.d/x_Ofast_big-arr-10x.info')) == ('b/x.c', 'Ofast', 'big-arr-10x')
+    assert infoKey(Path('b/x.d/y_O2.info')) is None
+
+    (tmp_path / 'a.d').mkdir()
+    _info(tmp_path / 'a.d' / 'a_O0.info', 100)
+    _info(tmp_path / 'a.d' / 'a_O1.info', 50)
+    dataset = tmp_path / 'dataset'
+    assert ingest([tmp_path], dataset, nproc=2) == 2
+    assert ingest([tmp_path], dataset, nproc=2) == 0
+
+    _info(tmp_path / 'a.d' / 'a_O1.info', 40)
+    os.utime(tmp_path / 'a.d' / 'a_O1.info', (0, 1))
+    assert ingest([tmp_path], dataset, nproc=2) == 1
+
+    cols = load(dataset)
+    dyn = dict(zip(cols['optLevel'].tolist(), cols['dynamic_instructions'].tolist()))
+    assert dyn == {'O0': 100, 'O1': 40}
+    assert cols['complete'].tolist() == [1, 1]
+
+
+def test_stats_report():
+    stats = groupStats(np.array([1, 0, 1, 1]), 3, np.array([5, 7, 1, 3]))
+    assert stats['n'].tolist() == [1, 3, 0]
+    assert stats['p50'][:2].tolist() == [7, 3] and np.isnan(stats['p50'][2])
+    assert stats['mean'][:2].tolist() == [7, 3]
+
+    opt = np.array(['O0', 'O2', 'O0', 'O2', 'O2'])
+    ratios = reductionRatios(np.array([100, 50, 10, 40, 7]), opt,
+                             np.array([0, 0, 1, 1, 2]))
+    assert np.isnan(ratios[[0, 2, 4]]).all() and ratios[[1, 3]].tolist() == [0.5, 4.0]
+
+    cols = {'bench': np.array(['a.c', 'a.c']), 'optLevel': np.array(['O0', 'O2']),
+            'ket': np.array(['', ''])}
+    cols |= {c: np.array([10, 5]) for c in InfoColumns}
+    text = report(cols, [('a.c', '', 'O0', 'ok'), ('a.c', '', 'O2', 'fail')],
+                  [('b.c', '', 'O2', 'ok')])
+    rows = [line.split() for line in text.splitlines()]
+    assert ['O2', '-', '2', '1', '50.00', '0', '1'] in rows        # UB
+    assert ['O2', '-', '1', '0.500', '0.500', '0.500', '0.500'] in rows  # O0 -> O2
+
+
+def test_stats_same_name_in_two_dirs(tmp_path):
+    # Two different a.c: never one benchmark, never each other's O0
+    for root, dyn in (('x', 100), ('y', 10)):
+        (tmp_path / root / 'a.d').mkdir(parents=True)
+        _info(tmp_path / root / 'a.d' / 'a_O0.info', dyn)
+        _info(tmp_path / root / 'a.d' / 'a_O2.info', dyn // 2)
+    dataset = tmp_path / 'dataset'
+    assert ingest([tmp_path / 'x', tmp_path / 'y'], dataset, nproc=2) == 4
+
+    cols = load(dataset)
+    assert sorted(set(cols['bench'].tolist())) == [str(tmp_path / r / 'a.c') for r in 'xy']
+    rows = [line.split() for line in report(cols, []).splitlines()]
+    assert rows[0][-2:] == ['2', 'benchmark(s)']
+    assert ['O2', '-', '2', '0.500', '0.500', '0.500', '0.500'] in rows
+
+
+def test_stats_ingest_one_shard(tmp_path):
+    from kotai.console.application import _inShard
+
+    names = [f'fn_{i}' for i in range(20)]
+    for name in names:
+        (tmp_path / f'{name}.d').mkdir()
+        _info(tmp_path / f'{name}.d' / f'{name}_O0.info', 1)
+
+    # Other shards' .info files, in the same dir, stay out of this dataset
+    mine = {name for name in names if _inShard(Path(f'{name}.c'), (0, 2))}
+    assert 0 < len(mine) < len(names)
+    assert ingest([tmp_path], tmp_path / 'dataset', nproc=2,
+                  only=lambda bench: _inShard(Path(bench.name), (0, 2))) == len(mine)
+    assert {Path(b).stem for b in load(tmp_path / 'dataset')['bench']} == mine
@@ -0,0 +1,313 @@
+import sys
+
+import pytest
+
+from kotai.constraints.genkonstrain import Konstrain
+from kotai.generator import Generator, generate
+from kotai.kotypes import (CmdResult, ExitCode, ResultKind, drainSamples, drive,
+                           failure, success)
+from kotai.plugin.CFGgrind import CFGgrind
+from kotai.plugin.Clang import Clang
+from kotai.plugin.Jotai import Jotai
+from kotai.plugin.PrintDescriptors import PrintDescriptors
+from kotai.results import drainStages
+
+
+_fakeKonstrainServer = r'''
+import sys
+print('KONSTRAIN-SERVER 1', flush=True)
+for line in sys.stdin:
+    descriptor, ket = line.rstrip('\n').split('\t')
+    if ket == 'hang':
+        continue
+    print(f'{ket}: {open(descriptor).read().strip()}')
+    print('@@KONSTRAIN-END', 0 if ket != 'bad' else 1, flush=True)
+'''
+
+_fakePrintDescriptors = r'''
+import re, sys
+rc = 0
+for f in [a for a in sys.argv[1:] if a.endswith('.c')]:
+    src = open(f).read()
+    if 'BROKEN' in src:
+        rc = 1
+        continue
+    print('function', re.search(r'(\w+)\s*\(', src).group(1))
+sys.exit(rc)
+'''
+
+_fakeJotai = r'''
+import sys
+args = sys.argv[1:]
+if args[0] == '--batch':
+    if 'nobatch' in sys.argv[0]:
+        sys.exit(f'No such file: {args[0]}')
+    descriptor, constraints = args[1], args[2:]
+else:
+    descriptor, constraints = args[1], args[:1]
+status = 0
+for c in constraints:
+    text = open(c).read().strip()
+    print(f'case({text}, {open(descriptor).read().strip()});')
+    status = int(text == 'bad')
+    if args[0] == '--batch' and status and 'crash' in sys.argv[0]:
+        sys.exit(-11)
+    if args[0] == '--batch':
+        print('@@JOTAI-END', status)
+sys.exit(0 if args[0] == '--batch' else status)
+'''
+
+_fakeClang = r'''
+import sys, time
+args = sys.argv[1:]
+src = open(args[-1]).read()
+with open(sys.argv[0] + '.calls', 'a') as calls:
+    calls.write(' '.join(args) + '\n')
+if '-include-pch' in args and 'stale' in args[args.index('-include-pch') + 1]:
+    sys.exit("fatal error: PCH file built from a different branch")
+if 'SLOW' in src:
+    time.sleep(5)
+if 'BROKEN' in src:
+    sys.exit("error: expected ';' after expression")
+open(args[args.index('-o') + 1], 'w').write('binary')
+'''
+
+
+@pytest.fixture
+def descriptor(tmp_path):
+    path = tmp_path / 'descriptor'
+    path.write_text('function foo')
+    return path
+
+
+@pytest.fixture
+def konstrainServers(monkeypatch):
+    '''Konstrain.servers set by the test, every server shut down after it'''
+    monkeypatch.setattr(Konstrain, 'unsupported', False)
+    yield
+    Konstrain.shutdown()
+
+
+def test_konstrain_server(tmp_path, monkeypatch, descriptor, pyScript, konstrainServers):
+    script = pyScript('server.py', _fakeKonstrainServer)
+    monkeypatch.setattr(Konstrain, 'server', [sys.executable, str(script)])
+    monkeypatch.setattr(Konstrain, 'servers', 2)
+    monkeypatch.setattr(Konstrain, 'timeout', 1.0)
+
+    for ket in ['big-arr', 'int-bounds', 'big-arr-10x']:
+        ofile = tmp_path / f'constraint_{ket}'
+        res = drive(Konstrain(descriptor, ket, ofile).runcmd())
+        assert res.err == success
+        assert ofile.read_text() == f'{ket}: function foo\n'
+
+    assert drive(Konstrain(descriptor, 'bad', tmp_path / 'c').runcmd()).err == failure
+
+    # A server that stops answering is killed, then replaced
+    assert drive(Konstrain(descriptor, 'hang', tmp_path / 'c').runcmd()).err == failure
+    assert drive(Konstrain(descriptor, 'big-arr', tmp_path / 'c').runcmd()).err == success
+    assert not Konstrain.unsupported
+
+    # Every request is timed, like a one-shot Konstrain
+    drainSamples()
+    drive(Konstrain(descriptor, 'big-arr', tmp_path / 'c').runcmd())
+    assert [(s.tool, s.kind) for s in drainSamples()] == [('konstrain', ResultKind.OK)]
+
+
+def test_konstrain_server_fallback(tmp_path, monkeypatch, konstrainServers):
+    calls = []
+
+    async def oneShot(proc_args, timeout, ofpath=None, breakLines=False, tool=''):
+        calls.append(proc_args)
+        return CmdResult('', success)
+
+    # A "jar" that never prints the handshake
+    monkeypatch.setattr(Konstrain, 'server', [sys.executable, '-c', 'pass'])
+    monkeypatch.setattr(Konstrain, 'servers', 1)
+    monkeypatch.setattr('kotai.constraints.genkonstrain.arunproc', oneShot)
+
+    res = drive(Konstrain(tmp_path / 'descriptor', 'big-arr', tmp_path / 'c').runcmd())
+    assert res.err == success
+    assert Konstrain.unsupported
+    assert len(calls) == 1 and calls[0][:2] == ['java', '-jar']
+
+
+def test_konstrain_server_slow_start(tmp_path, monkeypatch, konstrainServers):
+    calls = []
+
+    async def oneShot(proc_args, timeout, ofpath=None, breakLines=False, tool=''):
+        calls.append(proc_args)
+        return CmdResult('', success)
+
+    # A JVM too slow to start isn't a jar without the protocol
+    monkeypatch.setattr(Konstrain, 'server', [sys.executable, '-c', 'import time; time.sleep(5)'])
+    monkeypatch.setattr(Konstrain, 'servers', 1)
+    monkeypatch.setattr(Konstrain, 'startTimeout', 0.2)
+    monkeypatch.setattr('kotai.constraints.genkonstrain.arunproc', oneShot)
+
+    assert drive(Konstrain(tmp_path / 'descriptor', 'big-arr', tmp_path / 'c').runcmd()).err == success
+    assert not Konstrain.unsupported and len(calls) == 1
+
+
+def test_clang_pch_fallback(tmp_path, monkeypatch, pyScript):
+    clang = pyScript('clang', _fakeClang)
+    monkeypatch.setitem(Clang.exe, 'clang', clang)
+    monkeypatch.setattr(Clang, 'timeout', 0.5)
+
+    def compiles(pch, source):
+        (tmp_path / 'fn.c').write_text(source)
+        monkeypatch.setattr(Clang, 'pch', {'O0': tmp_path / pch})
+        (tmp_path / 'clang.calls').unlink(missing_ok=True)
+        res = drive(Clang('O0', tmp_path / 'fn_O0', tmp_path / 'fn.c').runcmd())
+        calls = (tmp_path / 'clang.calls').read_text().splitlines()
+        return res, ['-include-pch' in c for c in calls]
+
+    # Only a rejected PCH gets a second compilation, without it
+    res, calls = compiles('prelude.pch', 'int f();')
+    assert res.err == success and calls == [True]
+    res, calls = compiles('stale.pch', 'int f();')
+    assert res.err == success and calls == [True, False]
+    res, calls = compiles('prelude.pch', 'BROKEN')
+    assert res.err == failure and calls == [True]
+    res, calls = compiles('prelude.pch', 'SLOW')
+    assert res.timedOut and calls == [True]
+
+
+def test_clang_obj_key(tmp_path, monkeypatch, pyScript):
+    clang = pyScript('clang', _fakeClang)
+    monkeypatch.setitem(Clang.exe, 'clang', clang)
+    for name in ('a.c', 'b.c', 'c.c'):
+        (tmp_path / name).write_text('int f();' if name != 'c.c' else 'int g();')
+    key = lambda name, opt='O0': drive(Clang(opt, tmp_path / 'bin', tmp_path / name).objKey())
+
+    # Keyed on the source, clang and flags, without running clang
+    assert key('a.c') == key('b.c') != key('c.c')
+    assert key('a.c') != key('a.c', 'O2')
+    assert not (tmp_path / 'clang.calls').exists()
+
+    monkeypatch.setattr(Clang, 'objKeyKind', 'preprocessed')
+    key('a.c')
+    assert '-E' in (tmp_path / 'clang.calls').read_text().split()
+
+
+def test_print_descriptors_batch(tmp_path, monkeypatch, pyScript):
+    monkeypatch.setitem(PrintDescriptors.exe, 'clang', pyScript('clang', _fakePrintDescriptors))
+    monkeypatch.setattr(PrintDescriptors, '_separator', None)
+    monkeypatch.setattr(PrintDescriptors, '_separatorTried', False)
+
+    ifiles = []
+    for i in range(7):
+        ifiles.append(tmp_path / f'f{i}.c')
+        ifiles[-1].write_text(f'int f{i}(int x) {{ {"BROKEN" if i == 4 else ""} }}')
+
+    results = drive(PrintDescriptors.runbatch(ifiles))
+    assert [r.err for r in results] == [success] * 4 + [failure] + [success] * 2
+    assert [r.msg for r in results if r.err] == [
+        drive(PrintDescriptors(f).runcmd()).msg for i, f in enumerate(ifiles) if i != 4]
+
+
+def test_jotai_batch(tmp_path, monkeypatch, descriptor, pyScript):
+    constraints = []
+    for ket in ['int-bounds', 'bad', 'big-arr']:
+        constraints.append(tmp_path / f'constraint_{ket}')
+        constraints[-1].write_text(ket)
+
+    for name in ('jotai', 'jotai-nobatch', 'jotai-crash'):
+        monkeypatch.setattr(Jotai, 'exe', {'jotai': pyScript(name, _fakeJotai)})
+        monkeypatch.setattr(Jotai, 'batch', False)
+        single = [drive(Jotai(c, descriptor).runcmd()) for c in constraints]
+        monkeypatch.setattr(Jotai, 'batch', True)
+        monkeypatch.setattr(Jotai, 'unsupported', False)
+        monkeypatch.setattr(Jotai, '_batchWorked', False)
+
+        drainSamples()
+        batched = drive(Jotai.runbatch(constraints, descriptor))
+        assert [(r.msg, r.err) for r in batched] == [(r.msg, r.err) for r in single]
+        assert [r.err for r in batched] == [success, failure, success]
+        tools = [s.tool for s in drainSamples()]
+        if name == 'jotai':
+            assert tools == ['jotai_batch'] and not Jotai.unsupported
+        else:
+            # A batch cut short only falls back for its own files
+            assert tools == ['jotai_batch'] + ['jotai'] * 3
+            assert Jotai.unsupported == (name == 'jotai-nobatch')
+
+
+def test_generator_diff(tmp_path, monkeypatch, pyScript):
+    descriptor = 'function foo int\nunsigned int n\nchar *buf\n'
+    res = generate(descriptor, 'n 0 10\nbuf [64] -1 1\n')
+    assert res.err == success
+    assert 'unsigned int n = 0;' in res.msg and 'foo(n, buf);' in res.msg
+    assert 'malloc(64 * sizeof(char))' in res.msg and 'free(buf);' in res.msg
+
+    # Outside of the grammars: a missing param, an unknown type
+    assert generate(descriptor, 'n 0 10\n').err == failure
+    assert generate('function foo int\nstruct s x\n', 'x 0 1\n').err == failure
+
+    (tmp_path / 'descriptor').write_text(descriptor)
+    (tmp_path / 'ok').write_text('n 0 10\nbuf [64] -1 1\n')
+    (tmp_path / 'odd').write_text('n 0 10\nbuf 3\n')
+    paths = [tmp_path / 'ok', tmp_path / 'odd']
+
+    # Jotai: the native output for 'ok', something else for the rest
+    expected = generate(descriptor, (tmp_path / 'ok').read_text()).msg
+    script = pyScript('jotai', f'import sys\nprint({expected!r} if sys.argv[1].endswith("ok") else "jotai")\n')
+    monkeypatch.setattr(Jotai, 'exe', {'jotai': script})
+
+    monkeypatch.setattr(Generator, 'mode', 'diff')
+    drainStages()
+    results = drive(Generator.runbatch(tmp_path, ['int-bounds', 'big-arr'],
+                                       tmp_path / 'descriptor', paths))
+    assert [r.msg.strip() for r in results] == [expected, 'jotai']
+    records = drainStages()
+    assert [(r.stage, r.ket, r.kind) for r in records] == [
+        ('generator', 'int-bounds', ResultKind.OK),
+        ('generator', 'big-arr', ResultKind.FAIL)]
+
+    # Unreadable inputs fail the check, not the worker
+    (tmp_path / 'bad').write_bytes(b'\xff\xfe')
+    results = drive(Generator.runbatch(tmp_path, ['int-bounds', 'big-arr'], tmp_path / 'descriptor',
+                                       [tmp_path / 'bad', tmp_path / 'missing']))
+    assert [r.msg.strip() for r in results] == ['jotai', 'jotai']
+    assert [r.kind for r in drainStages()] == [ResultKind.FAIL] * 2
+
+
+def test_sanitizer_screen(tmp_path, monkeypatch):
+    memcheck = []
+    async def runMemcheck(self, timeout, *args):
+        memcheck.append(args)
+        return CmdResult('memcheck', ExitCode.OK)
+    monkeypatch.setattr(CFGgrind, '_run_valgrind_memcheck', runMemcheck)
+    monkeypatch.setattr(CFGgrind, 'ubScreen', 'sanitizer')
+
+    binPath = tmp_path / 'a_O0'
+    binPath.write_text('')
+    binPath.chmod(0o755)
+    cfggrind = CFGgrind(binPath, 'fn')
+
+    # No <bin>_san: memcheck decides
+    assert drive(cfggrind._screen('0')).err == ExitCode.OK and memcheck == [('0',)]
+
+    # A sanitizer report is conclusive
+    cfggrind.sanBinPath.write_text(f'#!/bin/sh\nexit {CFGgrind.sanitizerExitCode}\n')
+    cfggrind.sanBinPath.chmod(0o755)
+    res = drive(cfggrind._screen('0'))
+    assert res.err == ExitCode.ERR and res.returncode == CFGgrind.sanitizerExitCode
+    assert len(memcheck) == 1
+
+    # Any other failure isn't, unless the fallback is disabled
+    cfggrind.sanBinPath.write_text('#!/bin/sh\nexit 3\n')
+    assert drive(cfggrind._screen('0')).err == ExitCode.OK and len(memcheck) == 2
+    monkeypatch.setattr(CFGgrind, 'memcheckFallback', False)
+    assert drive(cfggrind._screen('0')).returncode == 3 and len(memcheck) == 2
+
+
+def test_cfggrind_missing_binary(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cfggrind = CFGgrind(tmp_path / 'bench.d' / 'a_O0', 'fn', 'big-arr')
+    assert cfggrind.mapFilePath == tmp_path / 'bench.d' / 'a_O0.map'
+    assert cfggrind.sanBinPath == tmp_path / 'bench.d' / 'a_O0_san'
+
+    # Nothing runs, nothing is written to the current dir
+    assert drive(cfggrind.asmmap()).err == ExitCode.ERR
+    assert drive(cfggrind.runcmd('0')).err == ExitCode.ERR
+    assert cfggrind.memcheckRes is None and list(tmp_path.iterdir()) == []